@@ -0,0 +1,101 @@
+"""
+Load imagery footprints from PgSTAC, shared by the global mosaic scripts.
+
+Rows are streamed from a server-side cursor in binary format, with the
+geometry as WKB, and decoded a batch at a time with shapely's vectorized
+`from_wkb`. Items are sorted newest first on pgstac's indexed `datetime`
+column. The result is kept columnar (NumPy arrays), so memory stays close
+to the size of the geometries themselves.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import shapely
+from psycopg import connect
+
+log = logging.getLogger("gen_mosaic.footprints")
+
+BATCH_SIZE = 10_000
+
+
+@dataclass
+class Footprints:
+    """Item ids, visual asset urls and footprint geometries, as arrays."""
+
+    ids: np.ndarray
+    urls: np.ndarray
+    geometries: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.geometries)
+
+    def subset(self, mask: np.ndarray) -> "Footprints":
+        """The footprints selected by a boolean mask (or index array)."""
+        return Footprints(self.ids[mask], self.urls[mask], self.geometries[mask])
+
+
+def load_footprints(
+    dsn: str,
+    collection: str,
+    bbox: Optional[tuple[float, float, float, float]] = None,
+    require_url: bool = False,
+    batch_size: int = BATCH_SIZE,
+) -> Footprints:
+    """
+    Stream the footprints of `collection` (intersecting `bbox` if given),
+    newest first. With `require_url`, items without a visual asset are
+    skipped. Items with a missing or invalid geometry are dropped.
+    """
+    where = ""
+    params: list = [collection]
+    if bbox is not None:
+        where += " AND geometry && ST_MakeEnvelope(%s, %s, %s, %s, 4326)"
+        params.extend(bbox)
+    if require_url:
+        where += " AND content->'assets'->'visual'->>'href' <> ''"
+
+    query = f"""
+        SELECT id,
+            content->'assets'->'visual'->>'href' AS url,
+            ST_AsBinary(geometry) AS wkb
+        FROM pgstac.items
+        WHERE collection = %s{where}
+        ORDER BY datetime DESC;
+    """
+
+    ids: list[np.ndarray] = []
+    urls: list[np.ndarray] = []
+    geometries: list[np.ndarray] = []
+    dropped = 0
+
+    with (
+        connect(dsn) as conn,
+        conn.cursor(name="footprints", binary=True) as cur,
+    ):
+        cur.itersize = batch_size
+        cur.execute(query, params)
+        while rows := cur.fetchmany(batch_size):
+            batch_ids, batch_urls, wkbs = (
+                np.array(c, dtype=object) for c in zip(*rows)
+            )
+            geoms = shapely.from_wkb(wkbs, on_invalid="ignore")
+            valid = ~shapely.is_missing(geoms)
+            dropped += len(rows) - np.count_nonzero(valid)
+
+            ids.append(batch_ids[valid])
+            urls.append(batch_urls[valid])
+            geometries.append(geoms[valid])
+            log.debug(f"Loaded {sum(len(g) for g in geometries)} footprints...")
+
+    if dropped:
+        log.warning(f"Dropped {dropped} items with a missing or invalid geometry")
+
+    empty = np.empty(0, dtype=object)
+    return Footprints(
+        np.concatenate(ids) if ids else empty,
+        np.concatenate(urls) if urls else empty,
+        np.concatenate(geometries) if geometries else empty,
+    )
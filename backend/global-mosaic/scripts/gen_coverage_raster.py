@@ -3,16 +3,15 @@
 Generate a PMTiles archive containing *partial-coverage* translucent grey tiles
 for zooms ZOOM_MIN-ZOOM_MAX by rasterizing PgSTAC footprints into each tile.
 
-NOTE we do not use this, as it's too memory inefficient for now.
-NOTE it could be optimised to run batches of tiles, and not load
-NOTE the job list in memory, instead using an iterator and yield.
+NOTE we do not use this for now.
 
 Workflow:
  - Queries pgstac.items for a collection inside a bbox (or global by default)
  - Builds a spatial index (STRtree) of footprints
- - Iterates tiles per-zoom and rasterizes overlapping footprints into a 256x256 tile
+ - Rasterizes overlapping footprints into the 256x256 tiles of ZOOM_MAX only
+ - Builds each coarser zoom by reducing the 2x2 masks of its child tiles
  - Writes only tiles that have any coverage (non-empty mask) into PMTiles
-    - Parallel tile rasterization per zoom level
+    - Parallel tile rasterization, in batches of tiles
     - Batch PMTiles writes for efficiency
  - PMTiles deduplicates identical tiles internally (so identical grey tiles will
    be stored only once)
@@ -24,37 +23,40 @@ Config (env):
  - TILE_SIZE (default: 256)
  - ZOOM_MIN (default: 0)
  - ZOOM_MAX (default: 15)
+ - COVERAGE_REDUCE (default: any): how child tiles are reduced into their
+   parent, "any" (covered if any child pixel is) or "mean" (fractional)
  - OUTPUT_PM (default: /app/output/global-coverage.pmtiles)
  - S3_ACCESS_KEY, S3_SECRET_KEY, (optional S3_ENDPOINT, S3_BUCKET, S3_REGION)
  - TEST_MODE (if set uses small test bbox)
  - LOG_LEVEL (DEBUG/INFO)
 """
 
-import json
 import logging
 import os
 import sys
 import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, List, Tuple
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from multiprocessing import cpu_count
 
 import numpy as np
-import affine
 import mercantile
-from psycopg import connect
-from shapely.geometry import shape, box, Polygon
+import shapely
+from shapely.geometry import box
 from shapely.strtree import STRtree
-from shapely.ops import unary_union
-from rasterio import features
 from rio_tiler.utils import render
 from pmtiles.writer import write
 from pmtiles.tile import zxy_to_tileid, TileType, Compression
 from minio import Minio
 from minio.error import S3Error
 
+from footprints import load_footprints
+from pyramid import CoveragePyramid, coverage_rgba, morton_order, rasterize_mask
+from tiling import TileLevel, bbox_tile_range, descend, iter_tile_candidates
+
 PG_DSN = os.getenv("PG_DSN")
 if not PG_DSN:
     PGHOST = os.getenv("PGHOST")
@@ -73,6 +75,8 @@ OUTPUT_PM = os.getenv("OUTPUT_PM", "/app/output/global-coverage.pmtiles")
 TILE_SIZE = int(os.getenv("TILE_SIZE", "256"))
 ZOOM_MIN = int(os.getenv("ZOOM_MIN", "0"))
 ZOOM_MAX = int(os.getenv("ZOOM_MAX", "15"))
+COVERAGE_REDUCE = os.getenv("COVERAGE_REDUCE", "any")
+TASK_BATCH = 4096
 
 TEST_MODE = bool(os.getenv("TEST_MODE", False))
 BBOX: tuple[float, float, float, float] = (
@@ -99,108 +103,35 @@ class TileJob:
 
 # NOTE: this global is intentionally set by the worker initializer to avoid
 # pickling 'geoms' for every single task.
-GEOMS: Optional[List[Polygon]] = None
+GEOMS: Optional[np.ndarray] = None
 
 
-def _init_worker(geoms: List[Polygon]) -> None:
+def _init_worker(geoms: np.ndarray) -> None:
     """
-    Run in worker process at start. Stores the geoms list in a module-level
+    Run in worker process at start. Stores the geoms array in a module-level
     global to avoid re-pickling for each task.
     """
     global GEOMS
     GEOMS = geoms
 
 
-def get_features() -> List[dict]:
-    """
-    Query PgSTAC for imagery features in BBOX.
-    Returns list of dicts: {"geometry": shapely.geometry, "url": <asset url or None>, "id": <id>}
-    """
-    where_bbox = "AND geometry && ST_MakeEnvelope(%s, %s, %s, %s, 4326)"
-    params = [COLLECTION] + list(BBOX)
-
-    query = f"""
-        SELECT id::text AS id,
-               content->'assets'->'visual'->>'href' AS url,
-               ST_AsGeoJSON(geometry) AS geom
-        FROM pgstac.items
-        WHERE collection = %s
-        {where_bbox}
-        ORDER BY (content->>'datetime')::timestamptz DESC;
-    """
-
-    log.info(f"Querying PgSTAC for features (bbox={BBOX})...")
-    features_list: List[dict] = []
-    try:
-        with connect(PG_DSN) as conn, conn.cursor() as cur:
-            cur.execute(query, params)
-            rows = cur.fetchall()
-    except Exception as e:
-        log.error(f"PgSTAC query failed: {e}")
-        raise
-
-    for id_, url, geom in rows:
-        if geom is None:
-            continue
-        try:
-            geom_obj = shape(json.loads(geom))
-            features_list.append({"geometry": geom_obj, "url": url, "id": id_})
-        except Exception as e:
-            log.warning(f"Failed to parse geometry for {id_}: {e}")
-
-    log.info(f"Found {len(features_list)} items in pgSTAC for bbox")
-    return features_list
-
-
-def make_partial_coverage_tile(
-    tile_bounds: tuple[float, float, float, float],
-    geoms: list[Polygon],
+def render_partial_coverage_tile(
+    mask: np.ndarray,
     color: tuple[int, int, int, int] = (128, 128, 128, 102),
-    tile_size: int = 256,
-) -> Optional[bytes]:
+) -> bytes:
     """
-    Create a PNG tile (tile_size x tile_size) with translucent coverage where imagery exists,
-    transparent elsewhere. Returns PNG bytes, or None if no coverage.
+    Render a coverage mask as a PNG tile with translucent coverage where imagery
+    exists, transparent elsewhere. Returns PNG bytes.
     """
-    if not geoms:
-        return None
-
-    west, south, east, north = tile_bounds
-    transform = affine.Affine(
-        (east - west) / tile_size, 0, west, 0, (south - north) / tile_size, north
-    )
-
-    try:
-        mask = features.rasterize(
-            [(geom, 1) for geom in geoms],
-            out_shape=(tile_size, tile_size),
-            transform=transform,
-            fill=0,
-            all_touched=True,
-            dtype="uint8",
-        )
-    except Exception as e:
-        log.error(f"Rasterization failed for bounds={tile_bounds}: {e}")
-        return None
-
-    if not np.any(mask):
-        return None
-
-    arr = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
-    r, g, b, a = color
-    arr[mask == 1, 0] = r
-    arr[mask == 1, 1] = g
-    arr[mask == 1, 2] = b
-    arr[mask == 1, 3] = a
-
-    return render(arr.transpose(2, 0, 1), img_format="PNG")
+    return render(coverage_rgba(mask, color), img_format="PNG")
 
 
 def process_tile(
-    z: int, tile: mercantile.Tile, candidate_indices: list[int], tile_size: int
-) -> Optional[tuple[int, bytes]]:
+    tile: mercantile.Tile, candidate_indices: np.ndarray, tile_size: int
+) -> Optional[tuple[int, int, np.ndarray, bytes]]:
     """
     Process a single tile: clip + simplify + rasterize.
+    Returns (x, y, mask, PNG bytes), or None if no coverage.
     Note: this runs in worker processes. It uses global GEOMS which is set via initializer.
     """
     global GEOMS
@@ -209,39 +140,41 @@ def process_tile(
     tile_geom = box(*tile_bounds)
 
     pixel_size = (tile_bounds[2] - tile_bounds[0]) / tile_size
-    clipped_simplified = []
-
-    # Iterate only candidate indices passed from main process (do not re-query STRtree)
-    for idx in candidate_indices:
-        geom = GEOMS[idx]
-        if geom.intersects(tile_geom):
-            clipped = geom.intersection(tile_geom)
-            if not clipped.is_empty:
-                clipped_simplified.append(
-                    clipped.simplify(pixel_size, preserve_topology=True)
-                )
+
+    # Only candidate indices passed from main process, which all intersect
+    # the tile (do not re-query STRtree), clipped and simplified at once
+    clipped = shapely.intersection(GEOMS[candidate_indices], tile_geom)
+    clipped = clipped[~shapely.is_empty(clipped)]
+    clipped_simplified = list(
+        shapely.simplify(clipped, pixel_size, preserve_topology=True)
+    )
 
     if not clipped_simplified:
         return None
 
-    data = make_partial_coverage_tile(
-        tile_bounds, clipped_simplified, tile_size=tile_size
-    )
-    if data:
-        return (zxy_to_tileid(tile.z, tile.x, tile.y), data)
-    return None
+    try:
+        mask = rasterize_mask(tile_bounds, clipped_simplified, tile_size)
+    except Exception as e:
+        log.error(f"Rasterization failed for bounds={tile_bounds}: {e}")
+        return None
+
+    if not np.any(mask):
+        return None
+    return tile.x, tile.y, mask, render_partial_coverage_tile(mask)
 
 
 def generate_partial_coverage_pmtiles() -> None:
-    features = get_features()
-    if not features:
+    log.info(f"Querying PgSTAC for features (bbox={BBOX})...")
+    footprints = load_footprints(PG_DSN, COLLECTION, BBOX)
+    log.info(f"Found {len(footprints)} items in pgSTAC for bbox")
+    if not len(footprints):
         log.warning("No features found - nothing to do.")
         return
 
-    geoms = [f["geometry"] for f in features]
+    geoms = footprints.geometries
     tree = STRtree(geoms)
 
-    overall_bounds = unary_union(geoms).bounds
+    overall_bounds = tuple(shapely.total_bounds(geoms).tolist())
     log.info(f"Overall feature bounds: {overall_bounds}")
 
     header = {
@@ -260,32 +193,44 @@ def generate_partial_coverage_pmtiles() -> None:
     Path(OUTPUT_PM).parent.mkdir(parents=True, exist_ok=True)
     start_time = time.time()
     total_written = 0
+    reduced_written = 0
 
     with write(OUTPUT_PM) as writer:
-        for z in range(ZOOM_MIN, ZOOM_MAX + 1):
-            tiles = list(mercantile.tiles(*overall_bounds, [z]))
-            total_tiles = len(tiles)
-            log.info(f"Processing zoom {z}: {total_tiles} candidate tiles")
 
-            # Find tiles that have any geometry candidate in tree
-            tasks: List[Tuple[mercantile.Tile, List[int]]] = []
-            for tile in tiles:
-                tile_geom = box(*mercantile.bounds(tile))
-                candidate_indices = tree.query(tile_geom)
-                # Generate if there is a match
-                if len(candidate_indices) > 0:
-                    tasks.append((tile, candidate_indices))
+        def write_reduced(z: int, x: int, y: int, mask: np.ndarray) -> None:
+            nonlocal total_written, reduced_written
+            writer.write_tile(
+                zxy_to_tileid(z, x, y), render_partial_coverage_tile(mask)
+            )
+            total_written += 1
+            reduced_written += 1
+
+        # Coarser zooms are reduced from the tiles of ZOOM_MAX
+        pyramid = CoveragePyramid(
+            ZOOM_MIN, ZOOM_MAX, write_reduced, TILE_SIZE, COVERAGE_REDUCE
+        )
 
-            skipped_tiles = total_tiles - len(tasks)
+        for level in descend(tree, overall_bounds, ZOOM_MAX, ZOOM_MAX):
+            z = level.z
+            xmin, ymin, xmax, ymax = bbox_tile_range(overall_bounds, z)
+            total_tiles = (xmax - xmin + 1) * (ymax - ymin + 1)
+            log.info(f"Processing zoom {z}: {total_tiles} candidate tiles")
+
+            task_count = len(level)
+            skipped_tiles = total_tiles - task_count
             log.info(
-                f"Zoom {z}: {len(tasks)} tiles to process ({100 - (skipped_tiles / total_tiles) * 100:.1f}% coverage)"
+                f"Zoom {z}: {task_count} tiles to process ({100 - (skipped_tiles / total_tiles) * 100:.1f}% coverage)"
             )
 
-            if not tasks:
+            if not task_count:
                 continue
 
+            # The pyramid needs the tiles in Z-order
+            order = morton_order(level.x, level.y)
+            level = TileLevel(z, level.x[order], level.y[order], level.full[order])
+
             # Leave one core spare for main thread + IO
-            max_workers = max(1, min(cpu_count() - 1, len(tasks)))
+            max_workers = max(1, min(cpu_count() - 1, task_count))
             log.debug(f"Using {max_workers} worker processes for zoom {z}")
 
             zoom_start_time = time.time()
@@ -296,51 +241,65 @@ def generate_partial_coverage_pmtiles() -> None:
             with ProcessPoolExecutor(
                 max_workers=max_workers, initializer=_init_worker, initargs=(geoms,)
             ) as exe:
-                futures = [
-                    exe.submit(process_tile, z, tile, candidate_indices, TILE_SIZE)
-                    for tile, candidate_indices in tasks
-                ]
-
-                for fut in as_completed(futures):
-                    completed_tasks += 1
-                    current_time = time.time()
-
-                    try:
-                        result = fut.result()
-                    except Exception as e:
-                        log.exception(f"Tile processing failed (zoom {z}): {e}")
-                        result = None
-
-                    if result:
-                        writer.write_tile(*result)
-                        total_written += 1
-                        tiles_written_this_zoom += 1
-
-                    # Log every 30 seconds or on completion
-                    if (current_time - last_log_time) >= 30 or completed_tasks == len(
-                        tasks
-                    ):
-                        progress_pct = (completed_tasks / len(tasks)) * 100.0
-                        elapsed = current_time - zoom_start_time
-                        rate = completed_tasks / elapsed if elapsed > 0 else 0
-                        eta = (len(tasks) - completed_tasks) / rate if rate > 0 else 0
-
-                        eta_str = f"{eta / 60:.1f}m" if eta > 60 else f"{eta:.1f}s"
-
-                        log.info(
-                            f"Zoom {z}: {progress_pct:.1f}% | "
-                            f"{completed_tasks}/{len(tasks)} tasks | "
-                            f"{tiles_written_this_zoom} tiles written | "
-                            f"rate {rate:.1f}/sec | "
-                            f"ETA {eta_str}"
-                        )
-                        last_log_time = current_time
+                # Find the geometry candidates of blocks of tiles at once, and
+                # only keep a batch of tasks in flight
+                tasks = iter_tile_candidates(tree, level)
+                while batch := list(islice(tasks, TASK_BATCH)):
+                    futures = [
+                        exe.submit(process_tile, tile, candidate_indices, TILE_SIZE)
+                        for tile, candidate_indices in batch
+                    ]
+
+                    # In submission order, to feed the pyramid in Z-order
+                    for fut in futures:
+                        completed_tasks += 1
+                        current_time = time.time()
+
+                        try:
+                            result = fut.result()
+                        except Exception as e:
+                            log.exception(f"Tile processing failed (zoom {z}): {e}")
+                            result = None
+
+                        if result:
+                            x, y, mask, data = result
+                            writer.write_tile(zxy_to_tileid(z, x, y), data)
+                            pyramid.add(x, y, mask)
+                            total_written += 1
+                            tiles_written_this_zoom += 1
+
+                        # Log every 30 seconds or on completion
+                        if (
+                            current_time - last_log_time
+                        ) >= 30 or completed_tasks == task_count:
+                            progress_pct = (completed_tasks / task_count) * 100.0
+                            elapsed = current_time - zoom_start_time
+                            rate = completed_tasks / elapsed if elapsed > 0 else 0
+                            eta = (
+                                (task_count - completed_tasks) / rate if rate > 0 else 0
+                            )
+
+                            eta_str = f"{eta / 60:.1f}m" if eta > 60 else f"{eta:.1f}s"
+
+                            log.info(
+                                f"Zoom {z}: {progress_pct:.1f}% | "
+                                f"{completed_tasks}/{task_count} tasks | "
+                                f"{tiles_written_this_zoom} tiles written | "
+                                f"rate {rate:.1f}/sec | "
+                                f"ETA {eta_str}"
+                            )
+                            last_log_time = current_time
 
             zoom_elapsed = time.time() - zoom_start_time
             log.info(
                 f"Zoom {z} complete: {tiles_written_this_zoom} tiles written in {zoom_elapsed / 60.0:.1f} min"
             )
 
+        pyramid.close()
+        log.info(
+            f"Zooms {ZOOM_MIN}-{ZOOM_MAX - 1} reduced: {reduced_written} tiles written"
+        )
+
         writer.finalize(header=header, metadata=metadata)
 
     elapsed_total = time.time() - start_time
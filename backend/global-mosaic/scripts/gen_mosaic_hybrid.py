@@ -21,33 +21,40 @@ Configuration (env):
  - TEST_MODE: if set => uses small BBOX; otherwise global BBOX
  - LOG_LEVEL: the log level to use, from "DEBUG" or "INFO"
  - BATCH_FACTOR: number of concurrent tasks per thread to keep in flight (default 5)
+ - PLAN_FILE: where the tile plan is saved (default: next to OUTPUT_PM, .plan.npz)
+ - COVERAGE_TILE_SECONDS: estimated time to render a coverage tile (default 0.05)
+ - DOWNLOAD_TILE_SECONDS: estimated time of a tile download (default 1.0)
+
+Run with --plan-only to only plan the tiles and log the estimates (dry run).
 """
 
+import argparse
 import asyncio
-import json
 import logging
 import os
 import sys
 import time
 from dataclasses import dataclass
-from typing import Optional, Iterable
+from typing import Iterator, Optional
 from pathlib import Path
 from urllib.parse import quote_plus
 
 import aiohttp
 import mercantile
 import numpy as np
-import affine
-from psycopg import connect
-from shapely.geometry import shape, box
+import shapely
+from shapely.geometry import box
 from shapely.strtree import STRtree
-from rasterio import features
 from rio_tiler.utils import render
 from pmtiles.writer import write
 from pmtiles.tile import zxy_to_tileid, TileType, Compression
 from minio import Minio
 from minio.error import S3Error
 
+from footprints import Footprints, load_footprints
+from pyramid import CoveragePyramid, coverage_rgba, morton_order, rasterize_mask
+from tiling import TileLevel, descend, iter_tile_candidates
+
 PG_DSN = os.getenv("PG_DSN")
 if not PG_DSN:
     PGHOST = os.getenv("PGHOST")
@@ -93,6 +100,13 @@ BATCH_FACTOR = int(
 MAX_INFLIGHT = max(THREADS * BATCH_FACTOR, 16)
 LOG_EVERY = int(os.getenv("LOG_EVERY", "500"))
 
+# tile planning
+PLAN_FILE = os.getenv("PLAN_FILE", str(Path(OUTPUT_PM).with_suffix(".plan.npz")))
+COVERAGE_TILE_SECONDS = float(os.getenv("COVERAGE_TILE_SECONDS", "0.05"))
+DOWNLOAD_TILE_SECONDS = float(os.getenv("DOWNLOAD_TILE_SECONDS", "1.0"))
+COVERAGE_ZOOMS = range(ZOOM_MIN, min(10, ZOOM_MAX) + 1)
+DOWNLOAD_ZOOMS = range(11, min(ZOOM_MAX, 14) + 1)
+
 # Setup main progress logger
 logging.basicConfig(
     stream=sys.stdout,
@@ -117,55 +131,88 @@ class TileJob:
     y: int
 
 
-def get_features() -> list[dict]:
+def plan_tiles(tree: STRtree, plan_file: str = PLAN_FILE) -> dict[int, int]:
     """
-    Query PgSTAC for imagery features in BBOX (synchronous).
-    Returns list of dicts: {"geometry": shapely.geometry, "url": <asset url or None>, "id": <id>}
+    Enumerate the tiles to render at every zoom in a single quadtree descent,
+    and save them to plan_file as compressed x/y arrays per zoom.
+    Returns the number of tiles per zoom.
     """
-    where_bbox = ""
-    params = [COLLECTION]
-    where_bbox = "AND geometry && ST_MakeEnvelope(%s, %s, %s, %s, 4326)"
-    params.extend(BBOX)
-
-    query = f"""
-        SELECT id::text AS id,
-            content->'assets'->'visual'->>'href' AS url,
-            ST_AsGeoJSON(geometry) AS geom
-        FROM pgstac.items
-        WHERE collection = %s
-        {where_bbox}
-        ORDER BY (content->>'datetime')::timestamptz DESC;
+    zooms = [*COVERAGE_ZOOMS, *DOWNLOAD_ZOOMS]
+    counts = {z: 0 for z in zooms}
+    arrays: dict[str, np.ndarray] = {}
+    if zooms:
+        for level in descend(tree, BBOX, zooms[0], zooms[-1]):
+            if level.z not in counts:
+                continue
+            counts[level.z] = len(level)
+            arrays[f"x{level.z}"] = level.x.astype(np.uint32)
+            arrays[f"y{level.z}"] = level.y.astype(np.uint32)
+            arrays[f"full{level.z}"] = level.full
+
+    Path(plan_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(plan_file, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    return counts
+
+
+def iter_plan(zooms: range, plan_file: str = PLAN_FILE) -> Iterator[TileLevel]:
     """
+    Yield the planned tiles of each zoom, loading one zoom at a time from
+    plan_file.
+    """
+    with np.load(plan_file) as plan:
+        for z in zooms:
+            if f"x{z}" not in plan.files:
+                continue
+            yield TileLevel(
+                z,
+                plan[f"x{z}"].astype(np.int64),
+                plan[f"y{z}"].astype(np.int64),
+                plan[f"full{z}"],
+            )
 
-    log.info(f"Querying PgSTAC for features (bbox={BBOX})...")
-    features: list[dict] = []
-    with connect(PG_DSN) as conn, conn.cursor() as cur:
-        cur.execute(query, params)
-        rows = cur.fetchall()
-
-    for id_, url, geom in rows:
-        if geom is None:
-            continue
-        try:
-            geom_json = json.loads(geom)
-            geom_obj = shape(geom_json)
-            features.append({"geometry": geom_obj, "url": url, "id": id_})
-        except Exception as e:
-            log.warning(f"Failed to parse geometry for {id_}: {e}")
 
-    log.info(f"Found {len(features)} items in pgSTAC for bbox")
-    return features
+def estimate_plan(counts: dict[int, int], footprints: Footprints) -> None:
+    """Log the tiles per zoom, and the estimated runtime, memory and HTTP requests."""
+    coverage_tiles = sum(counts[z] for z in COVERAGE_ZOOMS)
+    download_tiles = sum(counts[z] for z in DOWNLOAD_ZOOMS)
+
+    runtime = (
+        coverage_tiles * COVERAGE_TILE_SECONDS
+        + download_tiles * DOWNLOAD_TILE_SECONDS / THREADS
+    )
+    # footprint coordinates (+ per-geometry overhead), the largest zoom of
+    # the plan while rendering (x, y, full), and the tiles in flight
+    memory = (
+        int(shapely.get_num_coordinates(footprints.geometries).sum()) * 16
+        + len(footprints) * 256
+        + max(counts.values(), default=0) * 17
+        + MAX_INFLIGHT * TILE_SIZE * TILE_SIZE * 4
+    )
+
+    for z, count in counts.items():
+        log.info(f"Zoom {z}: {count} tiles")
+    log.info(
+        f"Tiles to render: {coverage_tiles + download_tiles} "
+        f"(coverage={coverage_tiles} download={download_tiles})"
+    )
+    log.info(
+        f"HTTP requests: {download_tiles} "
+        f"(up to {download_tiles * (RETRIES + 1)} with retries)"
+    )
+    log.info(f"Estimated runtime: {runtime / 60.0:.1f} min")
+    log.info(f"Estimated peak memory: {memory / 2**20:.0f} MiB")
 
 
-def iter_tiles_for_zoom(features_tree: STRtree, z: int) -> Iterable[mercantile.Tile]:
+def render_coverage_tile(
+    mask: np.ndarray,
+    color: tuple[int, int, int, int] = (128, 128, 128, 102),
+) -> bytes:
     """
-    Yield tiles at zoom z that intersect any feature in the provided spatial index.
-    Iterate per zoom level, avoiding building whole list in memory.
+    Render a coverage mask as a PNG tile, with translucent coverage where
+    imagery exists, transparent elsewhere. Returns PNG bytes.
     """
-    for tile in mercantile.tiles(*BBOX, [z]):
-        tile_geom = box(*mercantile.bounds(tile))
-        if len(features_tree.query(tile_geom)) > 0:
-            yield tile
+    return render(coverage_rgba(mask, color), img_format="PNG")
 
 
 def make_coverage_tile_for_geom(
@@ -177,32 +224,7 @@ def make_coverage_tile_for_geom(
     Create a PNG tile (256x256) with translucent coverage where imagery exists,
     transparent elsewhere. Returns PNG bytes.
     """
-    if not geoms:
-        arr = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
-        return render(arr.transpose(2, 0, 1), img_format="PNG")
-
-    west, south, east, north = tile_bounds
-    transform = affine.Affine(
-        (east - west) / TILE_SIZE, 0, west, 0, (south - north) / TILE_SIZE, north
-    )
-
-    mask = features.rasterize(
-        [(geom, 1) for geom in geoms],
-        out_shape=(TILE_SIZE, TILE_SIZE),
-        transform=transform,
-        fill=0,
-        all_touched=True,
-        dtype="uint8",
-    )
-
-    arr = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
-    r, g, b, a = color
-    arr[mask == 1, 0] = r
-    arr[mask == 1, 1] = g
-    arr[mask == 1, 2] = b
-    arr[mask == 1, 3] = a
-
-    return render(arr.transpose(2, 0, 1), img_format="PNG")
+    return render_coverage_tile(rasterize_mask(tile_bounds, geoms, TILE_SIZE), color)
 
 
 async def fetch_tile_bytes(
@@ -242,27 +264,28 @@ async def fetch_tile_bytes(
     return None
 
 
-def generate_mosaic() -> None:
+def generate_mosaic(plan_only: bool = False) -> None:
     """
-    Main entrypoint (synchronous). Queries PG, builds tile list per-zoom (streamed), and writes PMTiles.
+    Main entrypoint (synchronous). Queries PG, plans the tiles per-zoom (saved to PLAN_FILE), and writes PMTiles.
     Uses a memory-bounded asyncio pattern to download 11-14 tiles concurrently while keeping a small window of work in memory.
+    With plan_only, stops after logging the plan estimates.
     """
-    features = get_features()
-    if not features:
+    log.info(f"Querying PgSTAC for features (bbox={BBOX})...")
+    footprints = load_footprints(PG_DSN, COLLECTION, BBOX)
+    log.info(f"Found {len(footprints)} items in pgSTAC for bbox")
+    if not len(footprints):
         log.warning("No features found - nothing to do.")
         return
 
-    geoms = [f["geometry"] for f in features]
-    tree = STRtree(geoms)
+    tree = STRtree(footprints.geometries)
 
-    # estimate total tiles (light-weight iteration)
-    total_estimated_tiles = 0
-    for z in range(ZOOM_MIN, ZOOM_MAX + 1):
-        cnt = sum(1 for _ in iter_tiles_for_zoom(tree, z))
-        total_estimated_tiles += cnt
-    log.info(
-        f"Estimated total tiles to render (z {ZOOM_MIN}-{ZOOM_MAX}): {total_estimated_tiles}"
-    )
+    # plan the tiles once, the render stage reads them back from the plan
+    counts = plan_tiles(tree)
+    total_estimated_tiles = sum(counts.values())
+    log.info(f"Tile plan written: {PLAN_FILE}")
+    estimate_plan(counts, footprints)
+    if plan_only:
+        return
 
     header = {
         "version": 3,
@@ -283,34 +306,45 @@ def generate_mosaic() -> None:
     skipped = 0
 
     with write(OUTPUT_PM) as writer:
-        # Part A: coverage tiles (z 0-10)
-        for z in sorted(range(ZOOM_MIN, min(10, ZOOM_MAX) + 1)):
-            log.info(f"Processing coverage zoom {z}")
-            # iterate directly to avoid building large lists for higher zooms
-            for tile in iter_tiles_for_zoom(tree, z):
-                tile_geom = box(*mercantile.bounds(tile))
-                candidate_idx = tree.query(tile_geom)
-                if len(candidate_idx) == 0:
-                    data = make_coverage_tile_for_geom(mercantile.bounds(tile), [])
-                else:
-                    covered_geoms = [tree.geometries[i] for i in candidate_idx]
-                    data = make_coverage_tile_for_geom(
-                        mercantile.bounds(tile), covered_geoms
-                    )
-
-                writer.write_tile(zxy_to_tileid(tile.z, tile.x, tile.y), data)
-                written += 1
-                processed += 1
-                if processed % LOG_EVERY == 0:
-                    log.info(
-                        f"Processed {processed}/{total_estimated_tiles} (written={written} skipped={skipped})"
+        # Part A: coverage tiles (z 0-10), rasterized at the finest coverage
+        # zoom only, the coarser zooms are reduced from it
+        def write_coverage(z: int, x: int, y: int, mask: np.ndarray) -> None:
+            nonlocal processed, written
+            writer.write_tile(zxy_to_tileid(z, x, y), render_coverage_tile(mask))
+            written += 1
+            processed += 1
+            if processed % LOG_EVERY == 0:
+                log.info(
+                    f"Processed {processed}/{total_estimated_tiles} (written={written} skipped={skipped})"
+                )
+
+        if COVERAGE_ZOOMS:
+            pyramid = CoveragePyramid(
+                COVERAGE_ZOOMS[0], COVERAGE_ZOOMS[-1], write_coverage, TILE_SIZE
+            )
+            for level in iter_plan(COVERAGE_ZOOMS[-1:]):
+                log.info(
+                    f"Processing coverage zoom {level.z} (reduced down to zoom {COVERAGE_ZOOMS[0]})"
+                )
+                # the pyramid needs the tiles in Z-order
+                order = morton_order(level.x, level.y)
+                level = TileLevel(
+                    level.z, level.x[order], level.y[order], level.full[order]
+                )
+                # query the footprints of blocks of tiles at once
+                for tile, candidate_idx in iter_tile_candidates(tree, level):
+                    covered_geoms = list(tree.geometries[candidate_idx])
+                    mask = rasterize_mask(
+                        mercantile.bounds(tile), covered_geoms, TILE_SIZE
                     )
+                    write_coverage(tile.z, tile.x, tile.y, mask)
+                    pyramid.add(tile.x, tile.y, mask)
+            pyramid.close()
 
         # Part B: TiTiler tiles (z 11-14) - streaming, bounded concurrency
-        download_zoom_range = [z for z in range(11, min(ZOOM_MAX, 14) + 1)]
-        if download_zoom_range:
+        if DOWNLOAD_ZOOMS:
             log.info(
-                f"Downloading tiles for zooms {download_zoom_range} using {THREADS} workers (max inflight={MAX_INFLIGHT})"
+                f"Downloading tiles for zooms {list(DOWNLOAD_ZOOMS)} using {THREADS} workers (max inflight={MAX_INFLIGHT})"
             )
 
             # create a dedicated event loop for downloads
@@ -374,11 +408,11 @@ def generate_mosaic() -> None:
                                 )
 
                     # process tiles zoom-by-zoom, creating only small batches of tasks
-                    for z in download_zoom_range:
-                        log.info(f"Queueing download tasks for zoom {z}")
+                    for level in iter_plan(DOWNLOAD_ZOOMS):
+                        log.info(f"Queueing download tasks for zoom {level.z}")
                         tasks: list[asyncio.Task] = []
                         count = 0
-                        for tile in iter_tiles_for_zoom(tree, z):
+                        for tile in level.tiles():
                             task = asyncio.create_task(process_tile(tile))
                             tasks.append(task)
                             count += 1
@@ -394,7 +428,7 @@ def generate_mosaic() -> None:
                             await asyncio.gather(*tasks)
                             tasks.clear()
 
-                        log.info(f"Finished zoom {z}")
+                        log.info(f"Finished zoom {level.z}")
 
             try:
                 loop.run_until_complete(downloads_coroutine())
@@ -469,6 +503,19 @@ def upload_to_s3():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the global mosaic PMTiles")
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="only plan the tiles and log the estimates, without rendering",
+    )
+    args = parser.parse_args()
+
+    if args.plan_only:
+        log.info(f"Planning PMTiles generation (TEST_MODE={TEST_MODE})")
+        generate_mosaic(plan_only=True)
+        sys.exit(0)
+
     if Path(OUTPUT_PM).exists():
         log.info(
             f"PMTiles archive at {OUTPUT_PM} already exists, skipping straight to upload"
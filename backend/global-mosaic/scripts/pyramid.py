@@ -0,0 +1,138 @@
+"""
+Coverage pyramid for the global mosaic coverage scripts.
+
+Coverage masks are rasterized once, at the finest zoom, and each coarser
+zoom is built by reducing the 2x2 masks of its children (OR, or mean for a
+fractional coverage). Finest tiles are fed in Z-order (see `morton_order`),
+so the four children of a tile arrive together at every level: only one
+parent is assembled per zoom at a time, which keeps memory bounded whatever
+the number of tiles.
+
+Masks are uint8 arrays of tile_size x tile_size, 255 where covered.
+"""
+
+from typing import Callable
+
+import affine
+import numpy as np
+from rasterio import features
+
+
+def rasterize_mask(
+    tile_bounds: tuple[float, float, float, float],
+    geoms: list,
+    tile_size: int = 256,
+) -> np.ndarray:
+    """Coverage mask of geoms over a tile (all touched pixels covered)."""
+    if not len(geoms):
+        return np.zeros((tile_size, tile_size), dtype=np.uint8)
+
+    west, south, east, north = tile_bounds
+    transform = affine.Affine(
+        (east - west) / tile_size, 0, west, 0, (south - north) / tile_size, north
+    )
+    return features.rasterize(
+        [(geom, 255) for geom in geoms],
+        out_shape=(tile_size, tile_size),
+        transform=transform,
+        fill=0,
+        all_touched=True,
+        dtype="uint8",
+    )
+
+
+def coverage_rgba(mask: np.ndarray, color: tuple[int, int, int, int]) -> np.ndarray:
+    """
+    RGBA array (bands first) of color where mask is set, with the alpha
+    scaled by the mask, transparent elsewhere.
+    """
+    r, g, b, a = color
+    arr = np.zeros((4, *mask.shape), dtype=np.uint8)
+    covered = mask > 0
+    arr[0][covered] = r
+    arr[1][covered] = g
+    arr[2][covered] = b
+    arr[3] = (mask.astype(np.uint16) * a // 255).astype(np.uint8)
+    return arr
+
+
+def morton_order(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Indices sorting tiles of a zoom in Z-order (as their quadkeys)."""
+    code = np.zeros(len(x), dtype=np.uint64)
+    x = x.astype(np.uint64)
+    y = y.astype(np.uint64)
+    for bit in range(32):
+        b = np.uint64(bit)
+        code |= ((x >> b) & np.uint64(1)) << np.uint64(2 * bit)
+        code |= ((y >> b) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return np.argsort(code, kind="stable")
+
+
+def reduce_2x2(canvas: np.ndarray, how: str = "any") -> np.ndarray:
+    """Halve a mask by reducing each 2x2 block of pixels."""
+    size = canvas.shape[0] // 2
+    blocks = canvas.reshape(size, 2, size, 2)
+    if how == "any":
+        return blocks.max(axis=(1, 3))
+    if how == "mean":
+        return np.rint(blocks.mean(axis=(1, 3))).astype(np.uint8)
+    raise ValueError(f"Unknown coverage reduction: {how}")
+
+
+class CoveragePyramid:
+    """
+    Builds the masks of zooms zoom_min to zoom_max - 1 from those of
+    zoom_max, added in Z-order. Each built mask is passed to
+    on_tile(z, x, y, mask); tiles without any coverage are skipped.
+    """
+
+    def __init__(
+        self,
+        zoom_min: int,
+        zoom_max: int,
+        on_tile: Callable[[int, int, int, np.ndarray], None],
+        tile_size: int = 256,
+        how: str = "any",
+    ) -> None:
+        self.zoom_min = zoom_min
+        self.zoom_max = zoom_max
+        self.on_tile = on_tile
+        self.tile_size = tile_size
+        self.how = how
+        # Per zoom, the parent tile being assembled: x, y and its children
+        self._canvases: dict[int, tuple[int, int, np.ndarray]] = {}
+
+    def add(self, x: int, y: int, mask: np.ndarray) -> None:
+        """Add the mask of a tile at zoom_max."""
+        self._add_child(self.zoom_max, x, y, mask)
+
+    def close(self) -> None:
+        """Build the tiles still being assembled."""
+        for z in range(self.zoom_max - 1, self.zoom_min - 1, -1):
+            if z in self._canvases:
+                self._flush(z)
+
+    def _add_child(self, z: int, x: int, y: int, mask: np.ndarray) -> None:
+        if z <= self.zoom_min:
+            return
+        pz, px, py = z - 1, x >> 1, y >> 1
+        current = self._canvases.get(pz)
+        if current is not None and current[:2] != (px, py):
+            self._flush(pz)
+            current = None
+        if current is None:
+            size = 2 * self.tile_size
+            current = (px, py, np.zeros((size, size), dtype=np.uint8))
+            self._canvases[pz] = current
+
+        row = (y & 1) * self.tile_size
+        col = (x & 1) * self.tile_size
+        current[2][row : row + self.tile_size, col : col + self.tile_size] = mask
+
+    def _flush(self, z: int) -> None:
+        x, y, canvas = self._canvases.pop(z)
+        mask = reduce_2x2(canvas, self.how)
+        if not np.any(mask):
+            return
+        self.on_tile(z, x, y, mask)
+        self._add_child(z, x, y, mask)
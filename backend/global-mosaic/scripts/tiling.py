@@ -0,0 +1,176 @@
+"""
+Tile enumeration for the global mosaic scripts, by quadtree descent.
+
+Instead of testing every tile of the bbox at every zoom, tiles are
+enumerated from zoom 0 down: only the children of tiles intersecting a
+footprint are tested, and the subtree of a tile covered by a footprint is
+emitted without any further geometry test. The cost follows the covered
+area, not the size of the world.
+"""
+
+from dataclasses import dataclass
+from typing import Iterator
+
+import mercantile
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+# As mercantile.tiles(), to keep tiles only touching the bbox edges out
+LL_EPSILON = 1e-11
+MAX_LAT = 85.051129
+
+# Offsets of the four children of a tile, in x and y
+CHILD_DX = np.array([0, 1, 0, 1])
+CHILD_DY = np.array([0, 0, 1, 1])
+
+# Tiles per batched tree query, bounding the memory of the results
+BLOCK_SIZE = 4096
+
+
+@dataclass
+class TileLevel:
+    """The tiles of a zoom level, as arrays of x and y."""
+
+    z: int
+    x: np.ndarray
+    y: np.ndarray
+    # Whether each tile is covered by a single footprint (so are its children)
+    full: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def tiles(self) -> Iterator[mercantile.Tile]:
+        for x, y in zip(self.x.tolist(), self.y.tolist()):
+            yield mercantile.Tile(x, y, self.z)
+
+
+def tile_bounds(
+    x: np.ndarray, y: np.ndarray, z: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """(west, south, east, north) arrays of tiles, as mercantile.bounds()."""
+    n = 2.0**z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def bbox_tile_range(
+    bbox: tuple[float, float, float, float], z: int
+) -> tuple[int, int, int, int]:
+    """(xmin, ymin, xmax, ymax) of the tiles intersecting bbox at zoom z."""
+    west, south, east, north = bbox
+    west, south = max(west, -180.0), max(south, -MAX_LAT)
+    east, north = min(east, 180.0), min(north, MAX_LAT)
+    ul = mercantile.tile(west, north, z)
+    lr = mercantile.tile(east - LL_EPSILON, south + LL_EPSILON, z)
+    last = 2**z - 1
+    return (
+        min(max(ul.x, 0), last),
+        min(max(ul.y, 0), last),
+        min(max(lr.x, 0), last),
+        min(max(lr.y, 0), last),
+    )
+
+
+def query_tiles(
+    tree: STRtree,
+    x: np.ndarray,
+    y: np.ndarray,
+    z: int,
+    predicate: str = "intersects",
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (tile, footprint) index pairs of the tiles at x, y for which
+    `predicate(tile, footprint)` holds, in a single tree query. Pairs are
+    sorted by tile, then footprint (so newest first within a tile).
+    """
+    boxes = shapely.box(*tile_bounds(x, y, z))
+    tile_idx, geom_idx = tree.query(boxes, predicate=predicate)
+    order = np.lexsort((geom_idx, tile_idx))
+    return tile_idx[order], geom_idx[order]
+
+
+def tile_candidates(
+    tree: STRtree, x: np.ndarray, y: np.ndarray, z: int
+) -> list[np.ndarray]:
+    """The footprint indices intersecting each tile at x, y (maybe empty)."""
+    tile_idx, geom_idx = query_tiles(tree, x, y, z)
+    return np.split(geom_idx, np.searchsorted(tile_idx, np.arange(1, len(x))))
+
+
+def iter_tile_candidates(
+    tree: STRtree, level: TileLevel, block_size: int = BLOCK_SIZE
+) -> Iterator[tuple[mercantile.Tile, np.ndarray]]:
+    """
+    Yield the tiles of level intersecting footprints, with the footprint
+    indices of each, querying block_size tiles at a time.
+    """
+    for start in range(0, len(level), block_size):
+        x = level.x[start : start + block_size]
+        y = level.y[start : start + block_size]
+        for tx, ty, candidates in zip(
+            x.tolist(), y.tolist(), tile_candidates(tree, x, y, level.z)
+        ):
+            if len(candidates):
+                yield mercantile.Tile(tx, ty, level.z), candidates
+
+
+def classify_tiles(
+    tree: STRtree, x: np.ndarray, y: np.ndarray, z: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Whether each tile intersects a footprint of tree, and whether it is
+    covered by one.
+    """
+    hit = np.zeros(len(x), dtype=bool)
+    covered = np.zeros(len(x), dtype=bool)
+    for start in range(0, len(x), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        boxes = shapely.box(*tile_bounds(x[block], y[block], z))
+        hits = np.unique(tree.query(boxes, predicate="intersects")[0])
+        hit[start + hits] = True
+        fulls = tree.query(boxes[hits], predicate="covered_by")[0]
+        covered[start + hits[fulls]] = True
+    return hit, covered
+
+
+def descend(
+    tree: STRtree,
+    bbox: tuple[float, float, float, float],
+    zoom_min: int,
+    zoom_max: int,
+) -> Iterator[TileLevel]:
+    """
+    Yield, per zoom from zoom_min to zoom_max, the tiles in bbox that
+    intersect a footprint of tree.
+    """
+    x = np.zeros(1, dtype=np.int64)
+    y = np.zeros(1, dtype=np.int64)
+    full = np.zeros(1, dtype=bool)
+
+    for z in range(zoom_max + 1):
+        if z > 0:
+            x = (np.repeat(x * 2, 4).reshape(-1, 4) + CHILD_DX).ravel()
+            y = (np.repeat(y * 2, 4).reshape(-1, 4) + CHILD_DY).ravel()
+            full = np.repeat(full, 4)
+
+        xmin, ymin, xmax, ymax = bbox_tile_range(bbox, z)
+        inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        x, y, full = x[inside], y[inside], full[inside]
+
+        # Only tiles not already known to be covered need a geometry test
+        test = np.flatnonzero(~full)
+        hit, covered = classify_tiles(tree, x[test], y[test], z)
+        full[test] = covered
+        keep = full.copy()
+        keep[test] = hit
+        x, y, full = x[keep], y[keep], full[keep]
+
+        if z >= zoom_min:
+            yield TileLevel(z, x, y, full)
+        if not len(x):
+            return
@@ -0,0 +1,264 @@
+"""Admission control in front of the database pool.
+
+Every request takes one of `max_concurrency` slots while it runs. A client
+(identified by its API key, or else its IP address) can hold at most
+`client_concurrency` of them, so a harvester paging through `/search` with
+large limits queues behind its own requests instead of taking all of the
+slots. Requests waiting for a slot are admitted in arrival order, skipping
+those whose client is at its limit.
+
+Load is shed with:
+
+- 429 and `Retry-After` when a client exceeds its request rate, or already
+  has `client_queue_size` requests waiting;
+- 503 and `Retry-After` when the wait queue is full, or a request waited
+  longer than `queue_timeout` seconds.
+"""
+
+import asyncio
+import hashlib
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import orjson
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.metrics import Counter, Gauge, Metrics
+from app.routes import route_path
+
+# Paths that are never queued, so that probes and scrapes see a loaded
+# server rather than waiting in line
+EXEMPT_PREFIXES = ("/_mgmt", "/metrics")
+
+# Idle client state is dropped after this many seconds
+CLIENT_IDLE_TIMEOUT = 300.0
+
+
+@dataclass
+class _Client:
+    tokens: float
+    updated: float
+    running: int = 0
+    queued: int = 0
+
+
+@dataclass
+class _Waiter:
+    client_id: str
+    future: asyncio.Future
+
+
+class AdmissionControlMiddleware:
+    """Per-client concurrency and rate limits, with a bounded wait queue."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        max_concurrency: int,
+        client_concurrency: int,
+        client_rate: float = 0.0,
+        client_burst: int = 0,
+        queue_size: int = 100,
+        client_queue_size: int = 10,
+        queue_timeout: float = 10.0,
+        api_key_header: Optional[str] = None,
+        trust_forwarded_for: bool = False,
+        metrics: Optional[Metrics] = None,
+    ) -> None:
+        """`client_rate` is in requests per second (0 for no rate limit),
+        with bursts of up to `client_burst` requests.
+        """
+        self.app = app
+        self.max_concurrency = max_concurrency
+        self.client_concurrency = client_concurrency
+        self.client_rate = client_rate
+        self.client_burst = max(client_burst, 1)
+        self.queue_size = queue_size
+        self.client_queue_size = client_queue_size
+        self.queue_timeout = queue_timeout
+        self.api_key_header = (
+            api_key_header.lower().encode() if api_key_header else None
+        )
+        self.trust_forwarded_for = trust_forwarded_for
+
+        self._clients: dict[str, _Client] = {}
+        self._queue: deque[_Waiter] = deque()
+        self._running = 0
+        self._rejected = {"rate": 0, "client_queue": 0, "queue_full": 0, "timeout": 0}
+        self._last_sweep = time.monotonic()
+
+        if metrics is not None:
+            metrics.register(
+                Gauge(
+                    "stac_api_admission_requests",
+                    "Requests admitted (running) and waiting for a slot (queued).",
+                    ("state",),
+                    self._collect_requests,
+                )
+            )
+            metrics.register(
+                Counter(
+                    "stac_api_admission_rejected_total",
+                    "Requests shed by admission control, by reason.",
+                    ("reason",),
+                    lambda: (((reason,), n) for reason, n in self._rejected.items()),
+                )
+            )
+
+    def _collect_requests(self) -> Iterable[tuple[tuple[str, ...], float]]:
+        yield ("running",), self._running
+        yield ("queued",), len(self._queue)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or route_path(scope).startswith(EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        now = time.monotonic()
+        # Before the lookup, so that the client of this request is not dropped
+        self._sweep(now)
+        client_id = self._client_id(scope)
+        client = self._clients.get(client_id)
+        if client is None:
+            client = self._clients[client_id] = _Client(
+                tokens=self.client_burst, updated=now
+            )
+
+        if self.client_rate > 0:
+            client.tokens = min(
+                self.client_burst,
+                client.tokens + (now - client.updated) * self.client_rate,
+            )
+            client.updated = now
+            if client.tokens < 1:
+                self._rejected["rate"] += 1
+                retry_after = (1 - client.tokens) / self.client_rate
+                await _reject(send, 429, "Request rate limit exceeded.", retry_after)
+                return
+            client.tokens -= 1
+        client.updated = now
+
+        if not self._can_run(client):
+            if client.queued >= self.client_queue_size:
+                self._rejected["client_queue"] += 1
+                await _reject(
+                    send, 429, "Too many concurrent requests.", self.queue_timeout
+                )
+                return
+            if len(self._queue) >= self.queue_size:
+                self._rejected["queue_full"] += 1
+                await _reject(send, 503, "Server busy.", self.queue_timeout)
+                return
+            if not await self._wait(client_id, client):
+                self._rejected["timeout"] += 1
+                await _reject(send, 503, "Server busy.", self.queue_timeout)
+                return
+        else:
+            self._running += 1
+            client.running += 1
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._release(client)
+
+    def _client_id(self, scope: Scope) -> str:
+        headers = dict(scope["headers"])
+        if self.api_key_header is not None:
+            api_key = headers.get(self.api_key_header)
+            if api_key:
+                # Keep the key itself out of memory dumps
+                return "key:" + hashlib.blake2b(api_key, digest_size=12).hexdigest()
+        if self.trust_forwarded_for and b"x-forwarded-for" in headers:
+            return "ip:" + headers[b"x-forwarded-for"].split(b",")[0].strip().decode(
+                "latin-1"
+            )
+        client = scope.get("client")
+        return "ip:" + (client[0] if client else "unknown")
+
+    def _can_run(self, client: _Client) -> bool:
+        return (
+            self._running < self.max_concurrency
+            and client.running < self.client_concurrency
+        )
+
+    async def _wait(self, client_id: str, client: _Client) -> bool:
+        """Wait for a slot, True once one was handed over."""
+        waiter = _Waiter(client_id, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        client.queued += 1
+        admitted = False
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            admitted = True
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            client.queued -= 1
+            if not admitted:
+                if waiter.future.done():
+                    # Handed a slot just as it gave up, pass it on
+                    self._release(client)
+                else:
+                    waiter.future.cancel()
+                    self._queue.remove(waiter)
+        return admitted
+
+    def _release(self, client: _Client) -> None:
+        self._running -= 1
+        client.running -= 1
+        client.updated = time.monotonic()
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Hand free slots to waiters, in order, skipping clients at their
+        concurrency limit.
+        """
+        for waiter in list(self._queue):
+            if self._running >= self.max_concurrency:
+                return
+            if waiter.future.done():
+                continue
+            client = self._clients.get(waiter.client_id)
+            if client is None or client.running >= self.client_concurrency:
+                continue
+            self._running += 1
+            client.running += 1
+            self._queue.remove(waiter)
+            waiter.future.set_result(None)
+
+    def _sweep(self, now: float) -> None:
+        if now - self._last_sweep < CLIENT_IDLE_TIMEOUT:
+            return
+        self._last_sweep = now
+        for client_id, client in list(self._clients.items()):
+            if (
+                not client.running
+                and not client.queued
+                and now - client.updated > CLIENT_IDLE_TIMEOUT
+            ):
+                del self._clients[client_id]
+
+
+async def _reject(send: Send, status: int, description: str, retry_after: float):
+    body = orjson.dumps(
+        {
+            "code": "TooManyRequests" if status == 429 else "ServiceUnavailable",
+            "description": description,
+        }
+    )
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,487 @@
+"""Aggregations of the items matching a search, computed by PostgreSQL.
+
+An implementation of the STAC API aggregation extension: `/aggregate` takes
+the filters of `/search` and the names of the aggregations to compute, and
+returns counts instead of items. Every requested aggregation is computed in
+one pass over the matching items, as one `GROUPING SETS` query: each
+frequency aggregation is a grouping set on its bucket key, and the totals
+come from the empty set.
+
+Grid aggregations count items by the WebMercator tile (`z/x/y`) or geohash
+cell containing the center of their bbox. Results are cached per filter and
+aggregation parameters until a transaction touches one of the collections
+searched, or for at most the TTL (items ingested directly into pgstac).
+"""
+
+import logging
+from typing import Any, Dict, List, Literal, Optional, Tuple, Type
+from urllib.parse import unquote_plus
+
+import attr
+import orjson
+from fastapi import APIRouter, FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel, Field, ValidationError
+from stac_fastapi.api.models import create_request_model
+from stac_fastapi.api.routes import create_async_endpoint
+from stac_fastapi.extensions.core.aggregation import AggregationConformanceClasses
+from stac_fastapi.extensions.core.aggregation.request import (
+    AggregationExtensionGetRequest,
+)
+from stac_fastapi.types.errors import InvalidQueryParameter, NotFoundError
+from stac_fastapi.types.extension import ApiExtension
+from stac_fastapi.types.requests import get_base_url
+from stac_fastapi.types.search import APIRequest
+from starlette.responses import Response
+from typing_extensions import Annotated
+
+from stac_fastapi.pgstac.types.search import PgstacSearch
+
+from app.cache import ALL_COLLECTIONS, CacheBackend, CachedResponse
+from app.core import CoreCrudClient
+from app.viewport import MAX_LATITUDE
+
+logger = logging.getLogger(__name__)
+
+ROUTE = "aggregate"
+
+Interval = Literal["year", "quarter", "month", "week", "day", "hour"]
+
+DEFAULT_AGGREGATIONS = ["total_count", "datetime_min", "datetime_max"]
+DEFAULT_INTERVAL = "month"
+DEFAULT_GEOTILE_PRECISION = 4
+DEFAULT_GEOHASH_PRECISION = 3
+MAX_GEOHASH_PRECISION = 12
+
+# Search parameters the aggregations are filtered with
+FILTER_KEYS = {
+    "collections",
+    "ids",
+    "bbox",
+    "intersects",
+    "datetime",
+    "filter_expr",
+    "filter_crs",
+    "filter_lang",
+    "query",
+}
+
+WHERE_SQL = "SELECT stac_search_to_where($1::text::jsonb);"
+
+EXISTS_SQL = "SELECT EXISTS (SELECT 1 FROM collections WHERE id = $1);"
+
+# Center of the item bbox
+CENTER_X = "(ST_XMin(geometry) + ST_XMax(geometry)) / 2"
+CENTER_Y = "(ST_YMin(geometry) + ST_YMax(geometry)) / 2"
+
+# Data types of the totals
+TOTALS = {
+    "total_count": "integer",
+    "datetime_min": "datetime",
+    "datetime_max": "datetime",
+}
+
+# Bucket key data types of the frequency aggregations
+FREQUENCIES = {
+    "collection_frequency": "string",
+    "datetime_frequency": "datetime",
+    "grid_geotile_frequency": "string",
+    "grid_geohash_frequency": "string",
+    "gsd_frequency": "string",
+    "platform_frequency": "string",
+    "platform_type_frequency": "string",
+}
+
+AGGREGATIONS = [*TOTALS, *FREQUENCIES]
+
+# Item properties counted by the term aggregations
+TERMS = {
+    "gsd_frequency": "gsd",
+    "platform_frequency": "platform",
+    "platform_type_frequency": "oam:platform_type",
+}
+
+
+@attr.s
+class AggregationParamsGetRequest(APIRequest):
+    """Parameters of the frequency aggregations, for GET requests."""
+
+    datetime_frequency_interval: Annotated[
+        Optional[Interval],
+        Query(description="Bucket size of `datetime_frequency` (default month)."),
+    ] = attr.ib(default=None)
+    grid_geotile_frequency_precision: Annotated[
+        Optional[int],
+        Query(ge=0, description="Zoom level of `grid_geotile_frequency`."),
+    ] = attr.ib(default=None)
+    grid_geohash_frequency_precision: Annotated[
+        Optional[int],
+        Query(
+            ge=1,
+            le=MAX_GEOHASH_PRECISION,
+            description="Geohash length of `grid_geohash_frequency`.",
+        ),
+    ] = attr.ib(default=None)
+
+
+class AggregationPostRequest(BaseModel):
+    """Aggregations and their parameters, for POST requests."""
+
+    aggregations: Optional[List[str]] = Field(
+        None, description="A list of aggregations to compute and return."
+    )
+    datetime_frequency_interval: Optional[Interval] = Field(
+        None, description="Bucket size of `datetime_frequency` (default month)."
+    )
+    grid_geotile_frequency_precision: Optional[int] = Field(
+        None, ge=0, description="Zoom level of `grid_geotile_frequency`."
+    )
+    grid_geohash_frequency_precision: Optional[int] = Field(
+        None,
+        ge=1,
+        le=MAX_GEOHASH_PRECISION,
+        description="Geohash length of `grid_geohash_frequency`.",
+    )
+
+
+def bucket_key(name: str, interval: str, zoom: int, precision: int) -> str:
+    """SQL expression of the bucket key of a frequency aggregation.
+
+    The parameters are validated, so they are inlined.
+    """
+    if name == "collection_frequency":
+        return "collection"
+    if name == "datetime_frequency":
+        return (
+            f"to_char(date_trunc('{interval}', datetime AT TIME ZONE 'UTC'), "
+            '\'YYYY-MM-DD"T"HH24:MI:SS"Z"\')'
+        )
+    if name == "grid_geotile_frequency":
+        n = 2**zoom
+        lat = f"radians(least({MAX_LATITUDE}, greatest(-{MAX_LATITUDE}, {CENTER_Y})))"
+        x = f"floor(({CENTER_X} + 180) / 360 * {n})"
+        y = f"floor((1 - asinh(tan({lat})) / pi()) / 2 * {n})"
+        return (
+            f"concat_ws('/', {zoom}, "
+            f"least({n - 1}, greatest(0, {x}))::int, "
+            f"least({n - 1}, greatest(0, {y}))::int)"
+        )
+    if name == "grid_geohash_frequency":
+        return (
+            f"ST_GeoHash(ST_SetSRID(ST_MakePoint({CENTER_X}, {CENTER_Y}), 4326), "
+            f"{precision})"
+        )
+    return f"content->'properties'->>'{TERMS[name]}'"
+
+
+def aggregate_query(where: str, keys: List[str]) -> str:
+    """SQL computing the totals and the frequency of every bucket key, in one
+    pass over the items matching `where`.
+
+    Rows of bucket key `i` have `g{i}` = 0, the totals row has them all at 1.
+    """
+    columns = [f"{key} AS k{i}" for i, key in enumerate(keys)]
+    selected = [
+        *(f"GROUPING(k{i}) AS g{i}, k{i}" for i in range(len(keys))),
+        "count(*) AS frequency",
+        "min(datetime) AS datetime_min",
+        "max(datetime) AS datetime_max",
+    ]
+    query = (
+        f"SELECT {', '.join(selected)}\n"
+        f"FROM (SELECT {', '.join([*columns, 'datetime'])} FROM items WHERE {where})"
+        " AS matched"
+    )
+    if keys:
+        sets = ", ".join(["()", *(f"(k{i})" for i in range(len(keys)))])
+        query += f"\nGROUP BY GROUPING SETS ({sets})"
+    return query + ";"
+
+
+def _rfc3339(value: Any) -> Optional[str]:
+    return value.isoformat().replace("+00:00", "Z") if value is not None else None
+
+
+@attr.s
+class AggregationExtension(ApiExtension):
+    """Aggregation extension.
+
+    Adds `GET/POST /aggregate` and `/collections/{collection_id}/aggregate`,
+    the aggregations of the items matching a search, and `/aggregations` and
+    `/collections/{collection_id}/aggregations`, the aggregations available.
+    `extensions` are the search extensions whose filters apply (query,
+    filter).
+    """
+
+    client: CoreCrudClient = attr.ib()
+    cache: CacheBackend = attr.ib()
+    extensions: List[ApiExtension] = attr.ib(factory=list)
+    ttl: float = attr.ib(default=300)
+    max_zoom: int = attr.ib(default=12)
+    max_buckets: int = attr.ib(default=10000)
+    conformance_classes: List[str] = attr.ib(
+        factory=lambda: [AggregationConformanceClasses.AGGREGATION]
+    )
+    schema_href: Optional[str] = attr.ib(default=None)
+
+    def __attrs_post_init__(self) -> None:
+        self.GET = create_request_model(
+            "AggregateGetRequest",
+            base_model=AggregationExtensionGetRequest,
+            extensions=self.extensions,
+            mixins=[AggregationParamsGetRequest],
+            request_type="GET",
+        )
+        self.POST: Type[PgstacSearch] = create_request_model(
+            "AggregatePostRequest",
+            base_model=PgstacSearch,
+            extensions=self.extensions,
+            mixins=[AggregationPostRequest],
+            request_type="POST",
+        )
+
+    async def get_aggregations(self, request: Request) -> Response:
+        """The aggregations available, over all items or a collection's."""
+        await self._check_collection(request)
+        aggregations = [
+            *({"name": name, "data_type": t} for name, t in TOTALS.items()),
+            *(
+                {"name": name, "data_type": "frequency_distribution"}
+                for name in FREQUENCIES
+            ),
+        ]
+        return self._response(request, orjson.dumps(aggregations))
+
+    async def get_aggregate(
+        self,
+        request: Request,
+        aggregations: Optional[List[str]] = None,
+        collections: Optional[List[str]] = None,
+        ids: Optional[List[str]] = None,
+        bbox: Optional[List[float]] = None,
+        intersects: Optional[str] = None,
+        datetime: Optional[str] = None,
+        query: Optional[str] = None,
+        filter_expr: Optional[str] = None,
+        filter_lang: Optional[str] = None,
+        datetime_frequency_interval: Optional[str] = None,
+        grid_geotile_frequency_precision: Optional[int] = None,
+        grid_geohash_frequency_precision: Optional[int] = None,
+        **kwargs: Any,
+    ) -> Response:
+        """Aggregate the items matching a search (GET).
+
+        Called with `GET /aggregate` and
+        `GET /collections/{collection_id}/aggregate`.
+        """
+        base_args = {
+            "collections": collections,
+            "ids": ids,
+            "bbox": bbox,
+            "query": orjson.loads(unquote_plus(query)) if query else query,
+            "aggregations": aggregations,
+            "datetime_frequency_interval": datetime_frequency_interval,
+            "grid_geotile_frequency_precision": grid_geotile_frequency_precision,
+            "grid_geohash_frequency_precision": grid_geohash_frequency_precision,
+        }
+        clean = self.client._clean_search_args(
+            base_args=base_args,
+            intersects=intersects,
+            datetime=datetime,
+            filter_query=filter_expr,
+            filter_lang=filter_lang,
+        )
+        try:
+            search_request = self.POST(**clean)
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid parameters provided {e}"
+            ) from e
+        return await self.post_aggregate(search_request, request)
+
+    async def post_aggregate(
+        self, search_request: PgstacSearch, request: Request, **kwargs: Any
+    ) -> Response:
+        """Aggregate the items matching a search (POST).
+
+        Called with `POST /aggregate` and
+        `POST /collections/{collection_id}/aggregate`.
+        """
+        params: Dict[str, Any] = search_request.model_dump()
+        names = params.get("aggregations") or DEFAULT_AGGREGATIONS
+        unknown = [name for name in names if name not in AGGREGATIONS]
+        if unknown:
+            raise InvalidQueryParameter(
+                f"Unknown aggregations: {', '.join(unknown)}. "
+                f"Available: {', '.join(AGGREGATIONS)}."
+            )
+        interval = params.get("datetime_frequency_interval") or DEFAULT_INTERVAL
+        zoom = params.get("grid_geotile_frequency_precision")
+        zoom = DEFAULT_GEOTILE_PRECISION if zoom is None else zoom
+        if zoom > self.max_zoom:
+            raise InvalidQueryParameter(
+                f"grid_geotile_frequency_precision must be at most {self.max_zoom}."
+            )
+        precision = (
+            params.get("grid_geohash_frequency_precision") or DEFAULT_GEOHASH_PRECISION
+        )
+
+        search = orjson.loads(
+            search_request.model_dump_json(
+                exclude_none=True, by_alias=True, include=FILTER_KEYS
+            )
+        )
+        collection_id = request.path_params.get("collection_id")
+        if collection_id is not None:
+            search["collections"] = [collection_id]
+
+        frequencies = [name for name in dict.fromkeys(names) if name in FREQUENCIES]
+        key = {
+            "search": search,
+            "aggregations": sorted(set(names)),
+            "interval": interval if "datetime_frequency" in names else None,
+            "zoom": zoom if "grid_geotile_frequency" in names else None,
+            "precision": precision if "grid_geohash_frequency" in names else None,
+        }
+        cache_key = f"{ROUTE}:{orjson.dumps(key, option=orjson.OPT_SORT_KEYS).decode()}"
+        # As the response cache, fail open: a backend error is a miss
+        cached: Optional[CachedResponse] = None
+        generation: Optional[int] = None
+        try:
+            cached = await self.cache.get(cache_key)
+            if cached is None:
+                generation = await self.cache.generation()
+        except Exception:
+            logger.warning("Response cache read failed", exc_info=True)
+        self.cache.record(ROUTE, cached is not None)
+        if cached is not None:
+            return self._response(request, cached.body)
+
+        await self._check_collection(request)
+        async with request.app.state.get_connection(request, "r") as conn:
+            where = await conn.fetchval(WHERE_SQL, orjson.dumps(search).decode())
+            rows = await conn.fetch(
+                aggregate_query(
+                    where,
+                    [
+                        bucket_key(name, interval, zoom, precision)
+                        for name in frequencies
+                    ],
+                )
+            )
+
+        body = orjson.dumps(self._aggregations(names, frequencies, rows))
+        if generation is not None:
+            collections = frozenset(search.get("collections") or (ALL_COLLECTIONS,))
+            try:
+                await self.cache.set(
+                    cache_key,
+                    CachedResponse(200, [], body, collections),
+                    self.ttl,
+                    generation,
+                )
+            except Exception:
+                logger.warning("Response cache write failed", exc_info=True)
+        return self._response(request, body)
+
+    def _aggregations(
+        self, names: List[str], frequencies: List[str], rows: List[Any]
+    ) -> List[Dict[str, Any]]:
+        """Aggregations, in the requested order, from the rows of
+        `aggregate_query`.
+        """
+        totals = next(
+            row for row in rows if all(row[f"g{i}"] for i in range(len(frequencies)))
+        )
+        buckets: Dict[str, List[Tuple[str, int]]] = {name: [] for name in frequencies}
+        for row in rows:
+            for i, name in enumerate(frequencies):
+                # Items without a value are not counted in any bucket
+                if not row[f"g{i}"] and row[f"k{i}"] is not None:
+                    buckets[name].append((str(row[f"k{i}"]), row["frequency"]))
+
+        aggregations = []
+        for name in dict.fromkeys(names):
+            if name == "total_count":
+                aggregations.append(
+                    {"name": name, "data_type": "integer", "value": totals["frequency"]}
+                )
+            elif name in TOTALS:
+                aggregations.append(
+                    {
+                        "name": name,
+                        "data_type": "datetime",
+                        "value": _rfc3339(totals[name]),
+                    }
+                )
+            else:
+                aggregations.append(self._frequency(name, buckets[name]))
+        return aggregations
+
+    def _frequency(self, name: str, buckets: List[Tuple[str, int]]) -> Dict[str, Any]:
+        """A frequency distribution, with at most `max_buckets` buckets (the
+        most frequent) and the items in the others as `overflow`.
+        """
+        buckets.sort(key=lambda bucket: (-bucket[1], bucket[0]))
+        kept, dropped = buckets[: self.max_buckets], buckets[self.max_buckets :]
+        if name == "datetime_frequency":
+            kept.sort()
+        data_type = FREQUENCIES[name]
+        return {
+            "name": name,
+            "data_type": "frequency_distribution",
+            "overflow": sum(frequency for _, frequency in dropped),
+            "buckets": [
+                {"key": key, "data_type": data_type, "frequency": frequency}
+                for key, frequency in kept
+            ],
+        }
+
+    async def _check_collection(self, request: Request) -> None:
+        collection_id = request.path_params.get("collection_id")
+        if collection_id is None:
+            return
+        async with request.app.state.get_connection(request, "r") as conn:
+            if not await conn.fetchval(EXISTS_SQL, collection_id):
+                raise NotFoundError(f"Collection {collection_id} does not exist.")
+
+    def _response(self, request: Request, aggregations: bytes) -> Response:
+        """An AggregationCollection, around serialized `aggregations`."""
+        links = [
+            {"rel": "root", "type": "application/json", "href": get_base_url(request)},
+            {"rel": "self", "type": "application/json", "href": str(request.url)},
+        ]
+        body = (
+            b'{"type":"AggregationCollection","aggregations":'
+            + aggregations
+            + b',"links":'
+            + orjson.dumps(links)
+            + b"}"
+        )
+        return Response(body, media_type="application/json")
+
+    def register(self, app: FastAPI) -> None:
+        """Register the extension with a FastAPI application."""
+        router = APIRouter(prefix=app.state.router_prefix)
+        for prefix, name in (
+            ("", "Aggregate"),
+            ("/collections/{collection_id}", "Collection Aggregate"),
+        ):
+            router.add_api_route(
+                name=f"{name} Available",
+                path=f"{prefix}/aggregations",
+                methods=["GET"],
+                endpoint=self.get_aggregations,
+            )
+            router.add_api_route(
+                name=name,
+                path=f"{prefix}/aggregate",
+                methods=["GET"],
+                endpoint=create_async_endpoint(self.get_aggregate, self.GET),
+            )
+            router.add_api_route(
+                name=name,
+                path=f"{prefix}/aggregate",
+                methods=["POST"],
+                endpoint=create_async_endpoint(self.post_aggregate, self.POST),
+            )
+        app.include_router(router, tags=["Aggregation Extension"])
@@ -0,0 +1,358 @@
+"""Response cache for the read-heavy STAC endpoints.
+
+Responses are stored as the serialized ORJSON bytes produced by the app, keyed
+on the normalized request (method, base URL, path, sorted query string and
+canonical JSON body). Each entry is tagged with the collections it was built
+from, so that transactions can drop exactly the entries they make stale.
+Requests that are not scoped to any collection (e.g. `/collections`, or a
+`/search` without a `collections` filter) are tagged with `ALL_COLLECTIONS`,
+and are dropped on every write.
+
+The cache fails open: errors of the backend are logged, reads run as misses
+against the app, and their responses are not stored.
+"""
+
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode
+
+import orjson
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.routes import match_route, route_path
+
+logger = logging.getLogger(__name__)
+
+ALL_COLLECTIONS = "*"
+
+
+@dataclass
+class CachedResponse:
+    """A fully buffered response, ready to be replayed."""
+
+    status: int
+    headers: list[tuple[bytes, bytes]]
+    body: bytes
+    collections: frozenset[str] = field(default_factory=frozenset)
+    expires: float = 0.0  # unix timestamp, so it is meaningful across processes
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+
+class CacheBackend:
+    """Storage interface for the response cache.
+
+    Implementations must be safe to share between the workers they are used
+    from: the in-memory backend is per-process, the others are shared by
+    every worker on the host (or beyond, for a Redis-compatible server).
+    Hit/miss counters are kept per route name.
+    """
+
+    def __init__(self) -> None:
+        self._counters: dict[str, list[int]] = {}
+
+    async def generation(self) -> int:
+        """Counter bumped on every invalidation.
+
+        A read captures it before running the query, and `set` drops the
+        response if it changed since, so a write never leaves a stale read
+        behind.
+        """
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        raise NotImplementedError
+
+    async def set(
+        self, key: str, entry: CachedResponse, ttl: float, generation: int
+    ) -> None:
+        raise NotImplementedError
+
+    async def invalidate(self, collection_id: Optional[str] = None) -> None:
+        """Drop entries built from `collection_id`, or everything if None."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    def record(self, route: str, hit: bool) -> None:
+        """Count a hit or miss for `route`."""
+        counter = self._counters.setdefault(route, [0, 0])
+        counter[0 if hit else 1] += 1
+
+    async def stats(self) -> dict[str, dict[str, int]]:
+        """Hit/miss counters per route."""
+        return {
+            route: {"hits": hits, "misses": misses}
+            for route, (hits, misses) in self._counters.items()
+        }
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU cache with per-entry TTL and a total size bound.
+
+    NOTE this cache is per-process, so with several uvicorn workers a write
+    only invalidates the worker that handled it; the other workers serve the
+    old entry until its TTL expires. Use a shared backend in that case.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._by_collection: dict[str, set[str]] = {}
+        self._size = 0
+        self._generation = 0
+
+    async def generation(self) -> int:
+        return self._generation
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def set(
+        self, key: str, entry: CachedResponse, ttl: float, generation: int
+    ) -> None:
+        if generation != self._generation or entry.size > self.max_entry_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        entry.expires = time.time() + ttl
+        self._entries[key] = entry
+        self._size += entry.size
+        for collection_id in entry.collections:
+            self._by_collection.setdefault(collection_id, set()).add(key)
+
+        while self._size > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    async def invalidate(self, collection_id: Optional[str] = None) -> None:
+        self._generation += 1
+        if collection_id is None:
+            self._entries.clear()
+            self._by_collection.clear()
+            self._size = 0
+            return
+
+        for tag in (collection_id, ALL_COLLECTIONS):
+            for key in list(self._by_collection.get(tag, ())):
+                self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        for collection_id in entry.collections:
+            keys = self._by_collection.get(collection_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_collection[collection_id]
+
+
+async def invalidate_collection(request: Request, collection_id: Optional[str]) -> None:
+    """Invalidate cached responses after a write to `collection_id`.
+
+    Other caches derived from the collection register a coroutine function
+    taking the collection id in `app.state.invalidation_listeners`.
+    """
+    cache: Optional[CacheBackend] = getattr(request.app.state, "response_cache", None)
+    if cache is not None:
+        try:
+            await cache.invalidate(collection_id)
+        except Exception:
+            logger.error("Response cache invalidation failed", exc_info=True)
+    for listener in getattr(request.app.state, "invalidation_listeners", ()):
+        await listener(collection_id)
+
+
+def _split_collections(value: Optional[str]) -> frozenset[str]:
+    if not value:
+        return frozenset({ALL_COLLECTIONS})
+    return frozenset(c.strip() for c in value.split(",") if c.strip())
+
+
+class ResponseCacheMiddleware:
+    """ASGI middleware serving repeated reads from a `CacheBackend`.
+
+    It must sit inside the compression middleware, so that the cache holds the
+    uncompressed JSON bytes, and inside `ProxyHeaderMiddleware`, so that the
+    forwarded host (which ends up in the response links) is part of the key.
+    """
+
+    def __init__(
+        self, app: ASGIApp, cache: CacheBackend, ttls: dict[str, float]
+    ) -> None:
+        """`ttls` maps route names (see `app.routes`) to a TTL in seconds."""
+        self.app = app
+        self.cache = cache
+        self.ttls = ttls
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        path = route_path(scope)
+        route = match_route(method, path)
+        ttl = self.ttls.get(route[0], 0) if route else 0
+        if not route or ttl <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        route_name, collection_id = route
+        query = sorted(
+            parse_qsl(scope.get("query_string", b"").decode("latin-1"), True),
+            key=lambda kv: kv[0],
+        )
+
+        body = b""
+        if method == "POST":
+            body = await _read_body(receive)
+            receive = _replay_body(body, receive)
+            try:
+                payload = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                await self.app(scope, receive, send)
+                return
+            body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+            collections = (
+                payload.get("collections") if isinstance(payload, dict) else None
+            )
+            tags = (
+                frozenset(str(c) for c in collections)
+                if collections and isinstance(collections, list)
+                else frozenset({ALL_COLLECTIONS})
+            )
+        elif collection_id is not None:
+            tags = frozenset({collection_id})
+        else:
+            tags = _split_collections(dict(query).get("collections"))
+
+        headers = dict(scope["headers"])
+        key = _make_key(
+            method,
+            scope.get("scheme", "http"),
+            headers.get(b"host", b"").decode("latin-1"),
+            scope.get("root_path", ""),
+            path,
+            urlencode(query),
+            body,
+        )
+
+        cached: Optional[CachedResponse] = None
+        generation: Optional[int] = None
+        try:
+            cached = await self.cache.get(key)
+            if cached is None:
+                generation = await self.cache.generation()
+        except Exception:
+            logger.warning("Response cache read failed", exc_info=True)
+        self.cache.record(route_name, cached is not None)
+        if cached is not None:
+            await _send_cached(send, cached, b"HIT")
+            return
+
+        start: Optional[Message] = None
+        chunks: list[bytes] = []
+        cacheable = generation is not None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start, cacheable
+            if message["type"] == "http.response.start":
+                start = message
+                cacheable = (
+                    cacheable
+                    and message["status"] == 200
+                    and not any(
+                        k == b"set-cookie"
+                        or (k == b"cache-control" and b"no-store" in v)
+                        for k, v in message.get("headers", [])
+                    )
+                )
+                message.setdefault("headers", []).append((b"x-cache", b"MISS"))
+            elif message["type"] == "http.response.body" and cacheable:
+                chunks.append(message.get("body", b""))
+                if (
+                    not message.get("more_body", False)
+                    and start is not None
+                    and generation is not None
+                ):
+                    entry = CachedResponse(
+                        status=start["status"],
+                        headers=[
+                            (k, v) for k, v in start["headers"] if k != b"x-cache"
+                        ],
+                        body=b"".join(chunks),
+                        collections=tags,
+                    )
+                    try:
+                        await self.cache.set(key, entry, ttl=ttl, generation=generation)
+                    except Exception:
+                        logger.warning("Response cache write failed", exc_info=True)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _make_key(*parts: object) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+async def _read_body(receive: Receive) -> bytes:
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+def _replay_body(body: bytes, receive: Receive) -> Receive:
+    """Hand the already consumed request body to the app, then defer to the server."""
+    sent = False
+
+    async def replay() -> Message:
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replay
+
+
+async def _send_cached(send: Send, cached: CachedResponse, x_cache: bytes) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": cached.status,
+            "headers": [*cached.headers, (b"x-cache", x_cache)],
+        }
+    )
+    await send({"type": "http.response.body", "body": cached.body})
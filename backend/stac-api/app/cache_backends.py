@@ -0,0 +1,434 @@
+"""Response cache backends shared between uvicorn workers.
+
+`WEB_CONCURRENCY` workers each hold their own copy of a `MemoryCacheBackend`,
+which splits the hit rate between them. The backends here live outside the
+worker processes, so every worker spawned from `app.main:app` shares them:
+
+- `SQLiteCacheBackend`: a local SQLite file (point it at `/dev/shm` to keep it
+  in shared memory), bounded by size with LRU eviction.
+- `RedisCacheBackend`: any Redis-compatible server (Redis, Valkey, KeyDB...),
+  e.g. a sidecar in the same pod. Size and eviction are delegated to the
+  server's `maxmemory` and `maxmemory-policy` (use `allkeys-lru`).
+
+Other backends can be plugged in with `RESPONSE_CACHE_BACKEND=module:Class`,
+where the class subclasses `CacheBackend` and is built with the settings.
+"""
+
+import importlib
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional, TypeVar
+
+import orjson
+from starlette.concurrency import run_in_threadpool
+
+from app.cache import (
+    ALL_COLLECTIONS,
+    CacheBackend,
+    CachedResponse,
+    MemoryCacheBackend,
+)
+from app.settings import Settings
+
+T = TypeVar("T")
+
+# Local hit/miss counters are written to the shared store at most this often
+STATS_FLUSH_INTERVAL = 1.0
+
+
+def encode_entry(entry: CachedResponse) -> bytes:
+    """Serialize an entry as a JSON header line followed by the raw body."""
+    head = orjson.dumps(
+        {
+            "status": entry.status,
+            "headers": [
+                [k.decode("latin-1"), v.decode("latin-1")] for k, v in entry.headers
+            ],
+            "expires": entry.expires,
+        }
+    )
+    return head + b"\n" + entry.body
+
+
+def decode_entry(data: bytes) -> CachedResponse:
+    head, _, body = data.partition(b"\n")
+    meta = orjson.loads(head)
+    return CachedResponse(
+        status=meta["status"],
+        headers=[
+            (k.encode("latin-1"), v.encode("latin-1")) for k, v in meta["headers"]
+        ],
+        body=body,
+        expires=meta["expires"],
+    )
+
+
+@contextmanager
+def _immediate(conn: sqlite3.Connection) -> Iterator[None]:
+    """Write transaction, taking the database lock up front."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Response cache in a SQLite database shared by all local workers.
+
+    The database is only a cache, so it runs with WAL and `synchronous=OFF`.
+    Queries run in the threadpool to keep lock waits off the event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+        CREATE TABLE IF NOT EXISTS tags (
+            collection TEXT NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (collection, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS tags_key ON tags (key);
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        INSERT OR IGNORE INTO meta VALUES ('generation', 0), ('size', 0);
+        CREATE TABLE IF NOT EXISTS stats (
+            route TEXT PRIMARY KEY,
+            hits INTEGER NOT NULL,
+            misses INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+            UPDATE meta SET value = value + NEW.size WHERE name = 'size';
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+            UPDATE meta SET value = value - OLD.size WHERE name = 'size';
+            DELETE FROM tags WHERE key = OLD.key;
+        END;
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_entry_bytes: int):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._lock = threading.Lock()
+        self._pending: dict[str, list[int]] = {}
+        self._last_flush = time.monotonic()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = OFF")
+        self._conn.executescript(self.SCHEMA)
+
+    async def _run(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        def locked() -> T:
+            with self._lock:
+                return func(self._conn)
+
+        return await run_in_threadpool(locked)
+
+    async def generation(self) -> int:
+        return await self._run(self._get_generation)
+
+    @staticmethod
+    def _get_generation(conn: sqlite3.Connection) -> int:
+        return conn.execute(
+            "SELECT value FROM meta WHERE name = 'generation'"
+        ).fetchone()[0]
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        flush = self._take_pending()
+
+        def get(conn: sqlite3.Connection) -> Optional[bytes]:
+            if flush:
+                self._flush_stats(conn, flush)
+            row = conn.execute(
+                "SELECT data, expires, accessed FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            data, expires, accessed = row
+            if expires <= now:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            # Coarse LRU clock, to avoid a write on every single hit
+            if accessed < now - 1:
+                conn.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+                )
+            return data
+
+        data = await self._run(get)
+        return decode_entry(data) if data is not None else None
+
+    async def set(
+        self, key: str, entry: CachedResponse, ttl: float, generation: int
+    ) -> None:
+        now = time.time()
+        entry.expires = now + ttl
+        data = encode_entry(entry)
+        if len(data) > self.max_entry_bytes:
+            return
+
+        def set(conn: sqlite3.Connection) -> None:
+            with _immediate(conn):
+                if self._get_generation(conn) != generation:
+                    return
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                conn.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                    (key, data, len(data), entry.expires, now),
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO tags VALUES (?, ?)",
+                    [(collection_id, key) for collection_id in entry.collections],
+                )
+                self._evict(conn, key, now)
+
+        await self._run(set)
+
+    def _evict(self, conn: sqlite3.Connection, keep: str, now: float) -> None:
+        def size() -> int:
+            return conn.execute(
+                "SELECT value FROM meta WHERE name = 'size'"
+            ).fetchone()[0]
+
+        if size() <= self.max_bytes:
+            return
+        conn.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+        while size() > self.max_bytes:
+            deleted = conn.execute(
+                """
+                DELETE FROM entries WHERE key = (
+                    SELECT key FROM entries WHERE key != ? ORDER BY accessed LIMIT 1
+                )
+                """,
+                (keep,),
+            ).rowcount
+            if not deleted:
+                break
+
+    async def invalidate(self, collection_id: Optional[str] = None) -> None:
+        def invalidate(conn: sqlite3.Connection) -> None:
+            with _immediate(conn):
+                conn.execute(
+                    "UPDATE meta SET value = value + 1 WHERE name = 'generation'"
+                )
+                if collection_id is None:
+                    conn.execute("DELETE FROM entries")
+                else:
+                    conn.execute(
+                        """
+                        DELETE FROM entries WHERE key IN (
+                            SELECT key FROM tags WHERE collection IN (?, ?)
+                        )
+                        """,
+                        (collection_id, ALL_COLLECTIONS),
+                    )
+
+        await self._run(invalidate)
+
+    def record(self, route: str, hit: bool) -> None:
+        super().record(route, hit)
+        counter = self._pending.setdefault(route, [0, 0])
+        counter[0 if hit else 1] += 1
+
+    def _take_pending(self, force: bool = False) -> dict[str, list[int]]:
+        if not self._pending or (
+            not force and time.monotonic() - self._last_flush < STATS_FLUSH_INTERVAL
+        ):
+            return {}
+        pending, self._pending = self._pending, {}
+        self._last_flush = time.monotonic()
+        return pending
+
+    @staticmethod
+    def _flush_stats(conn: sqlite3.Connection, pending: dict[str, list[int]]) -> None:
+        conn.executemany(
+            """
+            INSERT INTO stats VALUES (?, ?, ?)
+            ON CONFLICT (route) DO UPDATE SET
+                hits = hits + excluded.hits, misses = misses + excluded.misses
+            """,
+            [(route, hits, misses) for route, (hits, misses) in pending.items()],
+        )
+
+    async def stats(self) -> dict[str, dict[str, int]]:
+        pending = self._take_pending(force=True)
+
+        def stats(conn: sqlite3.Connection) -> list[tuple[str, int, int]]:
+            if pending:
+                self._flush_stats(conn, pending)
+            return conn.execute("SELECT route, hits, misses FROM stats").fetchall()
+
+        rows = await self._run(stats)
+        return {route: {"hits": hits, "misses": misses} for route, hits, misses in rows}
+
+    async def close(self) -> None:
+        pending = self._take_pending(force=True)
+        if pending:
+            await self._run(lambda conn: self._flush_stats(conn, pending))
+        self._conn.close()
+
+
+class RedisCacheBackend(CacheBackend):
+    """Response cache on a Redis-compatible server.
+
+    Requires the `redis` package to be installed alongside the app, and
+    a server supporting `PEXPIRE ... GT|NX` (Redis >= 7 or equivalent).
+    """
+
+    def __init__(self, url: str, max_entry_bytes: int, prefix: str = "stac-api:cache:"):
+        super().__init__()
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError(
+                "redis must be installed in order to use the redis cache backend"
+            ) from e
+
+        self._redis = redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self.max_entry_bytes = max_entry_bytes
+        self.prefix = prefix
+        self._pending: dict[str, list[int]] = {}
+        self._last_flush = time.monotonic()
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    async def generation(self) -> int:
+        return int(await self._redis.get(self._key("generation")) or 0)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        if (
+            self._pending
+            and time.monotonic() - self._last_flush >= STATS_FLUSH_INTERVAL
+        ):
+            await self._flush_stats()
+        data = await self._redis.get(self._key("entry", key))
+        return decode_entry(data) if data is not None else None
+
+    async def set(
+        self, key: str, entry: CachedResponse, ttl: float, generation: int
+    ) -> None:
+        entry.expires = time.time() + ttl
+        data = encode_entry(entry)
+        if len(data) > self.max_entry_bytes:
+            return
+
+        entry_key = self._key("entry", key)
+        ttl_ms = max(1, int(ttl * 1000))
+        async with self._redis.pipeline() as pipe:
+            try:
+                await pipe.watch(self._key("generation"))
+                if int(await pipe.get(self._key("generation")) or 0) != generation:
+                    return
+                pipe.multi()
+                pipe.set(entry_key, data, px=ttl_ms)
+                for collection_id in entry.collections:
+                    tag_key = self._key("tag", collection_id)
+                    pipe.sadd(tag_key, entry_key)
+                    pipe.pexpire(tag_key, ttl_ms, gt=True)
+                    pipe.pexpire(tag_key, ttl_ms, nx=True)
+                await pipe.execute()
+            except self._watch_error:
+                # An invalidation raced with this response, so drop it
+                pass
+
+    async def invalidate(self, collection_id: Optional[str] = None) -> None:
+        await self._redis.incr(self._key("generation"))
+        if collection_id is None:
+            pattern = self._key("*")
+            keys = [
+                k
+                async for k in self._redis.scan_iter(match=pattern)
+                if k != self._key("generation").encode()
+                and not k.startswith(self._key("stats").encode())
+            ]
+        else:
+            tag_keys = [
+                self._key("tag", collection_id),
+                self._key("tag", ALL_COLLECTIONS),
+            ]
+            keys = [*await self._redis.sunion(tag_keys), *tag_keys]
+        if keys:
+            await self._redis.delete(*keys)
+
+    def record(self, route: str, hit: bool) -> None:
+        super().record(route, hit)
+        counter = self._pending.setdefault(route, [0, 0])
+        counter[0 if hit else 1] += 1
+
+    async def _flush_stats(self) -> None:
+        pending, self._pending = self._pending, {}
+        self._last_flush = time.monotonic()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for route, (hits, misses) in pending.items():
+                pipe.hincrby(self._key("stats", route), "hits", hits)
+                pipe.hincrby(self._key("stats", route), "misses", misses)
+            await pipe.execute()
+
+    async def stats(self) -> dict[str, dict[str, int]]:
+        if self._pending:
+            await self._flush_stats()
+        stats = {}
+        prefix = self._key("stats", "")
+        async for key in self._redis.scan_iter(match=prefix + "*"):
+            counters = await self._redis.hgetall(key)
+            stats[key.decode()[len(prefix) :]] = {
+                "hits": int(counters.get(b"hits", 0)),
+                "misses": int(counters.get(b"misses", 0)),
+            }
+        return stats
+
+    async def close(self) -> None:
+        if self._pending:
+            await self._flush_stats()
+        await self._redis.aclose()
+
+
+def create_cache_backend(settings: Settings) -> CacheBackend:
+    """Build the response cache backend selected by `RESPONSE_CACHE_BACKEND`."""
+    backend = settings.response_cache_backend
+
+    if backend == "memory":
+        return MemoryCacheBackend(
+            max_bytes=settings.response_cache_max_bytes,
+            max_entry_bytes=settings.response_cache_max_entry_bytes,
+        )
+
+    if backend == "sqlite":
+        return SQLiteCacheBackend(
+            path=settings.response_cache_url
+            or str(Path(tempfile.gettempdir()) / "stac-api-response-cache.sqlite3"),
+            max_bytes=settings.response_cache_max_bytes,
+            max_entry_bytes=settings.response_cache_max_entry_bytes,
+        )
+
+    if backend == "redis":
+        return RedisCacheBackend(
+            url=settings.response_cache_url or "redis://localhost:6379/0",
+            max_entry_bytes=settings.response_cache_max_entry_bytes,
+        )
+
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown response cache backend: {backend}")
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+    return backend_class(settings)
@@ -0,0 +1,615 @@
+"""In-memory index of the collections, answering collection search.
+
+There are at most a few hundred collections, so every worker keeps all of
+them in memory, with their spatial and temporal extents as arrays and an
+inverted index of the lexemes of their description, title and keywords. A
+`/collections` search with `bbox`, `datetime`, `q`, `sortby`, `fields` and
+a token is then answered without a query. Searches with `filter` or `query`
+still go to pgstac.
+
+The index is loaded at startup, and reloaded on the first search after a
+transaction touches a collection, or after `refresh_interval` seconds (for
+writes that bypass the API, or reach another worker). Results follow
+pgstac's: collections are matched on the envelope of their first bbox and
+their first temporal interval, and paged as by `app.collection_search`.
+
+Free text follows pgstac 0.9.2 to 0.9.6: the lexemes and positions of each
+collection are those of Postgres' `to_tsvector('english', ...)`, read at
+load, and `q` is rewritten as `q_to_tsquery()` does, then normalized as by
+`to_tsquery()` with the English Snowball stemmer and stopwords. Queries
+whose words Postgres would parse otherwise than as plain ASCII words and
+numbers (hyphens, prefixes, non-ASCII text), or that pgstac rejects, go to
+pgstac. So do all of them with another pgstac version or text search
+configuration, or when the stemmer does not stem the words of the
+collections as Postgres did.
+
+Needs `numpy` and `snowballstemmer` (2.x, the Snowball version of Postgres)
+installed alongside the API.
+"""
+
+import asyncio
+import logging
+import math
+import re
+import time
+from datetime import datetime, timezone
+from functools import cmp_to_key
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from stac_fastapi.pgstac.utils import filter_fields
+from stac_fastapi.types.errors import InvalidQueryParameter
+from starlette.requests import Request
+
+from app.collection_search import encode_token, parse_token, sort_fields
+
+logger = logging.getLogger(__name__)
+
+COLLECTIONS_SQL = "SELECT content FROM collections ORDER BY id;"
+
+# The text pgstac matches `q` against (`stac_search_to_where`), as lexemes
+# and positions
+TSVECTOR = """
+    to_tsvector('english', content->'properties'->>'description') ||
+    to_tsvector('english', coalesce(content->'properties'->>'title', '')) ||
+    to_tsvector('english', coalesce(content->'properties'->>'keywords', ''))
+"""
+LEXEMES_SQL = f"""
+SELECT id, lexeme, positions
+FROM collections_asitems, unnest({TSVECTOR}) AS t(lexeme, positions, weights);
+"""
+# The words of that text, to check the stemmer against Postgres'
+WORDS_SQL = """
+SELECT DISTINCT lower(d.token) AS word, d.lexemes[1] AS lexeme
+FROM collections_asitems, ts_debug('english', concat_ws(' ',
+    content->'properties'->>'description',
+    content->'properties'->>'title',
+    content->'properties'->>'keywords'
+)) AS d
+WHERE d.alias IN ('asciiword', 'hword_asciipart');
+"""
+TEXT_SEARCH_SQL = (
+    "SELECT get_version() AS version, "
+    "current_setting('default_text_search_config') AS config;"
+)
+# pgstac versions with the `q_to_tsquery()` of `parse_query`
+TEXT_SEARCH_VERSIONS = ("0.9.2", "0.9.3", "0.9.4", "0.9.5", "0.9.6")
+TEXT_SEARCH_CONFIG = "pg_catalog.english"
+
+# Postgres' english.stop
+STOPWORDS = frozenset(
+    """
+    i me my myself we our ours ourselves you your yours yourself yourselves he
+    him his himself she her hers herself it its itself they them their theirs
+    themselves what which who whom this that these those am is are was were be
+    been being have has had having do does did doing a an the and but if or
+    because as until while of at by for with about against between into
+    through during before after above below to from up down in out on off
+    over under again further then once here there when where why how all any
+    both each few more most other some such no nor not only own same so than
+    too very s t can will just don should now
+    """.split()
+)
+
+# `q_to_tsquery()` rewrites, in order
+QUOTED = re.compile(r'"[^"]*"')
+PLACEHOLDER = "@QUOTE@"
+REWRITES = [
+    (re.compile(r',(?=(?:[^"]*"[^"]*")*[^"]*$)'), " | "),
+    (re.compile(r"\s+AND\s+", re.IGNORECASE), " & "),
+    (re.compile(r"\s+OR\s+", re.IGNORECASE), " | "),
+    (re.compile(r"\+([a-zA-Z0-9_]+)"), r"& \1"),
+    (re.compile(r"\-([a-zA-Z0-9_]+)"), r"& ! \1"),
+]
+# `to_tsquery()` tokens: operators, quoted and bare operands
+TOKEN = re.compile(r"\s*(?:([!&|()])|<(-|\d+)>|'([^']*)'|([^\s!&|()<:']+)(:?))")
+WORD = re.compile(r"[A-Za-z0-9]+")
+OPERATORS = {"|": 1, "&": 2, "<": 3}
+MAX_DISTANCE = 16384
+
+# Free-text query trees, with the lexemes as leaves: ("lexeme", lexeme),
+# ("not", node), ("and" | "or", left, right) and ("phrase", left, right,
+# distance). Stopwords are None until `_clean` drops them.
+Node = Tuple[Any, ...]
+
+
+def tsquery_text(q: str) -> str:
+    """The text pgstac's `q_to_tsquery()` passes to `to_tsquery()`.
+
+    Raises ValueError where pgstac fails (more than one quoted string), and
+    for text `parse_query` leaves to Postgres.
+    """
+    if not q.isascii() or "'" in q or "\\" in q:
+        raise ValueError(q)
+    quoted = QUOTED.findall(q)
+    if len(quoted) > 1:
+        raise ValueError(q)
+    text = q
+    if quoted:
+        text = text.replace(quoted[0], f"{PLACEHOLDER}1{PLACEHOLDER}")
+    for pattern, replacement in REWRITES:
+        text = pattern.sub(replacement, text)
+    if quoted:
+        text = text.replace(f"{PLACEHOLDER}1{PLACEHOLDER}", f"'{quoted[0][1:-1]}'")
+    return text
+
+
+def parse_query(q: str, stem: Callable[[str], str]) -> Optional[Node]:
+    """The tree of a free-text query, as pgstac's `q_to_tsquery()` makes it,
+    or None for a query of stopwords only (it matches nothing).
+
+    Raises ValueError for the queries pgstac rejects, and for those that
+    cannot be matched exactly here.
+    """
+    text = tsquery_text(q)
+    tokens = []
+    position, end = 0, len(text.rstrip())
+    while position < end:
+        match = TOKEN.match(text, position)
+        if match is None or match.group(5):
+            # A syntax error, or weights and prefixes (`:*`)
+            raise ValueError(q)
+        tokens.append(match.groups()[:4])
+        position = match.end()
+    if not tokens:
+        return None
+    tokens.reverse()
+
+    def lexeme(word: str) -> Node:
+        if not WORD.fullmatch(word):
+            # Any other token is split or kept whole by Postgres' parser
+            raise ValueError(word)
+        word = word.lower()
+        if not word.isalpha():
+            # Numbers go to the `simple` dictionary
+            return ("lexeme", word)
+        return ("lexeme", None if word in STOPWORDS else stem(word))
+
+    def operand() -> Node:
+        op, _, quoted, bare = tokens.pop() if tokens else (None,) * 4
+        if op == "!":
+            return ("not", operand())
+        if op == "(":
+            node = expression(0)
+            if not tokens or tokens.pop()[0] != ")":
+                raise ValueError(q)
+            return node
+        if bare is not None:
+            return lexeme(bare)
+        if quoted:
+            # The words of a quoted string are a phrase, with the stopwords
+            # in between counted in the distances (but not those around)
+            words = [(i, lexeme(word)) for i, word in enumerate(quoted.split())]
+            words = [(i, node) for i, node in words if node[1] is not None]
+            if not words:
+                return ("lexeme", None)
+            node = words[0][1]
+            for (previous, _), (i, word) in zip(words, words[1:]):
+                node = ("phrase", node, word, i - previous)
+            return node
+        raise ValueError(q)
+
+    def expression(priority: int) -> Node:
+        """Operands joined by operators of a higher priority than
+        `priority`, left to right (`|` < `&` < `<->`, as `to_tsquery()`).
+        """
+        node = operand()
+        while tokens:
+            op, distance = tokens[-1][:2]
+            op = "<" if distance is not None else op
+            if op not in OPERATORS or OPERATORS[op] <= priority:
+                break
+            tokens.pop()
+            right = expression(OPERATORS[op])
+            if op == "|":
+                node = ("or", node, right)
+            elif op == "&":
+                node = ("and", node, right)
+            else:
+                distance = 1 if distance == "-" else int(distance)
+                if distance > MAX_DISTANCE:
+                    raise ValueError(q)
+                node = ("phrase", node, right, distance)
+        return node
+
+    tree = expression(0)
+    if tokens:
+        raise ValueError(q)
+    _check_phrases(tree)
+    return _clean(tree)[0]
+
+
+def _clean(node: Node) -> Tuple[Optional[Node], int, int]:
+    """`node` without its stopwords, as Postgres' `clean_stopword_intree`,
+    with the distances to add on its left and right.
+    """
+    kind = node[0]
+    if kind == "lexeme":
+        return (node if node[1] is not None else None), 0, 0
+    if kind == "not":
+        child = _clean(node[1])[0]
+        return (None if child is None else ("not", child)), 0, 0
+    left, lladd, lradd = _clean(node[1])
+    right, rladd, rradd = _clean(node[2])
+    if kind != "phrase":
+        if left is None or right is None:
+            return (left if right is None else right), 0, 0
+        return (kind, left, right), 0, 0
+    distance = node[3]
+    if left is None and right is None:
+        return None, lladd + distance + rradd, lladd + distance + rradd
+    if left is None:
+        return right, lladd + distance + rladd, rradd
+    if right is None:
+        return left, lladd, lradd + distance + rradd
+    return ("phrase", left, right, distance + lradd + rladd), lladd, rradd
+
+
+def _check_phrases(node: Node) -> None:
+    """Raise ValueError for phrases of other than words, not matched here."""
+    if node[0] == "phrase":
+        for child in node[1:3]:
+            if child[0] not in ("lexeme", "phrase"):
+                raise ValueError(node)
+    if node[0] != "lexeme":
+        for child in node[1:]:
+            if isinstance(child, tuple):
+                _check_phrases(child)
+
+
+def _terms(node: Node) -> List[Tuple[int, str]]:
+    """Offsets and lexemes of a phrase (of lexemes)."""
+    if node[0] == "lexeme":
+        return [(0, node[1])]
+    left = _terms(node[1])
+    width = max(offset for offset, _ in left) + node[3]
+    return left + [(offset + width, term) for offset, term in _terms(node[2])]
+
+
+def _instant(value: str) -> float:
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _isoformat(instant: float) -> str:
+    """A timestamp as Postgres writes it in JSON."""
+    if math.isinf(instant):
+        return "infinity" if instant > 0 else "-infinity"
+    return datetime.fromtimestamp(instant, timezone.utc).isoformat()
+
+
+def _from_isoformat(value: str) -> float:
+    if value in ("infinity", "-infinity"):
+        return math.inf if value == "infinity" else -math.inf
+    return _instant(value)
+
+
+def parse_datetime(value: str) -> Optional[Tuple[float, float]]:
+    """Start and end (epoch seconds) of a datetime parameter, or None for
+    the forms only pgstac understands (durations).
+    """
+    parts = value.split("/")
+    if len(parts) > 2 or any(p.upper().startswith("P") for p in parts):
+        return None
+    if len(parts) == 1:
+        instant = _instant(parts[0])
+        return instant, instant
+    start, end = parts
+    return (
+        -math.inf if start in ("", "..") else _instant(start),
+        math.inf if end in ("", "..") else _instant(end),
+    )
+
+
+def _value(value: Any) -> Any:
+    if value is None or isinstance(value, bool):
+        return None if value is None else str(value).lower()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return value if isinstance(value, str) else str(value)
+
+
+class CollectionCatalog:
+    """All collections, indexed for search."""
+
+    def __init__(self, refresh_interval: float = 60) -> None:
+        try:
+            import numpy
+            import snowballstemmer
+        except ImportError as e:
+            raise RuntimeError(
+                "numpy and snowballstemmer must be installed in order to use the "
+                "collection catalog"
+            ) from e
+
+        self.np = numpy
+        self.stem = snowballstemmer.stemmer("english").stemWord
+        self.refresh_interval = refresh_interval
+        self.collections: List[Dict[str, Any]] = []
+        # Whether free text is matched here, and if not why (see `load`)
+        self.text_search = False
+        self._text_search_off: Optional[str] = None
+        self._loaded = -math.inf
+        self._stale = True
+        self._lock = asyncio.Lock()
+
+    async def load(self, conn: Any) -> None:
+        """(Re)build the index from the collections table."""
+        self._stale = False
+        started = time.monotonic()
+        rows = await conn.fetch(COLLECTIONS_SQL)
+        lexemes = await conn.fetch(LEXEMES_SQL)
+        self._build([row["content"] for row in rows], lexemes)
+        off = await self._check_text_search(conn)
+        if off is not None and off != self._text_search_off:
+            logger.warning(f"Free-text collection search goes to pgstac: {off}")
+        self.text_search = off is None
+        self._text_search_off = off
+        self._loaded = started
+
+    async def _check_text_search(self, conn: Any) -> Optional[str]:
+        """Why `q` cannot be matched as pgstac would, if so: its version or
+        text search configuration are not those `parse_query` follows, or
+        the words of the collections do not stem as Postgres stems them.
+        """
+        settings = await conn.fetchrow(TEXT_SEARCH_SQL)
+        if settings["version"] not in TEXT_SEARCH_VERSIONS:
+            return f"pgstac {settings['version']}"
+        if settings["config"] != TEXT_SEARCH_CONFIG:
+            return f"text search configuration {settings['config']}"
+        differ = sorted(
+            row["word"]
+            for row in await conn.fetch(WORDS_SQL)
+            if row["lexeme"]
+            != (None if row["word"] in STOPWORDS else self.stem(row["word"]))
+        )
+        if differ:
+            return f"stems differ from Postgres' for {', '.join(differ[:10])}"
+        return None
+
+    async def invalidate(self, collection_id: Optional[str]) -> None:
+        """Reload on the next search, after a write to any collection."""
+        self._stale = True
+
+    def _build(self, collections: List[Dict[str, Any]], lexemes: List[Any]) -> None:
+        np = self.np
+        count = len(collections)
+        bounds = np.full((count, 4), np.nan)
+        start = np.full(count, -np.inf)
+        end = np.full(count, np.inf)
+        ids = {c["id"]: i for i, c in enumerate(collections)}
+        postings: Dict[str, Dict[int, Set[int]]] = {}
+        for row in lexemes:
+            index = ids.get(row["id"])
+            if index is not None:
+                postings.setdefault(row["lexeme"], {})[index] = set(row["positions"])
+        # As pgstac: without a description, the text is null and never matches
+        described = np.array(
+            [c.get("description") is not None for c in collections], dtype=bool
+        )
+
+        for i, collection in enumerate(collections):
+            extent = collection.get("extent") or {}
+            bbox = ((extent.get("spatial") or {}).get("bbox") or [None])[0]
+            if bbox and len(bbox) >= 4:
+                if len(bbox) == 6:
+                    bbox = [bbox[0], bbox[1], bbox[3], bbox[4]]
+                bounds[i] = bbox[:4]
+            interval = ((extent.get("temporal") or {}).get("interval") or [[]])[0]
+            if interval and interval[0]:
+                start[i] = _instant(interval[0])
+            if len(interval) > 1 and interval[1]:
+                end[i] = _instant(interval[1])
+
+        self.collections = collections
+        self.bounds = bounds
+        self.start = start
+        self.end = end
+        self.postings = postings
+        self.described = described
+
+    async def _ensure(self, request: Request) -> None:
+        if not self._stale and time.monotonic() - self._loaded < self.refresh_interval:
+            return
+        async with self._lock:
+            if self._stale or time.monotonic() - self._loaded >= self.refresh_interval:
+                async with request.app.state.get_connection(request, "r") as conn:
+                    await self.load(conn)
+
+    async def search(
+        self, request: Request, search: Dict[str, Any], token: Optional[str]
+    ) -> Optional[Dict[str, Any]]:
+        """A page of collection search, as `collection_page` returns it, or
+        None when the search needs pgstac.
+        """
+        if "filter" in search or "query" in search:
+            return None
+        span = None
+        if search.get("datetime"):
+            try:
+                span = parse_datetime(search["datetime"])
+            except ValueError:
+                return None
+            if span is None:
+                return None
+        await self._ensure(request)
+
+        text: Optional[Node] = None
+        if search.get("q"):
+            if not self.text_search or not isinstance(search["q"], str):
+                return None
+            try:
+                text = parse_query(search["q"], self.stem)
+            except ValueError:
+                return None
+
+        mask = self._filter(search.get("bbox"), span)
+        if search.get("q"):
+            # A query of stopwords only is empty, and matches nothing
+            mask &= self.described & (self._match(text) if text is not None else False)
+        fields = sort_fields(search.get("sortby"))
+        matched = [int(i) for i in self.np.flatnonzero(mask)]
+        keys = {i: self._sort_key(i, fields) for i in matched}
+
+        descending = [desc for _, desc in fields]
+
+        def compare(a: List[Any], b: List[Any]) -> int:
+            for x, y, desc in zip(a, b, descending):
+                if x is None or y is None:
+                    result = (x is None) - (y is None)
+                else:
+                    result = (x > y) - (x < y)
+                if result:
+                    return -result if desc else result
+            return 0
+
+        sort_key = cmp_to_key(compare)
+        try:
+            order = sorted(matched, key=lambda i: sort_key(keys[i]))
+        except TypeError:
+            # Values of mixed types, leave their order to pgstac
+            return None
+
+        values, backwards = parse_token(token, len(fields))
+        if values is not None:
+            try:
+                key = self._token_key(values, fields)
+            except (TypeError, ValueError) as e:
+                raise InvalidQueryParameter(f"Invalid token: {token}.") from e
+            try:
+                if backwards:
+                    order = [i for i in order if compare(keys[i], key) < 0][::-1]
+                else:
+                    order = [i for i in order if compare(keys[i], key) > 0]
+            except TypeError:
+                return None
+
+        limit = int(search.get("limit") or 10)
+        more = len(order) > limit
+        page_ids = order[:limit]
+        if backwards:
+            page_ids.reverse()
+
+        include: Set[str] = set()
+        exclude: Set[str] = set()
+        if search.get("fields"):
+            include = set(search["fields"].get("include") or ())
+            exclude = set(search["fields"].get("exclude") or ())
+        collections = [
+            filter_fields(self.collections[i], include, exclude)
+            if include or exclude
+            else self.collections[i]
+            for i in page_ids
+        ]
+
+        page: Dict[str, Any] = {
+            "collections": collections,
+            "numberReturned": len(collections),
+            "numberMatched": len(matched),
+            "next": None,
+            "prev": None,
+        }
+        if page_ids:
+            first, last = (
+                encode_token(self._token_values(i, fields))
+                for i in (page_ids[0], page_ids[-1])
+            )
+            if backwards:
+                page["next"] = last
+                page["prev"] = first if more else None
+            else:
+                page["next"] = last if more else None
+                page["prev"] = first if values is not None else None
+        return page
+
+    def _filter(
+        self,
+        bbox: Optional[Sequence[float]],
+        span: Optional[Tuple[float, float]],
+    ) -> Any:
+        np = self.np
+        mask = np.ones(len(self.collections), dtype=bool)
+        if bbox:
+            if len(bbox) == 6:
+                bbox = [bbox[0], bbox[1], bbox[3], bbox[4]]
+            minx, miny, maxx, maxy = bbox
+            with np.errstate(invalid="ignore"):
+                mask &= (
+                    (self.bounds[:, 0] <= maxx)
+                    & (self.bounds[:, 2] >= minx)
+                    & (self.bounds[:, 1] <= maxy)
+                    & (self.bounds[:, 3] >= miny)
+                )
+        if span is not None:
+            mask &= (self.start <= span[1]) & (self.end >= span[0])
+        return mask
+
+    def _match(self, node: Node) -> Any:
+        """Mask of the collections matching a free-text query tree."""
+        kind = node[0]
+        if kind == "not":
+            return ~self._match(node[1])
+        if kind == "and":
+            return self._match(node[1]) & self._match(node[2])
+        if kind == "or":
+            return self._match(node[1]) | self._match(node[2])
+
+        mask = self.np.zeros(len(self.collections), dtype=bool)
+        terms = _terms(node)
+        lists = [self.postings.get(term, {}) for _, term in terms]
+        docs = set(lists[0])
+        for postings in lists[1:]:
+            docs &= set(postings)
+        for doc in docs:
+            if any(
+                all(
+                    p + offset in postings[doc]
+                    for (offset, _), postings in zip(terms, lists)
+                )
+                for p in lists[0][doc]
+            ):
+                mask[doc] = True
+        return mask
+
+    def _sort_key(self, index: int, fields: List[Tuple[str, bool]]) -> List[Any]:
+        collection = self.collections[index]
+        key = []
+        for field, _ in fields:
+            name = field.removeprefix("properties.")
+            if name in ("datetime", "start_datetime"):
+                key.append(float(self.start[index]))
+            elif name == "end_datetime":
+                key.append(float(self.end[index]))
+            else:
+                key.append(_value(collection.get(name)))
+        return key
+
+    def _token_values(self, index: int, fields: List[Tuple[str, bool]]) -> List[Any]:
+        """Sort values of a collection in a token, as pgstac reads them: the
+        JSON of its fields, and its extent as timestamps.
+        """
+        collection = self.collections[index]
+        values = []
+        for field, _ in fields:
+            name = field.removeprefix("properties.")
+            if name in ("datetime", "start_datetime"):
+                values.append(_isoformat(float(self.start[index])))
+            elif name == "end_datetime":
+                values.append(_isoformat(float(self.end[index])))
+            else:
+                values.append(collection.get(name))
+        return values
+
+    def _token_key(
+        self, values: List[Any], fields: List[Tuple[str, bool]]
+    ) -> List[Any]:
+        """`_sort_key` of the values of a token."""
+        key = []
+        for value, (field, _) in zip(values, fields):
+            name = field.removeprefix("properties.")
+            if name in ("datetime", "start_datetime", "end_datetime"):
+                key.append(None if value is None else _from_isoformat(value))
+            else:
+                key.append(_value(value))
+        return key
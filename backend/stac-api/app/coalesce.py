@@ -0,0 +1,39 @@
+"""Single-flight coalescing of identical concurrent calls."""
+
+import asyncio
+from typing import Awaitable, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Run at most one call per key at a time, sharing its result.
+
+    The first caller for a key starts the call; callers arriving while it is
+    in flight wait for the same result instead of starting their own. The
+    call runs in its own task, so a caller going away (e.g. a client
+    disconnect cancelling the request) does not cancel it for the others.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: dict[str, asyncio.Task[T]] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task[T]) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved, in case every caller went away
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,219 @@
+"""Keyset pagination of collection search.
+
+pgstac's `collection_search()` pages with `OFFSET`, which sorts and formats
+every skipped collection, and shifts pages when collections are added or
+removed in between. Here pages are continued from a token carrying the sort
+values of the last (`next:`) or first (`prev:`) collection of the previous
+page, as base64 JSON: the next page is the collections sorting after those
+values, so a deep page costs the same as the first, and paging never repeats
+or skips a collection that was already there, even when that one has since
+been updated or deleted.
+
+The filters (`bbox`, `datetime`, `q`, `filter`, `query`) and the sort
+expressions are those of pgstac, over its `collections_asitems` view.
+Ties are broken on `id`, and nulls sort as the largest values, as pgstac
+sorts items.
+"""
+
+import base64
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+from asyncpg.exceptions import DataError
+from stac_fastapi.types.errors import InvalidQueryParameter
+
+DEFAULT_SORTBY = [{"field": "id", "direction": "asc"}]
+
+# The pgstac WHERE clause of a search and, for its sort keys, their SQL
+# expressions, the JSON (or column) they are read from and its wrapper
+PLAN_SQL = """
+SELECT
+    stac_search_to_where($1::text::jsonb) AS where,
+    array_agg(q.expression ORDER BY n) AS keys,
+    array_agg(q.path ORDER BY n) AS paths,
+    array_agg(q.wrapper ORDER BY n) AS wrappers
+FROM jsonb_array_elements($2::text::jsonb) WITH ORDINALITY AS t(s, n),
+    queryable(s->>'field') AS q;
+"""
+
+MATCHED_SQL = "SELECT collection_search_matched($1::text::jsonb);"
+
+# `collections_asitems` columns that are timestamps, the others are text
+TIMESTAMP_COLUMNS = ("datetime", "end_datetime")
+
+
+def encode_token(values: List[Any]) -> str:
+    """Token (without its `next:` / `prev:` prefix) of the sort values of a
+    collection.
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode().rstrip("=")
+
+
+def parse_token(token: Optional[str], size: int) -> Tuple[Optional[List[Any]], bool]:
+    """The `size` sort values of a `next:` / `prev:` token, and whether it
+    pages backwards.
+    """
+    if not token:
+        return None, False
+    direction, _, payload = token.partition(":")
+    try:
+        values = orjson.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+    except ValueError:
+        values = None
+    if (
+        direction not in ("next", "prev")
+        or not isinstance(values, list)
+        or len(values) != size
+        or not isinstance(values[-1], str)
+    ):
+        raise InvalidQueryParameter(f"Invalid token: {token}.")
+    return values, direction == "prev"
+
+
+def sort_fields(sortby: Optional[List[Dict[str, str]]]) -> List[Tuple[str, bool]]:
+    """Sort fields of a search and whether each is descending, ending with
+    `id`.
+    """
+    fields = [
+        (s["field"], str(s.get("direction") or "asc").lower().startswith("desc"))
+        for s in sortby or DEFAULT_SORTBY
+    ]
+    ids = [i for i, (field, _) in enumerate(fields) if field == "id"]
+    if ids:
+        # Keys after `id` never decide the order
+        return fields[: ids[0] + 1]
+    return [*fields, ("id", False)]
+
+
+def page_query(
+    where: str,
+    keys: List[str],
+    paths: List[str],
+    wrappers: List[Optional[str]],
+    descending: List[bool],
+    after: bool,
+) -> str:
+    """SQL of a page: the collections matching `where`, in the order of
+    `keys`, after the token values when `after` is set, with the sort values
+    of each (`k`).
+
+    Parameters are the fields (`$1`), the limit (`$2`) and, with `after`, the
+    token values as a JSON array (`$3`).
+    """
+    order = ", ".join(
+        f"{key} {'DESC' if desc else 'ASC'}" for key, desc in zip(keys, descending)
+    )
+    columns = (
+        "SELECT id, jsonb_fields(collectionjson, $1::text::jsonb)::text AS c,\n"
+        f"    jsonb_build_array({', '.join(paths)})::text AS k\n"
+    )
+    if not after:
+        return (
+            f"{columns}"
+            "FROM collections_asitems\n"
+            f"WHERE {where}\n"
+            f"ORDER BY {order}\n"
+            "LIMIT $2;"
+        )
+
+    # Token values are read as the row's are, by the wrapper of their key
+    token_keys = []
+    for i, (path, wrapper) in enumerate(zip(paths, wrappers)):
+        value = f"$3::text::jsonb->{i}"
+        if wrapper is None:
+            wrapper = "to_tstz" if path in TIMESTAMP_COLUMNS else "to_text"
+        token_keys.append(f"{wrapper}({value}) AS k{i}")
+    return (
+        "WITH token AS (\n"
+        f"    SELECT {', '.join(token_keys)}\n"
+        ")\n"
+        f"{columns}"
+        "FROM collections_asitems, token\n"
+        f"WHERE ({where}) AND ({_after(keys, descending)})\n"
+        f"ORDER BY {order}\n"
+        "LIMIT $2;"
+    )
+
+
+def _after(keys: List[str], descending: List[bool]) -> str:
+    """Condition for a row to sort after the token values (nulls largest)."""
+    terms = []
+    for i, (key, desc) in enumerate(zip(keys, descending)):
+        value = f"token.k{i}"
+        if key == "id":
+            # Never null, keep it usable by the primary key index
+            term = f"{key} {'<' if desc else '>'} {value}"
+        elif desc:
+            term = f"({value} IS NULL AND {key} IS NOT NULL) OR {key} < {value}"
+        else:
+            term = f"{value} IS NOT NULL AND ({key} > {value} OR {key} IS NULL)"
+        ties = [f"{keys[j]} IS NOT DISTINCT FROM token.k{j}" for j in range(i)]
+        terms.append("(" + " AND ".join([*ties, f"({term})"]) + ")")
+    return " OR ".join(terms)
+
+
+async def collection_page(
+    conn: Any, search: Dict[str, Any], token: Optional[str]
+) -> Dict[str, Any]:
+    """A page of collection search: its collections, the tokens to continue
+    from (`next` / `prev`), and `numberMatched` on the first page.
+    """
+    limit = int(search.get("limit") or 10)
+    fields = sort_fields(search.get("sortby"))
+    values, backwards = parse_token(token, len(fields))
+    # A previous page is the next one in the reverse order, reversed
+    descending = [desc != backwards for _, desc in fields]
+
+    filters = {
+        k: v for k, v in search.items() if k not in ("limit", "sortby", "fields")
+    }
+    row = await conn.fetchrow(
+        PLAN_SQL,
+        orjson.dumps(filters).decode(),
+        orjson.dumps([{"field": field} for field, _ in fields]).decode(),
+    )
+    after = values is not None
+    try:
+        rows = await conn.fetch(
+            page_query(
+                row["where"],
+                row["keys"],
+                row["paths"],
+                row["wrappers"],
+                descending,
+                after,
+            ),
+            orjson.dumps(search.get("fields") or {}, default=list).decode(),
+            limit + 1,
+            *([orjson.dumps(values).decode()] if after else []),
+        )
+    except DataError as e:
+        # Token values that their key's wrapper cannot read
+        raise InvalidQueryParameter(f"Invalid token: {token}.") from e
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    page: Dict[str, Any] = {
+        "collections": [orjson.loads(r["c"]) for r in rows],
+        "numberReturned": len(rows),
+        "next": None,
+        "prev": None,
+    }
+    if rows:
+        first, last = (encode_token(orjson.loads(r["k"])) for r in (rows[0], rows[-1]))
+        if backwards:
+            page["next"] = last
+            page["prev"] = first if more else None
+        else:
+            page["next"] = last if more else None
+            page["prev"] = first if after else None
+    if not after:
+        page["numberMatched"] = await conn.fetchval(
+            MATCHED_SQL, orjson.dumps(filters).decode()
+        )
+    return page
@@ -0,0 +1,301 @@
+"""Size- and type-aware response compression.
+
+Replaces `brotli_asgi.BrotliMiddleware`, which compressed every response on
+the event loop at a single quality:
+
+- responses below `minimum_size`, or of a content type that does not
+  compress (images, parquet, ...), are sent as-is;
+- the quality goes down as the payload grows, since large pages gain little
+  from the higher levels for a lot more CPU;
+- bodies from `offload_size` up are compressed in a worker pool, so a big
+  search page does not stall every other request on the loop;
+- near-static routes (landing page, conformance, queryables, collections)
+  are compressed once at the highest quality, in both encodings and always
+  in the worker pool, and the result reused for as long as the body does
+  not change. Entries are per origin (scheme, host, proxy headers, root
+  path), since the links of those bodies depend on it.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Callable, Optional
+
+import brotli
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app import routes
+from app.metrics import record_timing
+
+# Content types worth compressing, by prefix (parameters are ignored)
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/geo+json",
+    "application/schema+json",
+    "application/problem+json",
+    "application/x-ndjson",
+    "application/geo+json-seq",
+    "application/javascript",
+    "application/xml",
+    "application/vnd.oai.openapi",
+    "application/vnd.mapbox-vector-tile",
+)
+
+# (largest body size, brotli quality, gzip level), the first that fits wins
+QUALITY_BY_SIZE = (
+    (64 * 1024, 5, 6),
+    (1024 * 1024, 4, 5),
+    (8 * 1024 * 1024, 2, 3),
+    (None, 1, 1),
+)
+
+# Quality for the precompressed near-static bodies
+PRECOMPRESSED_QUALITY = (11, 9)
+PRECOMPRESSED_MAX_SIZE = 2 * 1024 * 1024
+PRECOMPRESSED_ROUTES = {
+    routes.LANDING,
+    routes.CONFORMANCE,
+    routes.QUERYABLES,
+    routes.COLLECTIONS,
+}
+
+# Request headers the links of a body may be built from
+ORIGIN_HEADERS = (b"host", b"forwarded", b"x-forwarded-proto", b"x-forwarded-host")
+
+
+def _accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick "br" or "gzip" from an Accept-Encoding header, br preferred."""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip())
+    if "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def _is_compressible(content_type: str) -> bool:
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(body: bytes, encoding: str, quality: Optional[int] = None) -> bytes:
+    """Compress `body`, with a quality picked by its size unless given."""
+    if quality is None:
+        for max_size, br_quality, gzip_level in QUALITY_BY_SIZE:
+            if max_size is None or len(body) <= max_size:
+                quality = br_quality if encoding == "br" else gzip_level
+                break
+    if encoding == "br":
+        return brotli.compress(body, mode=brotli.MODE_TEXT, quality=quality)
+    return gzip.compress(body, compresslevel=quality, mtime=0)
+
+
+def _origin(scope: Scope, headers: dict) -> tuple:
+    """What the links of a response may depend on, besides its path."""
+    return (
+        scope.get("scheme"),
+        scope.get("root_path", ""),
+        *(headers.get(name) for name in ORIGIN_HEADERS),
+    )
+
+
+class _StreamCompressor:
+    """Incremental compressor for streamed (more_body) responses."""
+
+    def __init__(self, encoding: str) -> None:
+        if encoding == "br":
+            self._br = brotli.Compressor(mode=brotli.MODE_TEXT, quality=4)
+            self.process: Callable[[bytes], bytes] = self._br.process
+            self._flush = self._br.flush
+            self._finish = self._br.finish
+        else:
+            self._zlib = zlib.compressobj(5, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.process = self._zlib.compress
+            self._flush = lambda: self._zlib.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._zlib.flush
+
+    def chunk(self, data: bytes, last: bool) -> bytes:
+        # Flush every chunk, so a streamed response stays streamed
+        return self.process(data) + (self._finish() if last else self._flush())
+
+
+class CompressionMiddleware:
+    """Compress responses with brotli (preferred) or gzip."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        offload_size: int = 256 * 1024,
+        executor: Optional[Executor] = None,
+        precompressed_max_entries: int = 64,
+    ) -> None:
+        """Bodies from `offload_size` bytes up are compressed in `executor`
+        (the default loop executor if None).
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.executor = executor
+        self.precompressed_max_entries = precompressed_max_entries
+        # (origin, path, encoding) -> (body digest, compressed body)
+        self._precompressed: OrderedDict[tuple, tuple[bytes, bytes]] = OrderedDict()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        encoding = _accepted_encoding(
+            headers.get(b"accept-encoding", b"").decode("latin-1")
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        path = routes.route_path(scope)
+        route = routes.match_route(scope["method"], path)
+        # /collections with a query string is a collection search
+        precompress = (
+            route is not None
+            and route[0] in PRECOMPRESSED_ROUTES
+            and not scope.get("query_string")
+        )
+
+        start: Optional[Message] = None
+        stream: Optional[_StreamCompressor] = None
+        passthrough = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start, stream, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = dict(message.get("headers", []))
+                content_type = response_headers.get(b"content-type", b"")
+                if b"content-encoding" in response_headers or not _is_compressible(
+                    content_type.decode("latin-1")
+                ):
+                    passthrough = True
+                    await send(message)
+                    return
+                # Hold on to the start message until the body size is known
+                start = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            assert start is not None
+
+            if stream is None and not more_body:
+                if len(body) < self.minimum_size:
+                    await send(start)
+                    await send(message)
+                    return
+                if precompress and len(body) <= PRECOMPRESSED_MAX_SIZE:
+                    compressed = await self._precompressed_body(
+                        (_origin(scope, headers), path), encoding, body
+                    )
+                else:
+                    compressed = await self._compress(body, encoding)
+                await send(self._encoded_start(start, encoding, len(compressed)))
+                await send({"type": "http.response.body", "body": compressed})
+                return
+
+            if stream is None:
+                stream = _StreamCompressor(encoding)
+                await send(self._encoded_start(start, encoding, None))
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": stream.chunk(body, last=not more_body),
+                    "more_body": more_body,
+                }
+            )
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _compress(
+        self,
+        body: bytes,
+        encoding: str,
+        quality: Optional[int] = None,
+        offload: bool = False,
+    ) -> bytes:
+        started = time.perf_counter()
+        if len(body) < self.offload_size and not offload:
+            compressed = compress(body, encoding, quality)
+        else:
+            loop = asyncio.get_running_loop()
+            compressed = await loop.run_in_executor(
+                self.executor, compress, body, encoding, quality
+            )
+        record_timing("compress", time.perf_counter() - started)
+        return compressed
+
+    async def _precompressed_body(
+        self, key: tuple, encoding: str, body: bytes
+    ) -> bytes:
+        """Compressed `body`, reused for as long as the route returns it to
+        the same origin (`key`).
+        """
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        cached = self._precompressed.get((*key, encoding))
+        if cached is not None and cached[0] == digest:
+            self._precompressed.move_to_end((*key, encoding))
+            return cached[1]
+
+        # Even small bodies take long at the highest quality: off the loop
+        br_quality, gzip_level = PRECOMPRESSED_QUALITY
+        for other, quality in (("br", br_quality), ("gzip", gzip_level)):
+            self._precompressed[(*key, other)] = (
+                digest,
+                await self._compress(body, other, quality, offload=True),
+            )
+        while len(self._precompressed) > self.precompressed_max_entries:
+            self._precompressed.popitem(last=False)
+        return self._precompressed[(*key, encoding)][1]
+
+    @staticmethod
+    def _encoded_start(
+        start: Message, encoding: str, content_length: Optional[int]
+    ) -> Message:
+        headers = []
+        vary = None
+        for name, value in start.get("headers", []):
+            if name == b"content-length":
+                continue
+            if name == b"vary":
+                vary = value
+                continue
+            if name == b"etag" and not value.startswith(b"W/"):
+                # Same document, different bytes: no longer a strong validator
+                value = b"W/" + value
+            headers.append((name, value))
+        if vary is None:
+            vary = b"Accept-Encoding"
+        elif b"accept-encoding" not in vary.lower():
+            vary += b", Accept-Encoding"
+        headers.append((b"vary", vary))
+        headers.append((b"content-encoding", encoding.encode()))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode()))
+        return {**start, "headers": headers}
@@ -0,0 +1,173 @@
+"""Conditional GET support (ETag / If-None-Match / Last-Modified).
+
+Strong ETags are a hash of the (uncompressed) response body, so they change
+whenever anything in the document does, including the `updated` timestamps
+of the items and collections it contains. Single items and collections also
+get a `Last-Modified` header from their `updated` timestamp, when they have
+one.
+"""
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+import orjson
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app import routes
+
+# Headers a 304 must repeat from the 200 it replaces (RFC 9110, 15.4.5)
+NOT_MODIFIED_HEADERS = {
+    b"cache-control",
+    b"content-location",
+    b"date",
+    b"etag",
+    b"expires",
+    b"last-modified",
+    b"vary",
+}
+
+
+def make_etag(body: bytes) -> bytes:
+    """Strong ETag from a hash of the response body."""
+    return b'"' + hashlib.blake2b(body, digest_size=16).hexdigest().encode() + b'"'
+
+
+def etag_matches(if_none_match: bytes, etag: bytes) -> bool:
+    """Weak comparison of `etag` against an If-None-Match header value."""
+    if if_none_match.strip() == b"*":
+        return True
+    opaque = etag.removeprefix(b"W/")
+    return any(
+        candidate.strip().removeprefix(b"W/") == opaque
+        for candidate in if_none_match.split(b",")
+    )
+
+
+def _updated(route: str, body: bytes) -> Optional[datetime]:
+    """The `updated` timestamp of a single item or collection document."""
+    try:
+        doc = orjson.loads(body)
+        value = doc.get("properties", {}) if route == routes.ITEM else doc
+        updated = value.get("updated")
+        if not updated:
+            return None
+        parsed = datetime.fromisoformat(updated.replace("Z", "+00:00"))
+    except (orjson.JSONDecodeError, AttributeError, TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def _not_modified_since(
+    if_modified_since: Optional[bytes], last_modified: Optional[datetime]
+) -> bool:
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since.decode("latin-1"))
+    except (TypeError, ValueError):
+        return False
+    return last_modified <= since
+
+
+class ConditionalGetMiddleware:
+    """Add validators to read responses, and answer revalidations with 304.
+
+    Must sit inside the compression middleware, so the ETag describes (and
+    the 304 short-circuits) the JSON document rather than its encoding.
+    """
+
+    def __init__(self, app: ASGIApp, cache_control: dict[str, str]) -> None:
+        """`cache_control` maps route names to a Cache-Control value.
+
+        Routes missing from it get no validators; an empty value adds
+        validators without a Cache-Control header.
+        """
+        self.app = app
+        self.cache_control = cache_control
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        route = routes.match_route("GET", routes.route_path(scope))
+        if route is None or route[0] not in self.cache_control:
+            await self.app(scope, receive, send)
+            return
+
+        route_name = route[0]
+        request_headers = dict(scope["headers"])
+        start: Optional[Message] = None
+        chunks: list[bytes] = []
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                if message["status"] != 200:
+                    start = None
+                    await send(message)
+                    return
+                start = message
+                return
+
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            headers = [(k, v) for k, v in start.get("headers", [])]
+            names = {k for k, _ in headers}
+
+            etag = next((v for k, v in headers if k == b"etag"), None)
+            if etag is None:
+                etag = make_etag(body)
+                headers.append((b"etag", etag))
+
+            last_modified = None
+            if route_name in (routes.ITEM, routes.COLLECTION):
+                last_modified = _updated(route_name, body)
+                if last_modified is not None and b"last-modified" not in names:
+                    headers.append(
+                        (
+                            b"last-modified",
+                            format_datetime(last_modified, usegmt=True).encode(),
+                        )
+                    )
+
+            cache_control = self.cache_control[route_name]
+            if cache_control and b"cache-control" not in names:
+                headers.append((b"cache-control", cache_control.encode()))
+
+            # If-Modified-Since is only considered without If-None-Match
+            if_none_match = request_headers.get(b"if-none-match")
+            if (
+                etag_matches(if_none_match, etag)
+                if if_none_match is not None
+                else _not_modified_since(
+                    request_headers.get(b"if-modified-since"), last_modified
+                )
+            ):
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": 304,
+                        "headers": [
+                            (k, v) for k, v in headers if k in NOT_MODIFIED_HEADERS
+                        ],
+                    }
+                )
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            await send({**start, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,704 @@
+"""Core client, adapted from `stac_fastapi.pgstac.core`.
+
+`_search_base` is copied from upstream, with the pgstac `search()` call moved
+into `_fetch_search` so that it can be coalesced. Diff it against upstream
+`core.py` when upgrading stac-fastapi-pgstac.
+
+`export_search` streams every item of a search as newline-delimited JSON,
+paging through pgstac `search()` one page at a time.
+
+Search pages can skip decoding their items (`app.passthrough`).
+
+Searches can ask for a response profile (`app.profiles`), which becomes
+their fields, and for simplified geometries, which wraps the pgstac
+`search()` call.
+
+Searches can choose how their matches are counted (`app.counts`).
+
+Collection search pages with tokens rather than offsets
+(`app.collection_search`), and can be answered from memory (`app.catalog`).
+"""
+
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import unquote_plus, urljoin
+
+import attr
+import orjson
+from asyncpg.exceptions import InvalidDatetimeFormatError
+from buildpg import render
+from fastapi import Request
+from pypgstac.hydration import hydrate
+from stac_fastapi.api.models import GeoJSONResponse
+from stac_fastapi.types.core import Relations
+from stac_fastapi.types.errors import InvalidQueryParameter, NotFoundError
+from stac_fastapi.types.requests import get_base_url
+from stac_fastapi.types.stac import Collection, Collections, Item, ItemCollection
+from stac_pydantic.shared import BBox, MimeTypes
+from starlette.responses import Response
+from starlette.responses import StreamingResponse
+
+from stac_fastapi.pgstac.config import Settings
+from stac_fastapi.pgstac.core import CoreCrudClient as _CoreCrudClient
+from stac_fastapi.pgstac.models.links import (
+    CollectionLinks,
+    CollectionSearchPagingLinks,
+    ItemLinks,
+    PagingLinks,
+)
+from stac_fastapi.pgstac.types.search import PgstacSearch
+from stac_fastapi.pgstac.utils import filter_fields
+
+from app.catalog import CollectionCatalog
+from app.coalesce import SingleFlight
+from app.collection_search import collection_page
+from app.counts import CONTEXT, COUNT_SETTINGS_SQL
+from app.metrics import record_timing
+from app.passthrough import SPLIT_PAGE_SQL, ItemLinksBuilder, item_fragments
+from app.profiles import SEARCH_KEYS, profile_fields, simplify_digits
+from app.slow_queries import SlowQueryLog
+from app.viewport import ViewportSnap
+
+
+SEARCH_SQL = "SELECT search(:req::text::jsonb) AS r"
+
+# The search, with the geometries of its features simplified
+SIMPLIFIED_SEARCH_SQL = """
+SELECT jsonb_set(r, '{features}', coalesce((
+    SELECT jsonb_agg(
+        CASE WHEN jsonb_typeof(f->'geometry') = 'object'
+        THEN jsonb_set(f, '{geometry}', ST_AsGeoJSON(
+            ST_SimplifyPreserveTopology(
+                ST_GeomFromGeoJSON(f->>'geometry'), :tolerance::float8
+            ),
+            :digits::int
+        )::jsonb)
+        ELSE f END
+        ORDER BY n
+    )
+    FROM jsonb_array_elements(r->'features') WITH ORDINALITY AS t(f, n)
+), '[]'::jsonb)) AS r
+FROM search(:req::text::jsonb) AS r
+"""
+
+
+def search_query(
+    search_request_json: str,
+    simplify: Optional[float] = None,
+    split: bool = False,
+) -> Tuple[str, List[Any]]:
+    """SQL and parameters of a pgstac `search()` call (see
+    `CoreCrudClient._query_search`).
+    """
+    params: Dict[str, Any] = {"req": search_request_json}
+    source = SEARCH_SQL
+    if simplify is not None:
+        source = SIMPLIFIED_SEARCH_SQL
+        params.update(tolerance=simplify, digits=simplify_digits(simplify))
+    if split:
+        return render(SPLIT_PAGE_SQL.format(source=source), **params)
+    return render(f"SELECT s.r::text FROM ({source}) AS s;", **params)
+
+
+@attr.s
+class CoreCrudClient(_CoreCrudClient):
+    """Client for core endpoints defined by stac.
+
+    When `single_flight` is set, identical concurrent searches (same
+    canonical search body, whether from GET or POST) share a single pgstac
+    `search()` call. Each caller parses its own copy of the result, so the
+    responses are exactly those of independent queries.
+
+    When `slow_queries` is set, pgstac `search()` calls are reported to it.
+
+    When `viewport_snap` is set, first-page bbox searches are answered from
+    tile-aligned sub-searches where it can (see `app.viewport`).
+
+    When `collection_catalog` is set, collection searches are answered from
+    it where they can (see `app.catalog`).
+    """
+
+    single_flight: Optional[SingleFlight[str]] = attr.ib(default=None)
+    slow_queries: Optional[SlowQueryLog] = attr.ib(default=None)
+    viewport_snap: Optional[ViewportSnap] = attr.ib(default=None)
+    collection_catalog: Optional[CollectionCatalog] = attr.ib(default=None)
+
+    async def _fetch_search(
+        self,
+        request: Request,
+        search_request_json: str,
+        simplify: Optional[float] = None,
+        split: bool = False,
+        decode: bool = True,
+        count: Optional[str] = None,
+    ) -> Any:
+        """Run pgstac `search()` and return the decoded result.
+
+        With `split`, return the row of `SPLIT_PAGE_SQL` instead, and
+        without `decode` the JSON text.
+        """
+        if self.single_flight is None:
+            result = await self._query_search(
+                request, search_request_json, simplify, split, count
+            )
+        else:
+            key = orjson.dumps(
+                [orjson.loads(search_request_json), simplify, split, count],
+                option=orjson.OPT_SORT_KEYS,
+            ).decode()
+            result = await self.single_flight.run(
+                key,
+                lambda: self._query_search(
+                    request, search_request_json, simplify, split, count
+                ),
+            )
+        return orjson.loads(result) if decode and not split else result
+
+    async def _query_search(
+        self,
+        request: Request,
+        search_request_json: str,
+        simplify: Optional[float] = None,
+        split: bool = False,
+        count: Optional[str] = None,
+    ) -> Any:
+        """Run pgstac `search()`, returning the undecoded JSON text, or with
+        `split` the row of `SPLIT_PAGE_SQL`.
+
+        With `simplify`, the geometries of the features are simplified to
+        that tolerance (in degrees) in the same query. With a `count` mode,
+        the pgstac count settings are those of the mode (see `app.counts`).
+        """
+        q, p = search_query(search_request_json, simplify, split)
+        async with request.app.state.get_connection(request, "r") as conn:
+            started = time.perf_counter()
+            if count is None:
+                result = await self._run_search(conn, q, p, split)
+            else:
+                async with conn.transaction():
+                    await conn.execute(COUNT_SETTINGS_SQL, CONTEXT[count])
+                    result = await self._run_search(conn, q, p, split)
+        if self.slow_queries is not None:
+            self.slow_queries.observe(
+                request,
+                search_request_json,
+                time.perf_counter() - started,
+                result["page"] if split else result,
+            )
+        return result
+
+    @staticmethod
+    async def _run_search(conn: Any, q: str, p: List[Any], split: bool) -> Any:
+        if split:
+            return await conn.fetchrow(q, *p)
+        return await conn.fetchval(q, *p)
+
+    async def _search_base(  # noqa: C901
+        self,
+        search_request: PgstacSearch,
+        request: Request,
+        passthrough: bool = True,
+    ) -> ItemCollection:
+        """Cross catalog search (POST).
+
+        Called with `POST /search`.
+
+        Args:
+            search_request: search request parameters.
+            passthrough: return the features as `orjson.Fragment`s when
+                pass-through responses are enabled (see `app.passthrough`).
+
+        Returns:
+            ItemCollection containing items which match the search criteria.
+        """
+        items: Dict[str, Any]
+
+        settings: Settings = request.app.state.settings
+
+        search_request.conf = search_request.conf or {}
+        search_request.conf["nohydrate"] = settings.use_api_hydrate
+
+        # GET requests pass these through `request.state`, see `get_search`
+        profile, simplify = getattr(
+            request.state,
+            "search_profile",
+            (
+                getattr(search_request, "profile", None),
+                getattr(search_request, "simplify", None),
+            ),
+        )
+        if profile is not None:
+            search_request.fields = profile_fields(
+                profile, getattr(search_request, "fields", None)
+            )
+        count = (
+            getattr(request.state, "search_count", None)
+            or getattr(search_request, "count", None)
+            or settings.number_matched
+        )
+
+        search_request_json = search_request.model_dump_json(
+            exclude_none=True, by_alias=True, exclude=SEARCH_KEYS
+        )
+
+        passthrough = (
+            passthrough
+            and settings.passthrough_responses
+            and not settings.use_api_hydrate
+        )
+        try:
+            snapped = None
+            # Snapped pages have no count, and are filtered on the geometries
+            # of the items as stored
+            if self.viewport_snap is not None and simplify is None:
+                search = orjson.loads(search_request_json)
+                if self.viewport_snap.applies(search, count):
+                    snapped = await self.viewport_snap.search(
+                        request,
+                        search,
+                        lambda body: self._fetch_search(
+                            request, body, simplify, decode=False, count=count
+                        ),
+                    )
+            if snapped is not None:
+                items = snapped
+                passthrough = False
+            elif passthrough:
+                page = await self._fetch_search(
+                    request, search_request_json, simplify, split=True, count=count
+                )
+                items = orjson.loads(page["page"])
+            else:
+                items = await self._fetch_search(
+                    request, search_request_json, simplify, count=count
+                )
+        except InvalidDatetimeFormatError as e:
+            raise InvalidQueryParameter(
+                f"Datetime parameter {search_request.datetime} is invalid."
+            ) from e
+
+        # Starting in pgstac 0.9.0, the `next` and `prev` tokens are returned in spec-compliant links with method GET
+        next_from_link: Optional[str] = None
+        prev_from_link: Optional[str] = None
+        for link in items.get("links", []):
+            if link.get("rel") == "next":
+                next_from_link = link.get("href").split("token=next:")[1]
+            if link.get("rel") == "prev":
+                prev_from_link = link.get("href").split("token=prev:")[1]
+
+        next: Optional[str] = items.pop("next", next_from_link)
+        prev: Optional[str] = items.pop("prev", prev_from_link)
+        if count in ("exact", "estimated") and "numberMatched" in items:
+            items["numberMatchedType"] = count
+        collection = ItemCollection(**items)
+
+        fields = getattr(search_request, "fields", None)
+        include: Set[str] = fields.include if fields and fields.include else set()
+        exclude: Set[str] = fields.exclude if fields and fields.exclude else set()
+
+        async def _add_item_links(
+            feature: Item,
+            collection_id: Optional[str] = None,
+            item_id: Optional[str] = None,
+        ) -> None:
+            """Add ItemLinks to the Item.
+
+            If the fields extension is excluding links, then don't add them.
+            Also skip links if the item doesn't provide collection and item ids.
+            """
+            collection_id = feature.get("collection") or collection_id
+            item_id = feature.get("id") or item_id
+
+            if not exclude or "links" not in exclude and all([collection_id, item_id]):
+                feature["links"] = await ItemLinks(
+                    collection_id=collection_id,  # type: ignore
+                    item_id=item_id,  # type: ignore
+                    request=request,
+                ).get_links(extra_links=feature.get("links"))
+
+        cleaned_features: List[Any] = []
+
+        if passthrough:
+            cleaned_features = item_fragments(
+                page["features"] or [],
+                page["collections"] or [],
+                page["ids"] or [],
+                page["links"] or [],
+                ItemLinksBuilder(request),
+                add_links="links" not in exclude,
+            )
+        elif settings.use_api_hydrate:
+
+            async def _get_base_item(collection_id: str) -> Dict[str, Any]:
+                return await self._get_base_item(collection_id, request=request)
+
+            base_item_cache = settings.base_item_cache(
+                fetch_base_item=_get_base_item, request=request
+            )
+
+            for feature in collection.get("features") or []:
+                base_item = await base_item_cache.get(feature.get("collection"))
+                # Exclude None values
+                base_item = {k: v for k, v in base_item.items() if v is not None}
+
+                feature = hydrate(base_item, feature)
+
+                # Grab ids needed for links that may be removed by the fields extension.
+                collection_id = feature.get("collection")
+                item_id = feature.get("id")
+
+                feature = filter_fields(feature, include, exclude)
+                await _add_item_links(feature, collection_id, item_id)
+
+                cleaned_features.append(feature)
+        else:
+            for feature in collection.get("features") or []:
+                await _add_item_links(feature)
+                cleaned_features.append(feature)
+
+        collection["features"] = cleaned_features
+        collection["links"] = await PagingLinks(
+            request=request,
+            next=next,
+            prev=prev,
+        ).get_links()
+
+        return collection
+
+    async def get_search(
+        self,
+        request: Request,
+        profile: Optional[str] = None,
+        simplify: Optional[float] = None,
+        count: Optional[str] = None,
+        **kwargs,
+    ) -> Union[ItemCollection, Response]:
+        """Cross catalog search (GET), with a response profile and count mode.
+
+        Called with `GET /search`. Upstream builds the search model from a
+        fixed set of parameters, so the profile and count mode are handed to
+        `_search_base` on the request state.
+        """
+        request.state.search_profile = (profile, simplify)
+        request.state.search_count = count
+        return self._response(request, await super().get_search(request, **kwargs))
+
+    async def post_search(
+        self, search_request: PgstacSearch, request: Request, **kwargs
+    ) -> Union[ItemCollection, Response]:
+        """Cross catalog search (POST).
+
+        Called with `POST /search`.
+        """
+        return self._response(
+            request, await super().post_search(search_request, request, **kwargs)
+        )
+
+    async def item_collection(
+        self,
+        collection_id: str,
+        request: Request,
+        profile: Optional[str] = None,
+        simplify: Optional[float] = None,
+        count: Optional[str] = None,
+        **kwargs,
+    ) -> Union[ItemCollection, Response]:
+        """Get all items from a specific collection, with a response profile
+        and count mode.
+
+        Called with `GET /collections/{collection_id}/items`.
+        """
+        request.state.search_profile = (profile, simplify)
+        request.state.search_count = count
+        return self._response(
+            request, await super().item_collection(collection_id, request, **kwargs)
+        )
+
+    async def all_collections(  # noqa: C901
+        self,
+        request: Request,
+        # Extensions
+        bbox: Optional[BBox] = None,
+        datetime: Optional[str] = None,
+        limit: Optional[int] = None,
+        token: Optional[str] = None,
+        query: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        sortby: Optional[str] = None,
+        filter_expr: Optional[str] = None,
+        filter_lang: Optional[str] = None,
+        q: Optional[List[str]] = None,
+        **kwargs,
+    ) -> Collections:
+        """Cross catalog search (GET).
+
+        Called with `GET /collections`. As upstream, but paging with tokens
+        (see `app.collection_search`) instead of offsets.
+
+        Returns:
+            Collections which match the search criteria, returns all
+            collections by default.
+        """
+        base_url = get_base_url(request)
+
+        next_link: Optional[Dict[str, Any]] = None
+        prev_link: Optional[Dict[str, Any]] = None
+        collections_result: Optional[Dict[str, Any]]
+
+        if self.extension_is_enabled("CollectionSearchExtension"):
+            base_args = {
+                "bbox": bbox,
+                "limit": limit,
+                "query": orjson.loads(unquote_plus(query)) if query else query,
+            }
+
+            clean_args = self._clean_search_args(
+                base_args=base_args,
+                datetime=datetime,
+                fields=fields,
+                sortby=sortby,
+                filter_query=filter_expr,
+                filter_lang=filter_lang,
+                q=q,
+            )
+
+            collections_result = None
+            if self.collection_catalog is not None:
+                collections_result = await self.collection_catalog.search(
+                    request, clean_args, token
+                )
+            if collections_result is None:
+                async with request.app.state.get_connection(request, "r") as conn:
+                    collections_result = await collection_page(conn, clean_args, token)
+
+            if collections_result["next"] is not None:
+                next_link = {"body": {"token": f"next:{collections_result['next']}"}}
+            if collections_result["prev"] is not None:
+                prev_link = {"body": {"token": f"prev:{collections_result['prev']}"}}
+
+        else:
+            async with request.app.state.get_connection(request, "r") as conn:
+                cols = await conn.fetchval(
+                    """
+                    SELECT * FROM all_collections();
+                    """
+                )
+                collections_result = {"collections": cols, "links": []}
+
+        linked_collections: List[Collection] = []
+        collections = collections_result["collections"]
+        if collections is not None and len(collections) > 0:
+            for c in collections:
+                coll = Collection(**c)
+                coll["links"] = await CollectionLinks(
+                    collection_id=coll["id"], request=request
+                ).get_links(extra_links=coll.get("links"))
+
+                if self.extension_is_enabled(
+                    "FilterExtension"
+                ) or self.extension_is_enabled("ItemCollectionFilterExtension"):
+                    coll["links"].append(
+                        {
+                            "rel": Relations.queryables.value,
+                            "type": MimeTypes.jsonschema.value,
+                            "title": "Queryables",
+                            "href": urljoin(
+                                base_url, f"collections/{coll['id']}/queryables"
+                            ),
+                        }
+                    )
+
+                linked_collections.append(coll)
+
+        links = await CollectionSearchPagingLinks(
+            request=request,
+            next=next_link,
+            prev=prev_link,
+        ).get_links()
+
+        result = Collections(
+            collections=linked_collections or [],
+            links=links,
+            numberReturned=collections_result.get(
+                "numberReturned", len(linked_collections)
+            ),
+        )
+        # Only counted by pgstac on the first page, to keep later pages cheap
+        if "numberMatched" in collections_result:
+            result["numberMatched"] = collections_result["numberMatched"]
+        return result
+
+    async def get_item(
+        self, item_id: str, collection_id: str, request: Request, **kwargs
+    ) -> Item:
+        """Get item by id.
+
+        Called with `GET /collections/{collection_id}/items/{item_id}`. As
+        upstream, without pass-through as the item is returned as a dict.
+        """
+        # If collection does not exist, NotFoundError wil be raised
+        await self.get_collection(collection_id, request=request)
+
+        search_request = self.pgstac_search_model(
+            ids=[item_id], collections=[collection_id], limit=1
+        )
+        item_collection = await self._search_base(
+            search_request, request=request, passthrough=False
+        )
+        if not item_collection["features"]:
+            raise NotFoundError(
+                f"Item {item_id} in Collection {collection_id} does not exist."
+            )
+
+        return Item(**item_collection["features"][0])
+
+    def _response(
+        self, request: Request, result: Union[ItemCollection, Response]
+    ) -> Union[ItemCollection, Response]:
+        """Serialize a search page here with pass-through responses.
+
+        FastAPI would otherwise run the result through `jsonable_encoder`,
+        which does not know about `orjson.Fragment`s.
+        """
+        settings: Settings = request.app.state.settings
+        if isinstance(result, Response) or not settings.passthrough_responses:
+            return result
+        started = time.perf_counter()
+        response = GeoJSONResponse(result)
+        record_timing("serialize", time.perf_counter() - started)
+        return response
+
+    async def export_search(
+        self, search_request: PgstacSearch, request: Request
+    ) -> StreamingResponse:
+        """Stream every item matching the search, one JSON object per line.
+
+        Called with `POST /search/export`. The search body is that of
+        `POST /search`; `limit` and `token` are ignored, as the export pages
+        through pgstac itself, `export_page_size` items at a time. The first
+        page is fetched before the response starts, so that an invalid search
+        still gets an error status.
+        """
+        settings: Settings = request.app.state.settings
+
+        search_request.conf = search_request.conf or {}
+        search_request.conf["nohydrate"] = settings.use_api_hydrate
+        profile = getattr(search_request, "profile", None)
+        simplify = getattr(search_request, "simplify", None)
+        if profile is not None:
+            search_request.fields = profile_fields(
+                profile, getattr(search_request, "fields", None)
+            )
+        search = orjson.loads(
+            search_request.model_dump_json(
+                exclude_none=True, by_alias=True, exclude=SEARCH_KEYS
+            )
+        )
+        search.pop("token", None)
+        search["limit"] = settings.export_page_size
+
+        try:
+            page = await self._export_page(request, search, simplify)
+        except InvalidDatetimeFormatError as e:
+            raise InvalidQueryParameter(
+                f"Datetime parameter {search_request.datetime} is invalid."
+            ) from e
+
+        fields = getattr(search_request, "fields", None)
+        include: Set[str] = fields.include if fields and fields.include else set()
+        exclude: Set[str] = fields.exclude if fields and fields.exclude else set()
+
+        return StreamingResponse(
+            self._export_lines(request, search, page, include, exclude, simplify),
+            media_type="application/x-ndjson",
+        )
+
+    async def _export_page(
+        self,
+        request: Request,
+        search: Dict[str, Any],
+        simplify: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        return orjson.loads(
+            await self._query_search(request, orjson.dumps(search).decode(), simplify)
+        )
+
+    async def _export_lines(
+        self,
+        request: Request,
+        search: Dict[str, Any],
+        page: Dict[str, Any],
+        include: Set[str],
+        exclude: Set[str],
+        simplify: Optional[float] = None,
+    ) -> AsyncIterator[bytes]:
+        """Yield the items of the search as NDJSON, a page per chunk.
+
+        The next page is only fetched once the server accepted the previous
+        chunk, so a slow client slows the export down rather than growing
+        its memory.
+        """
+        async for features in self.iter_search_pages(
+            request, search, page, include, exclude, simplify
+        ):
+            if features:
+                yield b"\n".join(orjson.dumps(f) for f in features) + b"\n"
+
+    async def iter_search_pages(
+        self,
+        request: Request,
+        search: Dict[str, Any],
+        page: Optional[Dict[str, Any]] = None,
+        include: Optional[Set[str]] = None,
+        exclude: Optional[Set[str]] = None,
+        simplify: Optional[float] = None,
+    ) -> AsyncIterator[List[Item]]:
+        """Yield the items of every page of `search`, starting from `page`.
+
+        `search` is a pgstac search body, its `token` is advanced in place.
+        Items are hydrated and get their links as in `/search`; only one page
+        is held at a time.
+        """
+        settings: Settings = request.app.state.settings
+        include = include or set()
+        exclude = exclude or set()
+        base_item_cache = None
+        if settings.use_api_hydrate:
+
+            async def _get_base_item(collection_id: str) -> Dict[str, Any]:
+                return await self._get_base_item(collection_id, request=request)
+
+            base_item_cache = settings.base_item_cache(
+                fetch_base_item=_get_base_item, request=request
+            )
+
+        if page is None:
+            page = await self._export_page(request, search, simplify)
+        while True:
+            features: List[Item] = []
+            for feature in page.get("features") or []:
+                if base_item_cache is not None:
+                    base_item = await base_item_cache.get(feature.get("collection"))
+                    base_item = {k: v for k, v in base_item.items() if v is not None}
+                    feature = hydrate(base_item, feature)
+                collection_id = feature.get("collection")
+                item_id = feature.get("id")
+                if base_item_cache is not None:
+                    feature = filter_fields(feature, include, exclude)
+                if "links" not in exclude and collection_id and item_id:
+                    feature["links"] = await ItemLinks(
+                        collection_id=collection_id,
+                        item_id=item_id,
+                        request=request,
+                    ).get_links(extra_links=feature.get("links"))
+                features.append(feature)
+            yield features
+
+            next_token = page.get("next")
+            for link in page.get("links", []):
+                if link.get("rel") == "next":
+                    next_token = link.get("href").split("token=next:")[1]
+            if not next_token:
+                return
+            search["token"] = f"next:{next_token}"
+            page = await self._export_page(request, search, simplify)
@@ -0,0 +1,76 @@
+"""How item searches count their matches.
+
+pgstac adds `numberMatched` to a search page according to its `context`
+setting: "off" (no count), "on" (an exact `count(*)`, cached per search
+for `context_stats_ttl`) or "auto" (the planner estimate from `EXPLAIN`,
+past some thresholds). An exact count reads every matching row, which for a
+broad search costs more than the page itself.
+
+The `count` parameter of `/search` and `/collections/{collection_id}/items`
+(or the `NUMBER_MATCHED` setting) picks one of:
+
+- "exact": an exact count,
+- "estimated": the planner estimate, whatever the size of the search,
+- "none": no count.
+
+The pgstac settings are set for the transaction of the `search()` call only,
+and the response says which kind of count it has in `numberMatchedType`.
+"""
+
+from typing import Dict, List, Literal, Optional
+
+import attr
+from fastapi import FastAPI, Query
+from pydantic import BaseModel, Field
+from stac_fastapi.types.extension import ApiExtension
+from stac_fastapi.types.search import APIRequest
+from typing_extensions import Annotated
+
+CountMode = Literal["exact", "estimated", "none"]
+
+# pgstac `context` of each mode
+CONTEXT: Dict[str, str] = {"exact": "on", "estimated": "auto", "none": "off"}
+
+# With both thresholds at 0, "auto" always returns the estimate
+COUNT_SETTINGS_SQL = """
+SELECT
+    set_config('pgstac.context', $1, true),
+    set_config('pgstac.context_estimated_count', '0', true),
+    set_config('pgstac.context_estimated_cost', '0', true);
+"""
+
+
+@attr.s
+class CountExtensionGetRequest(APIRequest):
+    """Count mode for GET requests."""
+
+    count: Annotated[
+        Optional[CountMode],
+        Query(description="How to count the matches: exact, estimated or none."),
+    ] = attr.ib(default=None)
+
+
+class CountExtensionPostRequest(BaseModel):
+    """Count mode for POST requests."""
+
+    count: Optional[CountMode] = Field(
+        None, description="How to count the matches: exact, estimated or none."
+    )
+
+
+@attr.s
+class CountExtension(ApiExtension):
+    """Count extension.
+
+    Adds the `count` parameter to item searches.
+    """
+
+    GET = CountExtensionGetRequest
+    POST = CountExtensionPostRequest
+
+    conformance_classes: List[str] = attr.ib(factory=list)
+    schema_href: Optional[str] = attr.ib(default=None)
+
+    def register(self, app: FastAPI) -> None:
+        """Register the extension with a FastAPI application."""
+        pass
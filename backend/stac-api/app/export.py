@@ -0,0 +1,45 @@
+"""Streaming export of search results."""
+
+from typing import List, Optional, Type
+
+import attr
+from fastapi import APIRouter, FastAPI
+from stac_fastapi.api.routes import create_async_endpoint
+from stac_fastapi.types.extension import ApiExtension
+from stac_fastapi.types.search import BaseSearchPostRequest
+
+from app.core import CoreCrudClient
+
+
+@attr.s
+class ExportExtension(ApiExtension):
+    """Export extension.
+
+    Adds `POST /search/export`, which takes the body of `POST /search` and
+    streams every matching item as newline-delimited JSON
+    (`application/x-ndjson`), instead of one page per request.
+    """
+
+    client: CoreCrudClient = attr.ib()
+    search_post_request_model: Type[BaseSearchPostRequest] = attr.ib()
+    conformance_classes: List[str] = attr.ib(factory=list)
+    schema_href: Optional[str] = attr.ib(default=None)
+
+    def register(self, app: FastAPI) -> None:
+        """Register the extension with a FastAPI application."""
+        router = APIRouter(prefix=app.state.router_prefix)
+        router.add_api_route(
+            name="Export Search",
+            path="/search/export",
+            methods=["POST"],
+            endpoint=create_async_endpoint(
+                self.client.export_search, self.search_post_request_model
+            ),
+            responses={
+                200: {
+                    "content": {"application/x-ndjson": {}},
+                    "description": "Every matching item, one per line.",
+                }
+            },
+        )
+        app.include_router(router, tags=["Export Extension"])
@@ -0,0 +1,263 @@
+"""stac-geoparquet export of collections and search results.
+
+The items are paged out of pgstac and handed to `stac_geoparquet` one page
+(one row group's worth) at a time, with the `ChunksToDisk` schema strategy,
+so memory stays bounded whatever the collection size. Whole-collection files
+are cached on disk, shared by the workers, until a transaction touches the
+collection or `ttl` seconds pass (for writes that bypass the API).
+
+Needs `stac-geoparquet` (and so `pyarrow`) installed alongside the API.
+"""
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Type
+
+import attr
+import orjson
+from anyio import from_thread
+from fastapi import APIRouter, FastAPI, Request
+from stac_fastapi.api.routes import create_async_endpoint
+from stac_fastapi.types.errors import NotFoundError
+from stac_fastapi.types.extension import ApiExtension
+from stac_fastapi.types.search import BaseSearchPostRequest
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse
+
+from stac_fastapi.pgstac.config import Settings
+from stac_fastapi.pgstac.types.search import PgstacSearch
+
+from app.core import CoreCrudClient
+from app.profiles import SEARCH_KEYS
+
+MEDIA_TYPE = "application/vnd.apache.parquet"
+
+
+class GeoParquetCache:
+    """Whole-collection GeoParquet files, in a directory shared by workers.
+
+    Invalidating a collection deletes its file and touches a marker, so a
+    build that started before the write is not stored once it completes.
+    """
+
+    def __init__(self, directory: str, ttl: float) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _path(self, collection_id: str, suffix: str) -> Path:
+        digest = hashlib.blake2b(collection_id.encode(), digest_size=16).hexdigest()
+        return self.directory / f"{digest}{suffix}"
+
+    def get(self, collection_id: str) -> Optional[Path]:
+        path = self._path(collection_id, ".parquet")
+        try:
+            if time.time() - path.stat().st_mtime < self.ttl:
+                return path
+        except FileNotFoundError:
+            pass
+        return None
+
+    def lock(self, collection_id: str) -> asyncio.Lock:
+        """Lock serializing builds of one collection within this worker."""
+        return self._locks.setdefault(collection_id, asyncio.Lock())
+
+    def new_file(self) -> Path:
+        fd, name = tempfile.mkstemp(suffix=".parquet.tmp", dir=self.directory)
+        os.close(fd)
+        return Path(name)
+
+    def store(self, collection_id: str, path: Path, started: float) -> Path:
+        """Move a finished build in place, unless invalidated since `started`.
+
+        Returns the path to serve the build from.
+        """
+        try:
+            invalidated = self._path(collection_id, ".invalidated").stat().st_mtime
+        except FileNotFoundError:
+            invalidated = 0.0
+        if invalidated >= started:
+            return path
+        target = self._path(collection_id, ".parquet")
+        os.replace(path, target)
+        return target
+
+    async def invalidate(self, collection_id: Optional[str]) -> None:
+        """Drop the file of `collection_id`, or every file if None."""
+        if collection_id is None:
+            paths = list(self.directory.glob("*.parquet"))
+        else:
+            paths = [self._path(collection_id, ".parquet")]
+            self._path(collection_id, ".invalidated").touch()
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+
+def write_geoparquet(
+    pages: Iterator[List[Dict[str, Any]]],
+    path: Path,
+    collections: Optional[Dict[str, Any]] = None,
+    chunk_size: int = 1000,
+) -> None:
+    """Write the items of `pages` to `path`, in the calling thread."""
+    from stac_geoparquet.arrow import parse_stac_items_to_parquet
+
+    items = (item for page in pages for item in page)
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmpdir:
+        parse_stac_items_to_parquet(
+            items,
+            chunk_size=chunk_size,
+            schema="ChunksToDisk",
+            output_path=path,
+            tmpdir=tmpdir,
+            collections=collections,
+        )
+
+
+@attr.s
+class GeoParquetExtension(ApiExtension):
+    """GeoParquet export extension.
+
+    Adds `GET /collections/{collection_id}/items.parquet`, the whole
+    collection (cached), and `POST /search/export.parquet`, the result of a
+    `POST /search` body, as stac-geoparquet files.
+    """
+
+    client: CoreCrudClient = attr.ib()
+    search_post_request_model: Type[BaseSearchPostRequest] = attr.ib()
+    cache: GeoParquetCache = attr.ib()
+    conformance_classes: List[str] = attr.ib(factory=list)
+    schema_href: Optional[str] = attr.ib(default=None)
+
+    async def collection_parquet(
+        self, collection_id: str, request: Request
+    ) -> FileResponse:
+        """Every item of a collection, as stac-geoparquet."""
+        collection = await self.client.get_collection(collection_id, request=request)
+        filename = f"{collection_id}.parquet"
+
+        path = self.cache.get(collection_id)
+        if path is None:
+            async with self.cache.lock(collection_id):
+                path = self.cache.get(collection_id)
+                if path is None:
+                    started = time.time()
+                    path = self.cache.new_file()
+                    try:
+                        await self._write(
+                            request,
+                            {"collections": [collection_id]},
+                            path,
+                            {collection_id: collection},
+                        )
+                    except BaseException:
+                        path.unlink(missing_ok=True)
+                        raise
+                    path = self.cache.store(collection_id, path, started)
+
+        if path.name.endswith(".tmp"):
+            # Built from a snapshot invalidated meanwhile, serve it once
+            return FileResponse(
+                path,
+                media_type=MEDIA_TYPE,
+                filename=filename,
+                background=BackgroundTask(path.unlink, missing_ok=True),
+            )
+        return FileResponse(path, media_type=MEDIA_TYPE, filename=filename)
+
+    async def search_parquet(
+        self, search_request: PgstacSearch, request: Request
+    ) -> FileResponse:
+        """Every item matching a search, as stac-geoparquet (not cached)."""
+        # Always whole items, response profiles do not apply
+        search = orjson.loads(
+            search_request.model_dump_json(
+                exclude_none=True, by_alias=True, exclude=SEARCH_KEYS
+            )
+        )
+        path = self.cache.new_file()
+        try:
+            await self._write(request, search, path)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        return FileResponse(
+            path,
+            media_type=MEDIA_TYPE,
+            filename="search.parquet",
+            background=BackgroundTask(path.unlink, missing_ok=True),
+        )
+
+    async def _write(
+        self,
+        request: Request,
+        search: Dict[str, Any],
+        path: Path,
+        collections: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Page `search` out of pgstac into a GeoParquet file at `path`.
+
+        The writer runs in a worker thread, pulling each page from the event
+        loop only once it is done with the previous one.
+        """
+        settings: Settings = request.app.state.settings
+        search.pop("token", None)
+        search["limit"] = settings.export_page_size
+        search.setdefault("conf", {})["nohydrate"] = settings.use_api_hydrate
+
+        pages = self.client.iter_search_pages(request, search)
+        first = await anext(pages)
+        if not first:
+            await pages.aclose()
+            raise NotFoundError("No items to export.")
+
+        def sync_pages() -> Iterator[List[Dict[str, Any]]]:
+            yield first
+            while True:
+                try:
+                    yield from_thread.run(anext, pages)
+                except StopAsyncIteration:
+                    return
+
+        try:
+            await run_in_threadpool(
+                write_geoparquet,
+                sync_pages(),
+                path,
+                collections,
+                settings.export_page_size,
+            )
+        finally:
+            await pages.aclose()
+
+    def register(self, app: FastAPI) -> None:
+        """Register the extension with a FastAPI application."""
+        app.state.invalidation_listeners = [
+            *getattr(app.state, "invalidation_listeners", []),
+            self.cache.invalidate,
+        ]
+
+        router = APIRouter(prefix=app.state.router_prefix)
+        router.add_api_route(
+            name="Collection GeoParquet",
+            path="/collections/{collection_id}/items.parquet",
+            methods=["GET"],
+            endpoint=self.collection_parquet,
+            responses={200: {"content": {MEDIA_TYPE: {}}}},
+        )
+        router.add_api_route(
+            name="Search GeoParquet",
+            path="/search/export.parquet",
+            methods=["POST"],
+            endpoint=create_async_endpoint(
+                self.search_parquet, self.search_post_request_model
+            ),
+            responses={200: {"content": {MEDIA_TYPE: {}}}},
+        )
+        app.include_router(router, tags=["GeoParquet Extension"])
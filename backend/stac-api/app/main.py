@@ -6,11 +6,12 @@ If the variable is not set, enables all extensions.
 """
 
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
-from brotli_asgi import BrotliMiddleware
-from fastapi import FastAPI
-from fastapi.responses import ORJSONResponse
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from stac_fastapi.api.app import StacApi
 from stac_fastapi.api.middleware import CORSMiddleware, ProxyHeaderMiddleware
 from stac_fastapi.api.models import (
@@ -26,7 +27,6 @@ from stac_fastapi.extensions.core import (
     FieldsExtension,
     FreeTextExtension,
     ItemCollectionFilterExtension,
-    OffsetPaginationExtension,
     SearchFilterExtension,
     SortExtension,
     TokenPaginationExtension,
@@ -39,24 +39,52 @@ from stac_fastapi.extensions.core.sort import SortConformanceClasses
 from stac_fastapi.extensions.third_party import BulkTransactionExtension
 from starlette.middleware import Middleware
 
-from stac_fastapi.pgstac.core import CoreCrudClient
 from stac_fastapi.pgstac.db import close_db_connection, connect_to_db
 from stac_fastapi.pgstac.extensions import QueryExtension
-from stac_fastapi.pgstac.extensions.filter import FiltersClient
-from stac_fastapi.pgstac.transactions import BulkTransactionsClient, TransactionsClient
 from stac_fastapi.pgstac.types.search import PgstacSearch
 
+from app import routes
+from app.admission import AdmissionControlMiddleware
+from app.aggregation import AggregationExtension
+from app.cache import MemoryCacheBackend, ResponseCacheMiddleware
+from app.cache_backends import create_cache_backend
+from app.catalog import CollectionCatalog
+from app.coalesce import SingleFlight
+from app.compression import CompressionMiddleware
+from app.conditional import ConditionalGetMiddleware
+from app.core import CoreCrudClient
+from app.counts import CountExtension
+from app.export import ExportExtension
+from app.geoparquet import GeoParquetCache, GeoParquetExtension
+from app.metrics import Metrics, MetricsMiddleware, TimedRoute, get_connection
+from app.pool import PoolSizer, warm_up
+from app.profiles import ProfileExtension
+from app.queryables import CachedFiltersClient, QueryablesCache
 from app.settings import Settings
+from app.slow_queries import SlowQueryLog
+from app.tiles import TileCache, TilesExtension
+from app.transactions import BulkTransactionsClient, TransactionsClient
+from app.viewport import ViewportSnap
 
 settings = Settings()
 
+# queryables, precomputed and served from memory
+queryables_cache = None
+if settings.queryables_cache_enabled:
+    queryables_cache = QueryablesCache(
+        refresh_interval=settings.queryables_refresh_interval
+    )
+filters_client = CachedFiltersClient(cache=queryables_cache)
+
 # search extensions
 search_extensions_map = {
     "query": QueryExtension(),
     "sort": SortExtension(),
     "fields": FieldsExtension(),
-    "filter": SearchFilterExtension(client=FiltersClient()),
+    "filter": SearchFilterExtension(client=filters_client),
     "pagination": TokenPaginationExtension(),
+    "profile": ProfileExtension(),
+    "count": CountExtension(),
 }
 
 # collection_search extensions
@@ -66,11 +94,12 @@ cs_extensions_map = {
     "fields": FieldsExtension(
         conformance_classes=[FieldsConformanceClasses.COLLECTIONS]
     ),
-    "filter": CollectionSearchFilterExtension(client=FiltersClient()),
+    "filter": CollectionSearchFilterExtension(client=filters_client),
     "free_text": FreeTextExtension(
         conformance_classes=[FreeTextConformanceClasses.COLLECTIONS],
     ),
-    "pagination": OffsetPaginationExtension(),
+    # keyset pagination, see app.collection_search
+    "pagination": TokenPaginationExtension(),
 }
 
 # item_collection extensions
@@ -82,8 +111,10 @@ itm_col_extensions_map = {
         conformance_classes=[SortConformanceClasses.ITEMS],
     ),
     "fields": FieldsExtension(conformance_classes=[FieldsConformanceClasses.ITEMS]),
-    "filter": ItemCollectionFilterExtension(client=FiltersClient()),
+    "filter": ItemCollectionFilterExtension(client=filters_client),
     "pagination": TokenPaginationExtension(),
+    "profile": ProfileExtension(),
+    "count": CountExtension(),
 }
 
 enabled_extensions = {
@@ -151,12 +182,224 @@ if "collection_search" in enabled_extensions:
     application_extensions.append(collection_search_extension)
 
 
+# response cache (opt-in)
+response_cache = None
+if settings.response_cache_enabled:
+    response_cache = create_cache_backend(settings)
+
+# viewport-snapped searches (opt-in), with their tiles in the response cache
+# when it is enabled
+viewport_snap = None
+viewport_cache = None
+if settings.viewport_snap_enabled:
+    if response_cache is None:
+        viewport_cache = MemoryCacheBackend(
+            max_bytes=settings.response_cache_max_bytes,
+            max_entry_bytes=settings.response_cache_max_entry_bytes,
+        )
+    viewport_snap = ViewportSnap(
+        response_cache or viewport_cache,
+        max_tiles=settings.viewport_snap_max_tiles,
+        max_zoom=settings.viewport_snap_max_zoom,
+        ttl=settings.viewport_snap_ttl,
+    )
+
+# in-memory collection catalog (opt-in)
+collection_catalog = None
+if settings.collection_catalog_enabled:
+    collection_catalog = CollectionCatalog(
+        refresh_interval=settings.collection_catalog_refresh_interval
+    )
+
+client = CoreCrudClient(
+    pgstac_search_model=post_request_model,
+    single_flight=SingleFlight() if settings.search_single_flight else None,
+    slow_queries=(
+        SlowQueryLog(
+            settings.slow_query_threshold,
+            explain_sample_rate=settings.slow_query_explain_sample_rate,
+            log_file=settings.slow_query_log_file,
+        )
+        if settings.slow_query_threshold is not None
+        else None
+    ),
+    viewport_snap=viewport_snap,
+    collection_catalog=collection_catalog,
+)
+
+# /search/export
+if settings.export_enabled:
+    application_extensions.append(
+        ExportExtension(client=client, search_post_request_model=post_request_model)
+    )
+
+# GeoParquet export (opt-in)
+if settings.geoparquet_enabled:
+    application_extensions.append(
+        GeoParquetExtension(
+            client=client,
+            search_post_request_model=post_request_model,
+            cache=GeoParquetCache(
+                settings.geoparquet_cache_dir
+                or os.path.join(tempfile.gettempdir(), "stac-api-geoparquet"),
+                ttl=settings.geoparquet_cache_ttl,
+            ),
+        )
+    )
+
+# aggregations, with their results in the response cache when it is enabled
+aggregation_cache = None
+if settings.aggregation_enabled:
+    if response_cache is None:
+        aggregation_cache = MemoryCacheBackend(
+            max_bytes=settings.response_cache_max_bytes,
+            max_entry_bytes=settings.response_cache_max_entry_bytes,
+        )
+    application_extensions.append(
+        AggregationExtension(
+            client=client,
+            cache=response_cache or aggregation_cache,
+            extensions=[
+                extension
+                for key, extension in search_extensions_map.items()
+                if key in ("query", "filter") and key in enabled_extensions
+            ],
+            ttl=settings.aggregation_cache_ttl,
+            max_zoom=settings.aggregation_max_zoom,
+            max_buckets=settings.aggregation_max_buckets,
+        )
+    )
+
+# footprint vector tiles
+if settings.tiles_enabled:
+    application_extensions.append(
+        TilesExtension(
+            cache=TileCache(
+                settings.tiles_cache_max_bytes, ttl=settings.tiles_cache_ttl
+            ),
+            max_zoom=settings.tiles_max_zoom,
+            max_features=settings.tiles_max_features,
+            cache_control=settings.tiles_cache_control,
+        )
+    )
+
+# metrics (opt-in)
+metrics = Metrics() if settings.metrics_enabled else None
+
+# admission control, innermost so that cache hits are not queued
+admission_middlewares = []
+if settings.admission_control_enabled:
+    admission_middlewares.append(
+        Middleware(
+            AdmissionControlMiddleware,
+            max_concurrency=settings.admission_max_concurrency,
+            client_concurrency=settings.admission_client_concurrency,
+            client_rate=settings.admission_client_rate,
+            client_burst=settings.admission_client_burst,
+            queue_size=settings.admission_queue_size,
+            client_queue_size=settings.admission_client_queue_size,
+            queue_timeout=settings.admission_queue_timeout,
+            api_key_header=settings.admission_api_key_header,
+            trust_forwarded_for=settings.admission_trust_forwarded_for,
+            metrics=metrics,
+        )
+    )
+
+# response cache middleware
+cache_middlewares = []
+if response_cache is not None:
+    # NOTE listed early, so it ends up inside (below compression)
+    cache_middlewares.append(
+        Middleware(
+            ResponseCacheMiddleware,
+            cache=response_cache,
+            ttls={
+                routes.SEARCH: settings.response_cache_search_ttl,
+                routes.ITEMS: settings.response_cache_search_ttl,
+                routes.ITEM: settings.response_cache_search_ttl,
+                routes.COLLECTIONS: settings.response_cache_collections_ttl,
+                routes.COLLECTION: settings.response_cache_collections_ttl,
+                routes.QUERYABLES: settings.response_cache_queryables_ttl,
+            },
+        )
+    )
+
+# conditional GET, outside the cache so cached responses get validators too
+conditional_middlewares = []
+if settings.conditional_get_enabled:
+    conditional_middlewares.append(
+        Middleware(
+            ConditionalGetMiddleware,
+            cache_control={
+                routes.COLLECTIONS: settings.cache_control_collections,
+                routes.COLLECTION: settings.cache_control_collections,
+                routes.ITEM: settings.cache_control_items,
+                routes.ITEMS: settings.cache_control_search,
+                routes.SEARCH: settings.cache_control_search,
+                routes.QUERYABLES: settings.cache_control_queryables,
+            },
+        )
+    )
+
+# metrics and Server-Timing, outermost so that they include compression
+timing_middlewares = []
+if settings.metrics_enabled or settings.server_timing_enabled:
+    timing_middlewares.append(
+        Middleware(
+            MetricsMiddleware,
+            metrics=metrics,
+            server_timing=settings.server_timing_enabled,
+        )
+    )
+
+# compression of large bodies, off the event loop
+compression_executor = ThreadPoolExecutor(
+    max_workers=settings.compression_workers, thread_name_prefix="compression"
+)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """FastAPI Lifespan."""
-    await connect_to_db(app)
+    await connect_to_db(app, get_conn=get_connection)
+    pools = {"readpool": app.state.readpool, "writepool": app.state.writepool}
+    if metrics is not None:
+        metrics.pools = pools
+    if settings.db_warmup_enabled:
+        await warm_up(
+            app.state.readpool,
+            searches=settings.db_warmup_searches,
+            split=settings.passthrough_responses and not settings.use_api_hydrate,
+            timeout=settings.db_warmup_timeout,
+        )
+    app.state.pool_sizers = {}
+    if settings.db_pool_adaptive:
+        app.state.pool_sizers = {
+            name: PoolSizer(
+                pool,
+                interval=settings.db_pool_adapt_interval,
+                wait_threshold=settings.db_pool_wait_threshold,
+                step=settings.db_pool_grow_step,
+            )
+            for name, pool in pools.items()
+        }
+        for sizer in app.state.pool_sizers.values():
+            sizer.start()
+        if metrics is not None:
+            metrics.pool_sizers = app.state.pool_sizers
+    if collection_catalog is not None:
+        async with app.state.readpool.acquire() as conn:
+            await collection_catalog.load(conn)
+    if queryables_cache is not None:
+        async with app.state.readpool.acquire() as conn:
+            await queryables_cache.load(conn)
     yield
+    for sizer in app.state.pool_sizers.values():
+        await sizer.stop()
     await close_db_connection(app)
+    compression_executor.shutdown(wait=False)
+    if app.state.response_cache is not None:
+        await app.state.response_cache.close()
 
 
 api = StacApi(
@@ -171,24 +414,76 @@ api = StacApi(
         lifespan=lifespan,
     ),
     settings=settings,
+    router=APIRouter(route_class=TimedRoute),
     extensions=application_extensions,
-    client=CoreCrudClient(pgstac_search_model=post_request_model),
+    client=client,
     response_class=ORJSONResponse,
     items_get_request_model=items_get_request_model,
     search_get_request_model=get_request_model,
     search_post_request_model=post_request_model,
     collections_get_request_model=collections_get_request_model,
     middlewares=[
-        Middleware(BrotliMiddleware),
+        *admission_middlewares,
+        *cache_middlewares,
+        *conditional_middlewares,
+        Middleware(
+            CompressionMiddleware,
+            minimum_size=settings.compression_minimum_size,
+            offload_size=settings.compression_offload_size,
+            executor=compression_executor,
+        ),
         Middleware(ProxyHeaderMiddleware),
         Middleware(
             CORSMiddleware,
             allow_origins=settings.cors_origins,
             allow_methods=settings.cors_methods,
         ),
+        *timing_middlewares,
     ],
 )
 app = api.app
+app.state.response_cache = response_cache
+app.state.metrics = metrics
+if viewport_cache is not None:
+    app.state.invalidation_listeners = [
+        *getattr(app.state, "invalidation_listeners", []),
+        viewport_cache.invalidate,
+    ]
+if aggregation_cache is not None:
+    app.state.invalidation_listeners = [
+        *getattr(app.state, "invalidation_listeners", []),
+        aggregation_cache.invalidate,
+    ]
+if queryables_cache is not None:
+    app.state.invalidation_listeners = [
+        *getattr(app.state, "invalidation_listeners", []),
+        queryables_cache.invalidate,
+    ]
+if collection_catalog is not None:
+    app.state.invalidation_listeners = [
+        *getattr(app.state, "invalidation_listeners", []),
+        collection_catalog.invalidate,
+    ]
+
+if response_cache is not None:
+
+    @app.get("/_mgmt/cache", include_in_schema=False)
+    async def response_cache_stats():
+        """Response cache hit/miss counters, per route."""
+        return {
+            "backend": settings.response_cache_backend,
+            "routes": await response_cache.stats(),
+        }
+
+
+if metrics is not None:
+
+    @app.get("/metrics", include_in_schema=False, response_class=PlainTextResponse)
+    async def prometheus_metrics():
+        """Request, database pool and response size metrics."""
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
 
 
 def run():
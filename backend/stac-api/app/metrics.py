@@ -0,0 +1,370 @@
+"""Request metrics in the Prometheus text format, and Server-Timing headers.
+
+Time spent in a request is split into phases, recorded against the request
+through a context variable:
+
+- `db-wait`: waiting for a connection from the asyncpg pool,
+- `db`: holding a connection (running queries),
+- `serialize`: turning the endpoint's return value into the response body,
+- `compress`: compressing the response body.
+
+The registry is kept per process; with several uvicorn workers each scrape
+sees the worker that happened to answer it.
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Iterable,
+    Literal,
+    Optional,
+)
+
+from asyncpg import Connection, Pool
+from fastapi import Request
+from fastapi.routing import APIRoute
+from starlette.responses import Response
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from stac_fastapi.pgstac.db import get_connection as _get_connection
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = tuple(float(4**n) for n in range(4, 14))  # 256 B to 64 MiB
+
+PHASES = ("db-wait", "db", "serialize", "compress")
+
+_timings: ContextVar[Optional[dict[str, float]]] = ContextVar("timings", default=None)
+
+
+def record_timing(phase: str, seconds: float) -> None:
+    """Add `seconds` to `phase` of the current request, if it is timed."""
+    timings = _timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = (
+        '{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+    """Cumulative histogram, one series per combination of label values."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._series: dict[tuple[str, ...], list[Any]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> Iterable[str]:
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield "{}_bucket{} {}".format(
+                    self.name,
+                    _labels((*self.labels, "le"), (*label_values, le)),
+                    cumulative,
+                )
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total!r}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """Gauge whose values are read by a callback at scrape time."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...],
+        collect: Callable[[], Iterable[tuple[tuple[str, ...], float]]],
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for label_values, value in self.collect():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value!r}"
+
+
+class Counter(Gauge):
+    """Counter whose values are read by a callback at scrape time."""
+
+    type = "counter"
+
+
+class Metrics:
+    """The metrics of one application."""
+
+    def __init__(self) -> None:
+        # asyncpg pools reported by name, set once they are open
+        self.pools: dict[str, Pool] = {}
+        # targets of the pools' sizers (see `app.pool`), by pool name
+        self.pool_sizers: dict[str, Any] = {}
+        self.request_duration = Histogram(
+            "stac_api_request_duration_seconds",
+            "Time until the response starts, per route.",
+            ("method", "route", "status"),
+        )
+        self.request_phase = Histogram(
+            "stac_api_request_phase_seconds",
+            "Time spent per request in each phase (db-wait, db, serialize, compress).",
+            ("route", "phase"),
+        )
+        self.response_size = Histogram(
+            "stac_api_response_size_bytes",
+            "Response body size as sent, after compression.",
+            ("route",),
+            buckets=SIZE_BUCKETS,
+        )
+        self.pool_checkout = Histogram(
+            "stac_api_db_pool_checkout_seconds",
+            "Time waiting for a connection from the asyncpg pool.",
+            ("pool",),
+        )
+        self.pool_connections = Gauge(
+            "stac_api_db_pool_connections",
+            "Connections of the asyncpg pools, by state.",
+            ("pool", "state"),
+            self._collect_pools,
+        )
+        self.metrics = [
+            self.request_duration,
+            self.request_phase,
+            self.response_size,
+            self.pool_checkout,
+            self.pool_connections,
+        ]
+
+    def _collect_pools(self) -> Iterable[tuple[tuple[str, ...], float]]:
+        for name, pool in self.pools.items():
+            size, idle = pool.get_size(), pool.get_idle_size()
+            yield (name, "in_use"), size - idle
+            yield (name, "idle"), idle
+            yield (name, "max"), pool.get_max_size()
+            sizer = self.pool_sizers.get(name)
+            if sizer is not None:
+                yield (name, "target"), sizer.target
+
+    def register(self, metric: Any) -> None:
+        """Add a metric reported by another component."""
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+@asynccontextmanager
+async def get_connection(
+    request: Request,
+    readwrite: Literal["r", "w"] = "r",
+) -> AsyncIterator[Connection]:
+    """`stac_fastapi.pgstac.db.get_connection`, timing checkout and use."""
+    metrics: Optional[Metrics] = getattr(request.app.state, "metrics", None)
+    requested = time.perf_counter()
+    async with _get_connection(request, readwrite) as conn:
+        acquired = time.perf_counter()
+        record_timing("db-wait", acquired - requested)
+        name = "writepool" if readwrite == "w" else "readpool"
+        if metrics is not None:
+            metrics.pool_checkout.observe(acquired - requested, name)
+        sizer = getattr(request.app.state, "pool_sizers", {}).get(name)
+        if sizer is not None:
+            sizer.observe(acquired - requested)
+        try:
+            yield conn
+        finally:
+            record_timing("db", time.perf_counter() - acquired)
+
+
+class TimedRoute(APIRoute):
+    """Route recording the time between the endpoint returning and the
+    response being ready, as the `serialize` phase.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs) -> None:
+        super().__init__(path, endpoint, **kwargs)
+        call = self.dependant.call
+
+        async def timed_call(*args, **kwargs):
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                timings = _timings.get()
+                if timings is not None:
+                    timings["_returned"] = time.perf_counter()
+
+        # Only the dependant's call is swapped, the signature FastAPI
+        # inspected stays that of the original endpoint
+        if asyncio.iscoroutinefunction(call):
+            self.dependant.call = timed_call
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            response = await handler(request)
+            timings = _timings.get()
+            if timings is not None and "_returned" in timings:
+                record_timing(
+                    "serialize", time.perf_counter() - timings.pop("_returned")
+                )
+            return response
+
+        return timed_handler
+
+
+class MetricsMiddleware:
+    """Time requests, and report them to `metrics` and/or as Server-Timing.
+
+    Must be the outermost middleware, so that compression is included.
+    """
+
+    def __init__(
+        self, app: ASGIApp, metrics: Optional[Metrics], server_timing: bool
+    ) -> None:
+        self.app = app
+        self.metrics = metrics
+        self.server_timing = server_timing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: dict[str, float] = {}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings["total"] = time.perf_counter() - start
+                if self.server_timing:
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"server-timing", _server_timing(timings)),
+                        ],
+                    }
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timings.reset(token)
+            if self.metrics is not None:
+                self._observe(scope, status, size, timings, start)
+
+    def _observe(
+        self,
+        scope: Scope,
+        status: int,
+        size: int,
+        timings: dict[str, float],
+        start: float,
+    ) -> None:
+        route_path = _route_template(scope)
+        self.metrics.request_duration.observe(
+            timings.get("total", time.perf_counter() - start),
+            scope["method"],
+            route_path,
+            str(status),
+        )
+        for phase in PHASES:
+            if phase in timings:
+                self.metrics.request_phase.observe(timings[phase], route_path, phase)
+        self.metrics.response_size.observe(float(size), route_path)
+
+
+def _route_template(scope: Scope) -> str:
+    """Path template of the route that handled the request.
+
+    FastAPI only records its own routes in the scope; plain Starlette ones
+    (e.g. the OpenAPI document) are looked up again. Unmatched paths are
+    lumped together, to bound the label values.
+    """
+    route = scope.get("route")
+    if route is None and "endpoint" in scope and "app" in scope:
+        route = next(
+            (
+                candidate
+                for candidate in scope["app"].router.routes
+                if candidate.matches(scope)[0] == Match.FULL
+            ),
+            None,
+        )
+    return getattr(route, "path", None) or "unmatched"
+
+
+def _server_timing(timings: dict[str, float]) -> bytes:
+    return ", ".join(
+        f"{phase};dur={timings[phase] * 1000:.1f}"
+        for phase in (*PHASES, "total")
+        if phase in timings
+    ).encode()
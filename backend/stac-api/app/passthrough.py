@@ -0,0 +1,118 @@
+"""Pass-through serialization of search pages.
+
+pgstac returns each page as one JSON document. By default the API decodes
+it, builds the links of every item with `ItemLinks`, and FastAPI walks the
+result with `jsonable_encoder` before ORJSON serializes it again. With
+pass-through, the page is split in the database into the JSON text of each
+item (without its links), so items are never decoded: their links are
+spliced onto the text, and the text is embedded as-is in the response with
+`orjson.Fragment`.
+"""
+
+from typing import Any, Dict, List, Optional
+from urllib.parse import urljoin
+
+import orjson
+from stac_fastapi.pgstac.models.links import INFERRED_LINK_RELS
+from stac_fastapi.types.requests import get_base_url
+from stac_pydantic.shared import MimeTypes
+from starlette.requests import Request
+
+# `source` yields the page as jsonb, in a column `r`
+SPLIT_PAGE_SQL = """
+SELECT
+    (s.r - 'features')::text AS page,
+    f.features,
+    f.collections,
+    f.ids,
+    f.links
+FROM ({source}) AS s
+CROSS JOIN LATERAL (
+    SELECT
+        array_agg((e - 'links')::text ORDER BY n) AS features,
+        array_agg(e->>'collection' ORDER BY n) AS collections,
+        array_agg(e->>'id' ORDER BY n) AS ids,
+        array_agg((e->'links')::text ORDER BY n) AS links
+    FROM jsonb_array_elements(s.r->'features') WITH ORDINALITY AS t(e, n)
+) AS f;
+"""
+
+
+class ItemLinksBuilder:
+    """The links `ItemLinks` adds to items, without an object per item.
+
+    The links shared by the items of a collection are serialized once.
+    """
+
+    def __init__(self, request: Request) -> None:
+        self.base_url = get_base_url(request)
+        self._root = {
+            "rel": "root",
+            "type": MimeTypes.json.value,
+            "href": self.base_url,
+        }
+        self._collections: Dict[str, List[Dict[str, Any]]] = {}
+
+    def links(
+        self, collection_id: str, item_id: str, stored: Optional[str] = None
+    ) -> bytes:
+        """JSON array of the links of an item, in the order of `ItemLinks`."""
+        shared = self._collections.get(collection_id)
+        if shared is None:
+            href = urljoin(self.base_url, f"collections/{collection_id}")
+            shared = self._collections[collection_id] = [
+                {"rel": "collection", "type": MimeTypes.json.value, "href": href},
+                {"rel": "parent", "type": MimeTypes.json.value, "href": href},
+                self._root,
+            ]
+        links = [
+            *shared,
+            {
+                "rel": "self",
+                "type": MimeTypes.geojson.value,
+                "href": urljoin(
+                    self.base_url, f"collections/{collection_id}/items/{item_id}"
+                ),
+            },
+        ]
+        if stored:
+            links += [
+                {**link, "href": urljoin(self.base_url, link["href"])}
+                for link in orjson.loads(stored)
+                if link["rel"] not in INFERRED_LINK_RELS
+            ]
+        return orjson.dumps(links)
+
+
+def item_fragments(
+    features: List[str],
+    collections: List[Optional[str]],
+    ids: List[Optional[str]],
+    links: List[Optional[str]],
+    builder: ItemLinksBuilder,
+    add_links: bool = True,
+) -> List[orjson.Fragment]:
+    """Items of a split page, with their links, as pre-serialized JSON."""
+    fragments = []
+    for text, collection_id, item_id, stored in zip(features, collections, ids, links):
+        if add_links and collection_id and item_id:
+            fragments.append(
+                orjson.Fragment(
+                    b"".join(
+                        (
+                            text[:-1].encode(),
+                            b', "links": ',
+                            builder.links(collection_id, item_id, stored),
+                            b"}",
+                        )
+                    )
+                )
+            )
+        elif stored:
+            # Not adding links, so put the stored ones back
+            feature = orjson.loads(text)
+            feature["links"] = orjson.loads(stored)
+            fragments.append(orjson.Fragment(orjson.dumps(feature)))
+        else:
+            fragments.append(orjson.Fragment(text))
+    return fragments
@@ -0,0 +1,157 @@
+"""Database pool warm-up and load-adaptive sizing.
+
+After a deploy or a scale-up, the first requests would otherwise pay for
+opening connections, for pgstac loading its functions and settings in each
+new backend, and for asyncpg preparing the statements. `warm_up` does that
+during the lifespan startup, before uvicorn accepts requests (and so before
+the pod reports ready): it holds the pool's minimum connections at once and
+runs representative searches, and a first collection search page, on each.
+
+`PoolSizer` adapts the number of connections kept open between
+`DB_MIN_CONN_SIZE` and `DB_MAX_CONN_SIZE`. asyncpg opens connections on
+demand and closes them after `DB_MAX_INACTIVE_CONN_LIFETIME`, so the
+requests of a burst wait for connection setup. Every `interval` seconds the
+sizer raises its target when checkouts waited longer than `wait_threshold`,
+lowers it by one when the pool had spare connections, and opens connections
+up to the target ahead of demand, as long as no connection is idle (so that
+no request waits on the sizer). Connections above the target are left to
+asyncpg's inactivity timeout.
+"""
+
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from typing import Any, Dict, List, Optional
+
+import orjson
+from asyncpg import Pool
+
+from app.collection_search import collection_page
+from app.core import CoreCrudClient, search_query
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEARCHES: List[Dict[str, Any]] = [
+    {"limit": 10},
+    {"limit": 10, "bbox": [-180, -90, 180, 90]},
+]
+
+
+async def warm_up(
+    pool: Pool,
+    searches: Optional[List[Dict[str, Any]]] = None,
+    split: bool = False,
+    timeout: float = 30,
+) -> None:
+    """Open the minimum connections of `pool` and run `searches` on each.
+
+    `split` runs the searches as pass-through responses do. Errors and
+    timeouts are logged: a cold start is better than none.
+    """
+    searches = DEFAULT_SEARCHES if searches is None else searches
+    queries = [
+        search_query(orjson.dumps(search).decode(), split=split) for search in searches
+    ]
+
+    async def warm(conn: Any) -> None:
+        for q, p in queries:
+            await CoreCrudClient._run_search(conn, q, p, split)
+        await collection_page(conn, {"limit": 10}, None)
+
+    try:
+        async with asyncio.timeout(timeout), AsyncExitStack() as stack:
+            conns = await asyncio.gather(
+                *(
+                    stack.enter_async_context(pool.acquire())
+                    for _ in range(max(1, pool.get_min_size()))
+                ),
+                return_exceptions=True,
+            )
+            for conn in conns:
+                if isinstance(conn, BaseException):
+                    raise conn
+            await asyncio.gather(*(warm(conn) for conn in conns))
+    except Exception:
+        logger.warning("Database warm-up failed", exc_info=True)
+
+
+class PoolSizer:
+    """Keeps a load-adapted number of connections of `pool` open."""
+
+    def __init__(
+        self,
+        pool: Pool,
+        interval: float = 5,
+        wait_threshold: float = 0.005,
+        step: int = 2,
+        connect_timeout: float = 1,
+    ) -> None:
+        self.pool = pool
+        self.interval = interval
+        self.wait_threshold = wait_threshold
+        self.step = step
+        self.connect_timeout = connect_timeout
+        self.target = pool.get_min_size()
+        self._checkouts = 0
+        self._slow = 0
+        self._peak = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def observe(self, wait: float) -> None:
+        """Record a checkout that waited `wait` seconds."""
+        self._checkouts += 1
+        if wait > self.wait_threshold:
+            self._slow += 1
+        in_use = self.pool.get_size() - self.pool.get_idle_size()
+        self._peak = max(self._peak, in_use)
+
+    def adjust(self) -> None:
+        """Move the target according to the checkouts since the last call."""
+        low, high = self.pool.get_min_size(), self.pool.get_max_size()
+        # More than one in ten checkouts waited
+        if self._slow * 10 > self._checkouts:
+            self.target = min(high, max(self.target, self._peak) + self.step)
+        elif self._peak < self.target:
+            self.target = max(low, self.target - 1)
+        self._checkouts = self._slow = self._peak = 0
+
+    async def fill(self) -> None:
+        """Open connections up to the target, while none of them is idle.
+
+        The pool hands out its free connections before opening new ones,
+        so a checkout only opens a connection when none is idle. New
+        connections are held until the target is reached; an existing one
+        taken from a request (released meanwhile) stops the fill.
+        """
+        async with AsyncExitStack() as stack:
+            while self.pool.get_size() < self.target and self.pool.get_idle_size() == 0:
+                size = self.pool.get_size()
+                try:
+                    await stack.enter_async_context(
+                        self.pool.acquire(timeout=self.connect_timeout)
+                    )
+                except asyncio.TimeoutError:
+                    return
+                if self.pool.get_size() <= size:
+                    return
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.adjust()
+            try:
+                await self.fill()
+            except Exception:
+                logger.warning("Could not open pool connections", exc_info=True)
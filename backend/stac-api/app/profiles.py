@@ -0,0 +1,112 @@
+"""Named response profiles for item searches.
+
+A profile is a preset of the fields extension, pushed down to pgstac as
+includes/excludes, so that clients drawing items on a map or in a list only
+get (and the API only hydrates and serializes) what they show. `simplify`
+additionally has PostGIS simplify the returned footprints to a tolerance in
+degrees, and round their coordinates to match.
+
+Profiles apply to `/search` and `/collections/{collection_id}/items`, with
+the `profile` and `simplify` query parameters (GET) or body fields (POST).
+"""
+
+import math
+from typing import Dict, List, Literal, Optional, Set
+
+import attr
+from fastapi import FastAPI, Query
+from pydantic import BaseModel, Field
+from stac_fastapi.extensions.core.fields.request import PostFieldsExtension
+from stac_fastapi.types.extension import ApiExtension
+from stac_fastapi.types.search import APIRequest
+from typing_extensions import Annotated
+
+ProfileName = Literal["lite"]
+
+PROFILES: Dict[str, PostFieldsExtension] = {
+    # What the frontend map and sidebar show
+    "lite": PostFieldsExtension(
+        include={
+            "type",
+            "id",
+            "collection",
+            "bbox",
+            "geometry",
+            "properties.datetime",
+            "properties.start_datetime",
+            "properties.end_datetime",
+            "properties.gsd",
+            "properties.title",
+            "properties.oam:producer_name",
+            "assets.thumbnail",
+        },
+        exclude={"links"},
+    ),
+}
+
+# Search body keys that are handled by the API, not passed on to pgstac
+# (`count` is that of `app.counts`)
+SEARCH_KEYS = {"profile", "simplify", "count"}
+
+
+@attr.s
+class ProfileExtensionGetRequest(APIRequest):
+    """Response profile for GET requests."""
+
+    profile: Annotated[
+        Optional[ProfileName],
+        Query(description="Named subset of the item fields to return."),
+    ] = attr.ib(default=None)
+    simplify: Annotated[
+        Optional[float],
+        Query(gt=0, description="Simplify geometries to this tolerance (degrees)."),
+    ] = attr.ib(default=None)
+
+
+class ProfileExtensionPostRequest(BaseModel):
+    """Response profile for POST requests."""
+
+    profile: Optional[ProfileName] = Field(
+        None, description="Named subset of the item fields to return."
+    )
+    simplify: Optional[float] = Field(
+        None, gt=0, description="Simplify geometries to this tolerance (degrees)."
+    )
+
+
+@attr.s
+class ProfileExtension(ApiExtension):
+    """Response profile extension.
+
+    Adds the `profile` and `simplify` parameters to item searches.
+    """
+
+    GET = ProfileExtensionGetRequest
+    POST = ProfileExtensionPostRequest
+
+    conformance_classes: List[str] = attr.ib(factory=list)
+    schema_href: Optional[str] = attr.ib(default=None)
+
+    def register(self, app: FastAPI) -> None:
+        """Register the extension with a FastAPI application."""
+        pass
+
+
+def profile_fields(
+    profile: Optional[str], fields: Optional[PostFieldsExtension]
+) -> Optional[PostFieldsExtension]:
+    """The `fields` of a search, with those of `profile` added."""
+    if profile is None:
+        return fields
+    preset = PROFILES[profile]
+    include: Set[str] = set(preset.include or ())
+    exclude: Set[str] = set(preset.exclude or ())
+    if fields is not None:
+        include |= fields.include or set()
+        exclude |= fields.exclude or set()
+    return PostFieldsExtension(include=include, exclude=exclude)
+
+
+def simplify_digits(tolerance: float) -> int:
+    """Decimal digits to write geometries simplified to `tolerance` with."""
+    return min(9, max(0, math.ceil(-math.log10(tolerance))) + 1)
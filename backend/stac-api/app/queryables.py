@@ -0,0 +1,155 @@
+"""Precomputed queryables documents, served from memory.
+
+pgstac's `get_queryables()` aggregates the queryables table on every call,
+and the frontend asks for the queryables of a collection each time one is
+selected. Here the documents (global, and of every collection) are built at
+startup and kept serialized, with an ETag, so a request only splices in its
+`$id`. A collection's document is rebuilt after a transaction on it, and
+every document after the queryables table, the `additional_properties`
+setting or the set of collections changes, which is checked at most every
+`refresh_interval` seconds.
+"""
+
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import attr
+import orjson
+from fastapi import Request
+from stac_fastapi.api.models import JSONSchemaResponse
+from stac_fastapi.types.errors import NotFoundError
+from starlette.responses import Response
+
+from stac_fastapi.pgstac.extensions.filter import FiltersClient
+
+QUERYABLES_SQL = """
+SELECT NULL::text AS id, get_queryables(NULL::text) AS queryables
+UNION ALL
+SELECT id, get_queryables(id) FROM collections;
+"""
+
+COLLECTION_QUERYABLES_SQL = "SELECT get_queryables($1::text);"
+
+# Changes whenever a document would: with the queryables table, the
+# `additional_properties` setting, or the set of collections
+FINGERPRINT_SQL = """
+SELECT md5(concat(
+    (SELECT string_agg(q::text, ',' ORDER BY q.id) FROM queryables q),
+    pgstac.additional_properties(),
+    (SELECT string_agg(id, ',' ORDER BY id) FROM collections)
+));
+"""
+
+# The document of a collection (None for the global one): the serialized
+# JSON up to and after the value of `$id`, and a digest of the document
+Document = Tuple[bytes, bytes, bytes]
+
+
+def _document(queryables: Dict[str, Any]) -> Document:
+    body = orjson.dumps({**queryables, "$id": ""})
+    prefix, _, suffix = body.partition(b'"$id":""')
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+    return prefix + b'"$id":', suffix, digest
+
+
+class QueryablesCache:
+    """Serialized queryables documents, per collection."""
+
+    def __init__(self, refresh_interval: float = 60) -> None:
+        self.refresh_interval = refresh_interval
+        self._documents: Dict[Optional[str], Document] = {}
+        self._fingerprint: Optional[str] = None
+        self._checked = -float("inf")
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def load(self, conn: Any) -> None:
+        """Build every document."""
+        generation = self._generation
+        fingerprint = await conn.fetchval(FINGERPRINT_SQL)
+        rows = await conn.fetch(QUERYABLES_SQL)
+        if generation != self._generation:
+            return
+        self._documents = {
+            row["id"]: _document(row["queryables"]) for row in rows if row["queryables"]
+        }
+        self._fingerprint = fingerprint
+        self._checked = time.monotonic()
+
+    async def invalidate(self, collection_id: Optional[str]) -> None:
+        """Rebuild the documents a write to `collection_id` may change."""
+        self._generation += 1
+        if collection_id is None:
+            self._documents = {}
+        else:
+            self._documents.pop(collection_id, None)
+            self._documents.pop(None, None)
+
+    async def get(
+        self, request: Request, collection_id: Optional[str]
+    ) -> Optional[Document]:
+        """The document of `collection_id`, None if it does not exist."""
+        await self._check(request)
+        document = self._documents.get(collection_id)
+        if document is not None:
+            return document
+
+        generation = self._generation
+        async with request.app.state.get_connection(request, "r") as conn:
+            queryables = await conn.fetchval(COLLECTION_QUERYABLES_SQL, collection_id)
+        if not queryables:
+            return None
+        document = _document(queryables)
+        if generation == self._generation:
+            self._documents[collection_id] = document
+        return document
+
+    async def _check(self, request: Request) -> None:
+        """Drop every document if anything they are built from changed."""
+        if time.monotonic() - self._checked < self.refresh_interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._checked < self.refresh_interval:
+                return
+            async with request.app.state.get_connection(request, "r") as conn:
+                fingerprint = await conn.fetchval(FINGERPRINT_SQL)
+            self._checked = time.monotonic()
+            if fingerprint != self._fingerprint:
+                await self.invalidate(None)
+                self._fingerprint = fingerprint
+
+
+@attr.s
+class CachedFiltersClient(FiltersClient):
+    """Filters client serving queryables from a `QueryablesCache`."""
+
+    cache: Optional[QueryablesCache] = attr.ib(default=None)
+
+    async def get_queryables(
+        self,
+        request: Request,
+        collection_id: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """Get the queryables available for the given collection_id.
+
+        As upstream, with `$id` set to the request URL, from the cache.
+        """
+        if self.cache is None:
+            return await super().get_queryables(request, collection_id, **kwargs)
+
+        document = await self.cache.get(request, collection_id)
+        if document is None:
+            raise NotFoundError(f"Collection {collection_id} not found")
+
+        prefix, suffix, digest = document
+        url = str(request.url)
+        body = prefix + orjson.dumps(url) + suffix
+        etag = hashlib.blake2b(digest + url.encode(), digest_size=16).hexdigest()
+        return Response(
+            body,
+            media_type=JSONSchemaResponse.media_type,
+            headers={"ETag": f'"{etag}"'},
+        )
@@ -0,0 +1,63 @@
+"""Classification of request paths into the STAC API read routes.
+
+Shared by the middlewares that treat routes differently (caching, conditional
+GET, compression...), which run before FastAPI has resolved the route.
+"""
+
+from typing import Optional
+
+from starlette.types import Scope
+
+# Route names, as returned by `match_route`
+LANDING = "landing"
+CONFORMANCE = "conformance"
+SEARCH = "search"
+QUERYABLES = "queryables"
+COLLECTIONS = "collections"
+COLLECTION = "collection"
+ITEMS = "items"
+ITEM = "item"
+
+
+def route_path(scope: Scope) -> str:
+    """Request path relative to the app's root path, without trailing slash."""
+    path: str = scope["path"]
+    root_path: str = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path) :]
+    return path.rstrip("/") or "/"
+
+
+def match_route(method: str, path: str) -> Optional[tuple[str, Optional[str]]]:
+    """Return (route name, collection id) for the read routes, else None.
+
+    The collection id is None for routes that are not scoped to a single
+    collection. Only `/search` is matched for POST.
+    """
+    # ASGI has already decoded the path, ids are used as they are
+    parts = path.strip("/").split("/") if path != "/" else []
+
+    if parts == ["search"] and method in ("GET", "POST"):
+        return SEARCH, None
+    if method != "GET":
+        return None
+    if not parts:
+        return LANDING, None
+    if parts == ["conformance"]:
+        return CONFORMANCE, None
+    if parts == ["queryables"]:
+        return QUERYABLES, None
+    if parts == ["collections"]:
+        return COLLECTIONS, None
+    if len(parts) >= 2 and parts[0] == "collections":
+        collection_id = parts[1]
+        rest = parts[2:]
+        if not rest:
+            return COLLECTION, collection_id
+        if rest == ["queryables"]:
+            return QUERYABLES, collection_id
+        if rest == ["items"]:
+            return ITEMS, collection_id
+        if len(rest) == 2 and rest[0] == "items":
+            return ITEM, collection_id
+    return None
@@ -1,5 +1,136 @@
+from typing import Any, Dict, List, Literal, Optional
+
 from stac_fastapi.pgstac.config import Settings as _Settings
 
 
 class Settings(_Settings):
     """Settings specific to this deployment of STAC FastAPI PgSTAC"""
+
+    # Response cache (opt-in), TTLs are in seconds and 0 disables a route
+    response_cache_enabled: bool = False
+    # "memory", "sqlite", "redis" or a "module:Class" import path
+    response_cache_backend: str = "memory"
+    # SQLite database path or Redis URL, for the shared backends
+    response_cache_url: Optional[str] = None
+    response_cache_max_bytes: int = 64 * 1024 * 1024
+    response_cache_max_entry_bytes: int = 8 * 1024 * 1024
+    response_cache_search_ttl: float = 30
+    response_cache_collections_ttl: float = 300
+    response_cache_queryables_ttl: float = 3600
+
+    # Share one pgstac search() call between identical concurrent searches
+    search_single_flight: bool = True
+
+    # Conditional GET (ETag / Last-Modified, 304 Not Modified). The
+    # Cache-Control values are sent as-is, an empty string sends none
+    conditional_get_enabled: bool = True
+    cache_control_collections: str = "public, max-age=60"
+    cache_control_items: str = "public, max-age=60"
+    # /search and /collections/{collectionId}/items pages
+    cache_control_search: str = "public, no-cache"
+    cache_control_queryables: str = "public, max-age=60"
+
+    # Response compression: bodies below the minimum size are sent as-is,
+    # from the offload size up they are compressed in a worker pool
+    compression_minimum_size: int = 1024
+    compression_offload_size: int = 256 * 1024
+    compression_workers: int = 2
+
+    # Prometheus metrics on /metrics, and Server-Timing response headers
+    metrics_enabled: bool = False
+    server_timing_enabled: bool = False
+
+    # Slow pgstac searches, threshold in seconds (unset disables the log).
+    # A fraction of them get an EXPLAIN (ANALYZE, BUFFERS), which runs the
+    # query a second time
+    slow_query_threshold: Optional[float] = None
+    slow_query_explain_sample_rate: float = 0.0
+    slow_query_log_file: Optional[str] = None
+
+    # Admission control: slots shared by all requests, and per client
+    # (API key header, else IP address). A client rate of 0 disables the
+    # rate limit
+    admission_control_enabled: bool = False
+    admission_max_concurrency: int = 20
+    admission_client_concurrency: int = 4
+    admission_client_rate: float = 0.0
+    admission_client_burst: int = 20
+    admission_queue_size: int = 100
+    admission_client_queue_size: int = 10
+    admission_queue_timeout: float = 10.0
+    admission_api_key_header: Optional[str] = None
+    admission_trust_forwarded_for: bool = False
+
+    # Streaming export (POST /search/export), and the number of items per
+    # pgstac search() call it makes
+    export_enabled: bool = True
+    export_page_size: int = 500
+
+    # GeoParquet export (needs stac-geoparquet). Whole-collection files are
+    # cached in the directory (default: in the temp dir) for up to the TTL
+    geoparquet_enabled: bool = False
+    geoparquet_cache_dir: Optional[str] = None
+    geoparquet_cache_ttl: float = 24 * 3600
+
+    # Vector tiles of item footprints (/collections/{collectionId}/tiles),
+    # cached per process up to the size, for up to the TTL (seconds)
+    tiles_enabled: bool = True
+    tiles_max_zoom: int = 15
+    tiles_max_features: int = 20000
+    tiles_cache_max_bytes: int = 64 * 1024 * 1024
+    tiles_cache_ttl: float = 300
+    tiles_cache_control: str = "public, max-age=60"
+
+    # Pass-through serialization of search pages: items are split out of the
+    # pgstac result in the database and embedded in the response without
+    # being decoded (not with USE_API_HYDRATE)
+    passthrough_responses: bool = False
+
+    # Viewport-snapped searches: first-page bbox searches are answered from
+    # cached sub-searches over the (at most max_tiles) WebMercator tiles
+    # covering the bbox. Sub-search results are kept for the TTL (seconds),
+    # in the response cache when it is enabled
+    viewport_snap_enabled: bool = False
+    viewport_snap_max_tiles: int = 9
+    viewport_snap_max_zoom: int = 14
+    viewport_snap_ttl: float = 300
+
+    # How searches count their matches by default: "exact", "estimated"
+    # (planner estimate) or "none"; unset leaves it to the pgstac `context`
+    # setting. Searches can pick another with the `count` parameter
+    number_matched: Optional[Literal["exact", "estimated", "none"]] = None
+
+    # In-memory collection catalog: collection searches are answered from an
+    # index of every collection, reloaded after collection transactions and
+    # every refresh interval (seconds). Needs numpy and snowballstemmer
+    collection_catalog_enabled: bool = False
+    collection_catalog_refresh_interval: float = 60
+
+    # Queryables documents, precomputed and served from memory; changes to
+    # the queryables table are picked up within the refresh interval (seconds)
+    queryables_cache_enabled: bool = True
+    queryables_refresh_interval: float = 60
+
+    # Aggregations (/aggregate). Results are cached for up to the TTL
+    # (seconds), in the response cache when it is enabled; the largest
+    # frequency distributions are cut to the most frequent buckets
+    aggregation_enabled: bool = True
+    aggregation_max_zoom: int = 12
+    aggregation_max_buckets: int = 10000
+    aggregation_cache_ttl: float = 300
+
+    # Database warm-up: before the app accepts requests, the read pool's
+    # minimum connections each run the searches (default: a first page, and
+    # a global bbox page), for at most the timeout (seconds)
+    db_warmup_enabled: bool = True
+    db_warmup_searches: Optional[List[Dict[str, Any]]] = None
+    db_warmup_timeout: float = 30
+
+    # Load-adaptive pools: every interval (seconds), the number of
+    # connections kept open (between DB_MIN_CONN_SIZE and DB_MAX_CONN_SIZE)
+    # grows by the step when checkouts wait longer than the threshold
+    # (seconds), and shrinks by one when connections are left unused
+    db_pool_adaptive: bool = True
+    db_pool_adapt_interval: float = 5
+    db_pool_wait_threshold: float = 0.005
+    db_pool_grow_step: int = 2
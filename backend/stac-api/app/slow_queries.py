@@ -0,0 +1,116 @@
+"""Slow-query log for pgstac searches.
+
+Searches whose pgstac `search()` call takes longer than a threshold are
+logged as one JSON line each, with the canonical search body, the time spent
+in `search()` and the row counts. A sampled fraction of them also gets an
+`EXPLAIN (ANALYZE, BUFFERS)` of the items query pgstac builds for the
+search, which runs in the background after the response has been sent,
+cancelled by a `statement_timeout` of `EXPLAIN_TIMEOUT_FACTOR` times the
+threshold.
+"""
+
+import asyncio
+import logging
+import math
+import random
+from logging.handlers import WatchedFileHandler
+from typing import Any, Optional
+
+import orjson
+from buildpg import render
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+# The EXPLAIN ANALYZE re-run is cancelled after this many times the threshold
+EXPLAIN_TIMEOUT_FACTOR = 3
+
+STATEMENT_TIMEOUT_SQL = "SELECT set_config('statement_timeout', $1, true);"
+
+
+class SlowQueryLog:
+    """Log pgstac searches slower than `threshold` seconds."""
+
+    def __init__(
+        self,
+        threshold: float,
+        explain_sample_rate: float = 0.0,
+        log_file: Optional[str] = None,
+    ) -> None:
+        """With a `log_file`, records go there rather than only to the
+        application log.
+        """
+        self.threshold = threshold
+        self.explain_sample_rate = explain_sample_rate
+        if log_file:
+            handler = WatchedFileHandler(log_file)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        # At most one EXPLAIN ANALYZE at a time, it runs the query again
+        self._explaining: Optional[asyncio.Task] = None
+
+    def observe(
+        self, request: Request, search_request_json: str, seconds: float, result: str
+    ) -> None:
+        """Record a pgstac `search()` call that took `seconds`."""
+        if seconds < self.threshold:
+            return
+
+        search = orjson.loads(search_request_json)
+        record: dict[str, Any] = {
+            "event": "slow_search",
+            "path": request.url.path,
+            "search_ms": round(seconds * 1000, 1),
+            "search": search,
+        }
+        try:
+            context = orjson.loads(result)
+        except (orjson.JSONDecodeError, TypeError):
+            context = {}
+        for count in ("numberReturned", "numberMatched"):
+            if count in context:
+                record[count] = context[count]
+
+        if random.random() < self.explain_sample_rate and (
+            self._explaining is None or self._explaining.done()
+        ):
+            self._explaining = asyncio.create_task(self._explain(request, record))
+        else:
+            logger.warning(_dumps(record))
+
+    async def _explain(self, request: Request, record: dict[str, Any]) -> None:
+        """Log `record` with the plan of its items query (without the
+        pagination token filter).
+        """
+        try:
+            timeout_ms = math.ceil(self.threshold * EXPLAIN_TIMEOUT_FACTOR * 1000)
+            async with (
+                request.app.state.get_connection(request, "r") as conn,
+                conn.transaction(),
+            ):
+                await conn.execute(STATEMENT_TIMEOUT_SQL, f"{timeout_ms}ms")
+                q, p = render(
+                    """
+                    SELECT _where, orderby FROM search_query(:req::text::jsonb);
+                    """,
+                    req=orjson.dumps(record["search"]).decode(),
+                )
+                query = await conn.fetchrow(q, *p)
+                limit = int(record["search"].get("limit", 10)) + 1
+                plan = await conn.fetch(
+                    "EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM items "
+                    f"WHERE {query['_where']} ORDER BY {query['orderby']} "
+                    f"LIMIT {limit};"
+                )
+            record["where"] = query["_where"]
+            record["orderby"] = query["orderby"]
+            record["explain"] = [row[0] for row in plan]
+        except Exception as e:
+            record["explain_error"] = repr(e)
+        logger.warning(_dumps(record))
+
+
+def _dumps(record: dict[str, Any]) -> str:
+    return orjson.dumps(record, default=str).decode()
@@ -0,0 +1,187 @@
+"""Mapbox vector tiles of item footprints, rendered by PostGIS.
+
+Each tile is one query over the items of a collection, using the spatial
+index on `geometry`: footprints are simplified to the tile resolution,
+clipped to the tile (plus its buffer), and encoded with `ST_AsMVT`. Rendered
+tiles are kept in a bounded in-process LRU cache, which transactions on the
+collection invalidate; the TTL picks up items ingested directly into pgstac.
+"""
+
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import attr
+from fastapi import APIRouter, FastAPI, Path, Request
+from stac_fastapi.types.errors import NotFoundError
+from stac_fastapi.types.extension import ApiExtension
+from starlette.responses import Response
+
+MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+LAYER = "footprints"
+EXTENT = 4096
+BUFFER = 256
+# Footprints are simplified to this many tile units before clipping,
+# ST_AsMVTGeom snaps what remains to the tile grid
+SIMPLIFY_UNITS = 16
+
+TILE_QUERY = f"""
+WITH bounds AS (
+    SELECT
+        tile,
+        ST_Transform(
+            ST_Expand(tile, (ST_XMax(tile) - ST_XMin(tile)) * {BUFFER / EXTENT}),
+            4326
+        ) AS box
+    FROM ST_TileEnvelope($2, $3, $4) AS tile
+)
+SELECT
+    EXISTS (SELECT 1 FROM collections WHERE id = $1) AS found,
+    (
+        SELECT ST_AsMVT(features, '{LAYER}', {EXTENT}, 'geom')
+        FROM (
+            SELECT
+                i.id,
+                to_char(
+                    i.datetime AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"'
+                ) AS datetime,
+                ST_AsMVTGeom(
+                    ST_Transform(
+                        ST_ClipByBox2D(ST_Simplify(i.geometry, $5, true), bounds.box),
+                        3857
+                    ),
+                    bounds.tile,
+                    {EXTENT},
+                    {BUFFER}
+                ) AS geom
+            FROM items i, bounds
+            WHERE i.collection = $1 AND i.geometry && bounds.box
+            ORDER BY i.datetime DESC
+            LIMIT $6
+        ) AS features
+        WHERE geom IS NOT NULL
+    ) AS tile;
+"""
+
+TileKey = Tuple[str, int, int, int]
+
+
+class TileCache:
+    """In-process LRU cache of rendered tiles, bounded in total bytes.
+
+    Each collection has a generation, bumped on invalidation: a tile is only
+    stored if its collection was not invalidated while it was rendered.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._tiles: OrderedDict[TileKey, Tuple[bytes, float]] = OrderedDict()
+        self._generations: dict[str, int] = {}
+        self._generation = 0
+        self._size = 0
+
+    def generation(self, collection_id: str) -> Tuple[int, int]:
+        return self._generation, self._generations.get(collection_id, 0)
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        entry = self._tiles.get(key)
+        if entry is None:
+            return None
+        tile, expires = entry
+        if expires <= time.monotonic():
+            self._remove(key)
+            return None
+        self._tiles.move_to_end(key)
+        return tile
+
+    def set(self, key: TileKey, tile: bytes, generation: Tuple[int, int]) -> None:
+        if generation != self.generation(key[0]) or len(tile) > self.max_bytes:
+            return
+        self._remove(key)
+        self._tiles[key] = (tile, time.monotonic() + self.ttl)
+        self._size += len(tile)
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._tiles)))
+
+    async def invalidate(self, collection_id: Optional[str]) -> None:
+        """Drop the tiles of `collection_id`, or every tile if None."""
+        if collection_id is None:
+            self._generation += 1
+            self._tiles.clear()
+            self._size = 0
+            return
+        self._generations[collection_id] = self._generations.get(collection_id, 0) + 1
+        for key in [key for key in self._tiles if key[0] == collection_id]:
+            self._remove(key)
+
+    def _remove(self, key: TileKey) -> None:
+        entry = self._tiles.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+
+@attr.s
+class TilesExtension(ApiExtension):
+    """Vector tiles extension.
+
+    Adds `GET /collections/{collection_id}/tiles/{z}/{x}/{y}.mvt`, the item
+    footprints of a collection in a web mercator tile, with their `id` and
+    `datetime`, newest first.
+    """
+
+    cache: TileCache = attr.ib()
+    max_zoom: int = attr.ib(default=15)
+    max_features: int = attr.ib(default=20000)
+    cache_control: str = attr.ib(default="")
+    conformance_classes: List[str] = attr.ib(factory=list)
+    schema_href: Optional[str] = attr.ib(default=None)
+
+    async def tile(
+        self,
+        request: Request,
+        collection_id: str = Path(description="Collection ID"),
+        z: int = Path(ge=0),
+        x: int = Path(ge=0),
+        y: int = Path(ge=0),
+    ) -> Response:
+        """Item footprints of a collection, as a Mapbox vector tile."""
+        if z > self.max_zoom or x >= 2**z or y >= 2**z:
+            raise NotFoundError(f"Tile {z}/{x}/{y} does not exist.")
+
+        key = (collection_id, z, x, y)
+        tile = self.cache.get(key)
+        if tile is None:
+            generation = self.cache.generation(collection_id)
+            # SIMPLIFY_UNITS tile units, in degrees at the equator
+            tolerance = 360 / 2**z / EXTENT * SIMPLIFY_UNITS
+            async with request.app.state.get_connection(request, "r") as conn:
+                row = await conn.fetchrow(
+                    TILE_QUERY, collection_id, z, x, y, tolerance, self.max_features
+                )
+            if not row["found"]:
+                raise NotFoundError(f"Collection {collection_id} does not exist.")
+            tile = bytes(row["tile"] or b"")
+            self.cache.set(key, tile, generation)
+
+        headers = {"Cache-Control": self.cache_control} if self.cache_control else None
+        return Response(tile, media_type=MEDIA_TYPE, headers=headers)
+
+    def register(self, app: FastAPI) -> None:
+        """Register the extension with a FastAPI application."""
+        app.state.invalidation_listeners = [
+            *getattr(app.state, "invalidation_listeners", []),
+            self.cache.invalidate,
+        ]
+
+        router = APIRouter(prefix=app.state.router_prefix)
+        router.add_api_route(
+            name="Collection Footprint Tile",
+            path="/collections/{collection_id}/tiles/{z}/{x}/{y}.mvt",
+            methods=["GET"],
+            endpoint=self.tile,
+            response_class=Response,
+            responses={200: {"content": {MEDIA_TYPE: {}}}},
+        )
+        app.include_router(router, tags=["Vector Tiles Extension"])
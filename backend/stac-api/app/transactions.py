@@ -0,0 +1,117 @@
+"""Transactions clients that invalidate cached reads after every write."""
+
+from typing import Optional, Union
+
+import attr
+from fastapi import Request
+from stac_fastapi.extensions.third_party.bulk_transactions import Items
+from stac_fastapi.types import stac as stac_types
+from stac_pydantic import Collection, Item, ItemCollection
+from starlette.responses import Response
+
+from stac_fastapi.pgstac.transactions import (
+    BulkTransactionsClient as _BulkTransactionsClient,
+)
+from stac_fastapi.pgstac.transactions import (
+    TransactionsClient as _TransactionsClient,
+)
+
+from app.cache import invalidate_collection
+
+
+@attr.s
+class TransactionsClient(_TransactionsClient):
+    """Transactions client invalidating the affected collection on write.
+
+    Invalidation happens in a `finally`, so a write that fails half way still
+    drops whatever it may have touched.
+    """
+
+    async def create_item(
+        self,
+        collection_id: str,
+        item: Union[Item, ItemCollection],
+        request: Request,
+        **kwargs,
+    ) -> Optional[Union[stac_types.Item, Response]]:
+        """Create item."""
+        try:
+            return await super().create_item(collection_id, item, request, **kwargs)
+        finally:
+            await invalidate_collection(request, collection_id)
+
+    async def update_item(
+        self,
+        request: Request,
+        collection_id: str,
+        item_id: str,
+        item: Item,
+        **kwargs,
+    ) -> Optional[Union[stac_types.Item, Response]]:
+        """Update item."""
+        try:
+            return await super().update_item(
+                request, collection_id, item_id, item, **kwargs
+            )
+        finally:
+            await invalidate_collection(request, collection_id)
+
+    async def delete_item(
+        self,
+        item_id: str,
+        collection_id: str,
+        request: Request,
+        **kwargs,
+    ) -> Optional[Union[stac_types.Item, Response]]:
+        """Delete item."""
+        try:
+            return await super().delete_item(item_id, collection_id, request, **kwargs)
+        finally:
+            await invalidate_collection(request, collection_id)
+
+    async def create_collection(
+        self,
+        collection: Collection,
+        request: Request,
+        **kwargs,
+    ) -> Optional[Union[stac_types.Collection, Response]]:
+        """Create collection."""
+        try:
+            return await super().create_collection(collection, request, **kwargs)
+        finally:
+            await invalidate_collection(request, collection.id)
+
+    async def update_collection(
+        self,
+        collection: Collection,
+        request: Request,
+        **kwargs,
+    ) -> Optional[Union[stac_types.Collection, Response]]:
+        """Update collection."""
+        try:
+            return await super().update_collection(collection, request, **kwargs)
+        finally:
+            await invalidate_collection(request, collection.id)
+
+    async def delete_collection(
+        self, collection_id: str, request: Request, **kwargs
+    ) -> Optional[Union[stac_types.Collection, Response]]:
+        """Delete collection."""
+        try:
+            return await super().delete_collection(collection_id, request, **kwargs)
+        finally:
+            await invalidate_collection(request, collection_id)
+
+
+@attr.s
+class BulkTransactionsClient(_BulkTransactionsClient):
+    """Bulk transactions client invalidating the affected collection on write."""
+
+    async def bulk_item_insert(self, items: Items, request: Request, **kwargs) -> str:
+        """Bulk item insertion using pgstac."""
+        try:
+            return await super().bulk_item_insert(items, request, **kwargs)
+        finally:
+            await invalidate_collection(
+                request, request.path_params.get("collection_id")
+            )
@@ -0,0 +1,390 @@
+"""Viewport-snapped searches, answered from tile-aligned sub-searches.
+
+A map sends the bbox it shows, so nearly every pan is a new search. In this
+mode a first-page bbox search is split into one sub-search per WebMercator
+tile covering the bbox, at the finest zoom where at most `max_tiles` tiles
+are needed. Sub-searches keep every other parameter (and the limit), so
+their results only depend on the tile, and are cached per tile. The items
+of the tiles are then deduplicated, filtered to those whose geometry
+intersects the bbox (planar, as pgstac's `ST_Intersects`), and merged in the
+sort order of the search.
+
+The merge is only used when it is exact: a tile that had more matches than
+the limit bounds how far down its sort order the merged items are known to
+be complete. When fewer than `limit` items are known complete, the search is
+run as-is instead. So is a search that pgstac would count (its `context`
+setting is on and the search asked for no count mode): snapped pages have
+no `numberMatched`.
+"""
+
+import asyncio
+import logging
+import math
+from datetime import datetime
+from functools import cmp_to_key
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import orjson
+from starlette.requests import Request
+
+from app.cache import ALL_COLLECTIONS, CacheBackend, CachedResponse
+
+logger = logging.getLogger(__name__)
+
+ROUTE = "search-tile"
+MAX_LATITUDE = 85.0511287798066
+DEFAULT_SORTBY = [{"field": "datetime", "direction": "desc"}]
+
+Tile = Tuple[int, int, int]
+SortKey = List[Tuple[bool, Any]]
+
+
+def covering_tiles(
+    bbox: Sequence[float], max_tiles: int, max_zoom: int
+) -> Tuple[int, List[Tile]]:
+    """Tiles covering `bbox`, at the finest zoom needing at most `max_tiles`."""
+    minx, miny, maxx, maxy = bbox
+    for z in range(max_zoom, -1, -1):
+        n = 2**z
+        x0, x1 = _tile_x(minx, n), _tile_x(maxx, n)
+        y0, y1 = _tile_y(maxy, n), _tile_y(miny, n)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= max_tiles or z == 0:
+            break
+    tiles = [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    return z, tiles
+
+
+def tile_bbox(tile: Tile) -> List[float]:
+    """Bounds of a tile in degrees; the edge rows reach the poles."""
+    z, x, y = tile
+    n = 2**z
+
+    def lat(y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return [
+        x / n * 360 - 180,
+        -90.0 if y == n - 1 else lat(y + 1),
+        (x + 1) / n * 360 - 180,
+        90.0 if y == 0 else lat(y),
+    ]
+
+
+def _tile_x(lon: float, n: int) -> int:
+    return min(n - 1, max(0, math.floor((lon + 180) / 360 * n)))
+
+
+def _tile_y(lat: float, n: int) -> int:
+    lat = math.radians(min(MAX_LATITUDE, max(-MAX_LATITUDE, lat)))
+    y = (1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n
+    return min(n - 1, max(0, math.floor(y)))
+
+
+def bbox_overlaps(item_bbox: Sequence[float], bbox: Sequence[float]) -> bool:
+    """Whether an item bbox (2D or 3D, maybe across the antimeridian)
+    overlaps a 2D bbox.
+    """
+    if len(item_bbox) == 6:
+        item_bbox = [item_bbox[0], item_bbox[1], item_bbox[3], item_bbox[4]]
+    iminx, iminy, imaxx, imaxy = item_bbox
+    if imaxy < bbox[1] or iminy > bbox[3]:
+        return False
+    lons = [(iminx, imaxx)] if iminx <= imaxx else [(iminx, 180), (-180, imaxx)]
+    return any(lo <= bbox[2] and hi >= bbox[0] for lo, hi in lons)
+
+
+def geometry_intersects_bbox(geometry: Dict[str, Any], bbox: Sequence[float]) -> bool:
+    """Whether a GeoJSON geometry intersects a 2D bbox, in planar coordinates
+    as PostGIS `ST_Intersects` on EPSG:4326.
+    """
+    kind = geometry.get("type")
+    if kind == "GeometryCollection":
+        return any(
+            geometry_intersects_bbox(g, bbox) for g in geometry.get("geometries", ())
+        )
+    coordinates = geometry["coordinates"]
+    if kind == "Point":
+        return _line_intersects([coordinates], bbox)
+    if kind in ("MultiPoint", "LineString"):
+        return _line_intersects(coordinates, bbox)
+    if kind == "MultiLineString":
+        return any(_line_intersects(line, bbox) for line in coordinates)
+    if kind == "Polygon":
+        return _polygon_intersects(coordinates, bbox)
+    if kind == "MultiPolygon":
+        return any(_polygon_intersects(polygon, bbox) for polygon in coordinates)
+    raise ValueError(f"Unknown geometry type: {kind}")
+
+
+def _line_intersects(points: Sequence[Sequence[float]], bbox: Sequence[float]) -> bool:
+    """Whether a point, or any segment of a line, intersects bbox."""
+    if len(points) == 1:
+        x, y = points[0][:2]
+        return bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]
+    return any(_segment_intersects(p, q, bbox) for p, q in zip(points, points[1:]))
+
+
+def _segment_intersects(
+    p: Sequence[float], q: Sequence[float], bbox: Sequence[float]
+) -> bool:
+    """Liang-Barsky clipping of the segment pq to bbox."""
+    x0, y0 = p[0], p[1]
+    dx, dy = q[0] - x0, q[1] - y0
+    t0, t1 = 0.0, 1.0
+    for pk, qk in (
+        (-dx, x0 - bbox[0]),
+        (dx, bbox[2] - x0),
+        (-dy, y0 - bbox[1]),
+        (dy, bbox[3] - y0),
+    ):
+        if pk == 0:
+            if qk < 0:
+                return False
+        elif pk < 0:
+            t0 = max(t0, qk / pk)
+        else:
+            t1 = min(t1, qk / pk)
+        if t0 > t1:
+            return False
+    return True
+
+
+def _polygon_intersects(
+    rings: Sequence[Sequence[Sequence[float]]], bbox: Sequence[float]
+) -> bool:
+    if any(_line_intersects(ring, bbox) for ring in rings):
+        return True
+    # No ring crosses the bbox: it is all inside the polygon, or all outside
+    x, y = bbox[0], bbox[1]
+    inside = False
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip((p[:2] for p in ring), (p[:2] for p in ring[1:])):
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+
+def sort_key_function(
+    sortby: List[Dict[str, str]],
+) -> Tuple[Callable[[Dict[str, Any]], SortKey], Callable[[SortKey, SortKey], int]]:
+    """Sort key of an item and comparison, matching pgstac's order.
+
+    pgstac sorts nulls as the largest values, and breaks ties on `id`
+    (descending).
+    """
+    fields = [(s["field"], s.get("direction", "asc")) for s in sortby]
+    if not any(field == "id" for field, _ in fields):
+        fields.append(("id", "desc"))
+    getters = [_getter(field) for field, _ in fields]
+    descending = [direction.lower().startswith("desc") for _, direction in fields]
+
+    def key(item: Dict[str, Any]) -> SortKey:
+        values = []
+        for get in getters:
+            value = get(item)
+            values.append((value is None, value))
+        return values
+
+    def compare(a: SortKey, b: SortKey) -> int:
+        for (a_null, a_value), (b_null, b_value), desc in zip(a, b, descending):
+            if a_null or b_null:
+                result = (a_null > b_null) - (a_null < b_null)
+            else:
+                result = (a_value > b_value) - (a_value < b_value)
+            if result:
+                return -result if desc else result
+        return 0
+
+    return key, compare
+
+
+def _getter(field: str) -> Callable[[Dict[str, Any]], Any]:
+    if field in ("id", "collection"):
+        return lambda item: item.get(field)
+    name = field.removeprefix("properties.")
+    if name == "datetime":
+        return lambda item: _datetime(
+            item.get("properties", {}).get("datetime")
+            or item.get("properties", {}).get("start_datetime")
+        )
+    if name.endswith("datetime"):
+        return lambda item: _datetime(item.get("properties", {}).get(name))
+    return lambda item: item.get("properties", {}).get(name)
+
+
+def _datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def sort_paths(sortby: List[Dict[str, str]]) -> Set[str]:
+    """Item paths the sort order is read from."""
+    paths = {"id"}
+    for s in sortby:
+        field = s["field"]
+        if field in ("id", "collection"):
+            paths.add(field)
+        else:
+            name = field.removeprefix("properties.")
+            paths.add(f"properties.{name}")
+            if name == "datetime":
+                paths.add("properties.start_datetime")
+    return paths
+
+
+def _returned(path: str, include: Set[str], exclude: Set[str]) -> bool:
+    """Whether the fields extension keeps `path` in the items."""
+
+    def covers(fields: Set[str]) -> bool:
+        return any(path == f or path.startswith(f + ".") for f in fields)
+
+    return not covers(exclude) and (not include or covers(include))
+
+
+class ViewportSnap:
+    """Answer first-page bbox searches from cached tile sub-searches."""
+
+    def __init__(
+        self,
+        cache: CacheBackend,
+        max_tiles: int = 9,
+        max_zoom: int = 14,
+        ttl: float = 300,
+    ) -> None:
+        self.cache = cache
+        self.max_tiles = max_tiles
+        self.max_zoom = max_zoom
+        self.ttl = ttl
+        # Whether pgstac counts searches that ask for no count mode, seen
+        # from the tile pages: such searches are then not snapped
+        self.context_counts = False
+
+    def applies(self, search: Dict[str, Any], count: Optional[str] = None) -> bool:
+        """Whether `search`, with the `count` mode, can be answered from tiles."""
+        if count not in (None, "none") or (count is None and self.context_counts):
+            return False
+        bbox = search.get("bbox")
+        if (
+            not bbox
+            or len(bbox) != 4
+            or bbox[0] > bbox[2]
+            or search.get("token")
+            or search.get("intersects")
+            or search.get("ids")
+        ):
+            return False
+        fields = search.get("fields") or {}
+        include = set(fields.get("include") or ())
+        exclude = set(fields.get("exclude") or ())
+        paths = {"bbox", "geometry", "collection"} | sort_paths(
+            search.get("sortby") or DEFAULT_SORTBY
+        )
+        return all(_returned(path, include, exclude) for path in paths)
+
+    async def search(
+        self,
+        request: Request,
+        search: Dict[str, Any],
+        query: Callable[[str], Any],
+    ) -> Optional[Dict[str, Any]]:
+        """Merged page of `search`, or None to run the search as-is.
+
+        `query` runs a pgstac search body (JSON) and returns the result text.
+        """
+        bbox = search["bbox"]
+        limit = int(search.get("limit") or 10)
+        _, tiles = covering_tiles(bbox, self.max_tiles, self.max_zoom)
+        pages = await asyncio.gather(
+            *(self._tile_page(request, search, tile, query) for tile in tiles)
+        )
+
+        key, compare = sort_key_function(search.get("sortby") or DEFAULT_SORTBY)
+        items: Dict[Tuple[str, str], Tuple[SortKey, Dict[str, Any]]] = {}
+        frontier: Optional[SortKey] = None
+        if any("numberMatched" in page for page in pages):
+            # Counted by pgstac: the direct search has a count, not this page
+            self.context_counts = True
+            return None
+        try:
+            for page in pages:
+                features = page.get("features") or []
+                if features and any(
+                    link.get("rel") == "next" for link in page.get("links") or ()
+                ):
+                    # Matches of this tile beyond its last item are unknown
+                    last = key(features[-1])
+                    if frontier is None or compare(last, frontier) < 0:
+                        frontier = last
+                for feature in features:
+                    item_bbox = feature.get("bbox")
+                    if item_bbox is not None and not bbox_overlaps(item_bbox, bbox):
+                        continue
+                    geometry = feature.get("geometry")
+                    if geometry is None or not geometry_intersects_bbox(geometry, bbox):
+                        continue
+                    items[(feature.get("collection"), feature.get("id"))] = (
+                        key(feature),
+                        feature,
+                    )
+            merged = sorted(
+                items.values(), key=cmp_to_key(lambda a, b: compare(a[0], b[0]))
+            )
+        except (KeyError, TypeError, ValueError):
+            # Values that cannot be ordered as pgstac would, or geometries
+            # that cannot be read
+            return None
+
+        if frontier is not None:
+            complete = [item for item in merged if compare(item[0], frontier) <= 0]
+            if len(complete) < limit:
+                return None
+        else:
+            complete = merged
+
+        features = [feature for _, feature in complete[:limit]]
+        page = {
+            "type": "FeatureCollection",
+            "features": features,
+            "links": [],
+            "numberReturned": len(features),
+        }
+        if features and (len(complete) > limit or frontier is not None):
+            page["next"] = f"{features[-1]['collection']}:{features[-1]['id']}"
+        return page
+
+    async def _tile_page(
+        self,
+        request: Request,
+        search: Dict[str, Any],
+        tile: Tile,
+        query: Callable[[str], Any],
+    ) -> Dict[str, Any]:
+        sub = {**search, "bbox": tile_bbox(tile)}
+        sub_json = orjson.dumps(sub, option=orjson.OPT_SORT_KEYS).decode()
+        cache_key = f"{ROUTE}:{sub_json}"
+
+        # As the response cache, fail open: a backend error is a miss
+        cached: Optional[CachedResponse] = None
+        generation: Optional[int] = None
+        try:
+            cached = await self.cache.get(cache_key)
+            if cached is None:
+                generation = await self.cache.generation()
+        except Exception:
+            logger.warning("Response cache read failed", exc_info=True)
+        self.cache.record(ROUTE, cached is not None)
+        if cached is not None:
+            return orjson.loads(cached.body)
+
+        body = await query(sub_json)
+        if generation is not None:
+            collections = frozenset(search.get("collections") or (ALL_COLLECTIONS,))
+            try:
+                await self.cache.set(
+                    cache_key,
+                    CachedResponse(200, [], body.encode(), collections),
+                    self.ttl,
+                    generation,
+                )
+            except Exception:
+                logger.warning("Response cache write failed", exc_info=True)
+        return orjson.loads(body)
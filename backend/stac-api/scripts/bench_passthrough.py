@@ -0,0 +1,180 @@
+"""Benchmark pass-through serialization of a search page.
+
+Times `GET /search?limit=1000` through the whole app (middlewares included),
+with and without `PASSTHROUGH_RESPONSES`, against canned pgstac results for
+1000 OpenAerialMap-like items, so only the API's own CPU time is measured.
+
+Usage:
+    PYTHONPATH=. uv run python scripts/bench_passthrough.py [--items 1000] [--rounds 20]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List
+
+import orjson
+
+from app.main import app, settings
+
+
+def make_item(i: int) -> Dict[str, Any]:
+    """An item shaped like the OpenAerialMap ones."""
+    x, y = random.uniform(-180, 170), random.uniform(-80, 70)
+    ring = [
+        [round(x + dx, 7), round(y + dy, 7)]
+        for dx, dy in [(0, 0), (0.1, 0.01), (0.11, 0.1), (0.01, 0.11), (0, 0)]
+    ]
+    return {
+        "type": "Feature",
+        "stac_version": "1.0.0",
+        "stac_extensions": [
+            "https://stac-extensions.github.io/projection/v1.1.0/schema.json"
+        ],
+        "id": f"item-{i:06d}",
+        "collection": "openaerialmap",
+        "bbox": [x, y, x + 0.11, y + 0.11],
+        "geometry": {"type": "Polygon", "coordinates": [ring]},
+        "properties": {
+            "title": f"Survey {i}",
+            "datetime": "2024-05-01T10:00:00Z",
+            "start_datetime": "2024-05-01T10:00:00Z",
+            "end_datetime": "2024-05-01T11:00:00Z",
+            "gsd": 0.05,
+            "platform": "uav",
+            "license": "CC-BY-4.0",
+            "oam:producer_name": "HOT",
+            "oam:platform_type": "uav",
+            "proj:epsg": 3857,
+            "proj:shape": [20000, 20000],
+            "created": "2024-05-02T00:00:00Z",
+            "updated": "2024-05-02T00:00:00Z",
+        },
+        "assets": {
+            name: {
+                "href": f"https://oin-hotosm-temp.s3.amazonaws.com/{i}/{name}.tif",
+                "type": "image/tiff; application=geotiff",
+                "roles": [role],
+            }
+            for name, role in [
+                ("visual", "data"),
+                ("thumbnail", "thumbnail"),
+                ("metadata", "metadata"),
+            ]
+        },
+        "links": [{"rel": "license", "href": "https://creativecommons.org/"}],
+    }
+
+
+class CannedConnection:
+    """Answers pgstac `search()` with a prepared page, in both shapes."""
+
+    def __init__(self, items: List[Dict[str, Any]]) -> None:
+        page = {
+            "type": "FeatureCollection",
+            "numberReturned": len(items),
+            "links": [
+                {
+                    "rel": "next",
+                    "type": "application/geo+json",
+                    "method": "GET",
+                    "href": "./search?token=next:openaerialmap:item-000999",
+                }
+            ],
+        }
+        self.text = orjson.dumps({**page, "features": items}).decode()
+        # As Postgres writes jsonb out as text
+        self.row = {
+            "page": json.dumps(page),
+            "features": [
+                json.dumps({k: v for k, v in item.items() if k != "links"})
+                for item in items
+            ],
+            "collections": [item["collection"] for item in items],
+            "ids": [item["id"] for item in items],
+            "links": [json.dumps(item["links"]) for item in items],
+        }
+
+    async def fetchval(self, query: str, *args: Any) -> str:
+        return self.text
+
+    async def fetchrow(self, query: str, *args: Any) -> Dict[str, Any]:
+        return self.row
+
+
+async def get(path: str, query: str) -> bytes:
+    """Run one GET request through the ASGI app, return the body."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "server": ("localhost", 8082),
+        "client": ("127.0.0.1", 50000),
+        "root_path": "",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": [(b"host", b"localhost:8082")],
+    }
+    body = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return b"".join(body)
+
+
+async def bench(items: int, rounds: int) -> None:
+    random.seed(0)
+    connection = CannedConnection([make_item(i) for i in range(items)])
+
+    @asynccontextmanager
+    async def get_connection(request, readwrite="r"):
+        yield connection
+
+    app.state.get_connection = get_connection
+    query = f"limit={items}"
+
+    results = {}
+    bodies = {}
+    for passthrough in (False, True):
+        settings.passthrough_responses = passthrough
+        await get("/search", query)  # warm up
+        times = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            bodies[passthrough] = await get("/search", query)
+            times.append(time.perf_counter() - started)
+        results[passthrough] = statistics.median(times)
+
+    assert orjson.loads(bodies[False]) == orjson.loads(bodies[True])
+    default, passthrough = results[False], results[True]
+    print(f"{items} items, median of {rounds} requests")
+    print(f"  default:      {default * 1000:8.1f} ms")
+    print(f"  pass-through: {passthrough * 1000:8.1f} ms")
+    print(f"  speedup:      {default / passthrough:8.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(bench(args.items, args.rounds))
+
+
+if __name__ == "__main__":
+    main()